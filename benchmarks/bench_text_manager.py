@@ -0,0 +1,207 @@
+"""
+TextManagerのテキスト処理(hot path)のマイクロベンチマーク。
+
+Usage:
+  python benchmarks/bench_text_manager.py
+  python benchmarks/bench_text_manager.py --sizes 1K,1M,50M --save baseline.json
+  python benchmarks/bench_text_manager.py --compare baseline.json --threshold 0.2
+
+  --compare: baselineより`threshold`(割合)以上遅くなったケースがあれば、exit code 1で終了する
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import statistics
+import tempfile
+import click
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from tagwriting.main import TextManager, HTMLClient  # noqa: E402
+from tagwriting.config_builder import ConfigBuilder  # noqa: E402
+import tagwriting.utils  # noqa: E402
+
+UNITS = {"K": 1024, "M": 1024 * 1024}
+WORDS = ("tagwriting", "prompt", "context", "markdown", "editor", "response",
+         "テキスト", "文章", "要約", "説明")
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def build_templates(custom_tags):
+    return ConfigBuilder.build({
+        "tags": [{"tag": f"custom{i}", "format": "custom: {prompt}"} for i in range(custom_tags)],
+        "attrs": {"bullet": ["bullet style", "Markdown style"], "detail": "detail"},
+        "history": {"file": None},
+        "config": {"history_warning": False},
+    })
+
+
+def generate_document(size, tag_count, custom_tags, nesting, include_name, seed=0):
+    """
+    sizeバイト程度のMarkdownを作る。
+
+    - tag_count: <prompt>/<chat>/<url>/<wikipedia>/<include>/カスタムタグの数
+    - nesting: 入れ子の深さ (<prompt>a <prompt>b</prompt></prompt>)
+    """
+    rng = random.Random(seed)
+    tags = []
+    for i in range(tag_count):
+        kind = i % 6
+        if kind == 0:
+            inner = "summarize this"
+            for _ in range(nesting):
+                inner = f"outer <prompt>{inner}</prompt>"
+            tags.append(f"<prompt(gpt):bullet:detail>{inner}</prompt>")
+        elif kind == 1:
+            tags.append("<chat:detail>translate</chat>")
+        elif kind == 2:
+            tags.append("<url>https://example.com</url>")
+        elif kind == 3:
+            tags.append("<wikipedia>Python</wikipedia>")
+        elif kind == 4:
+            tags.append(f"<include>{include_name}</include>")
+        elif custom_tags:
+            name = f"custom{rng.randrange(custom_tags)}"
+            tags.append(f"<{name}:bullet>custom body</{name}>")
+        else:
+            tags.append("<chat>plain</chat>")
+    paragraphs = []
+    length = 0
+    section = 0
+    while length < size:
+        if len(paragraphs) % 20 == 0:
+            section += 1
+            paragraph = f"## Section {section}"
+        else:
+            paragraph = " ".join(rng.choice(WORDS) for _ in range(40))
+        paragraphs.append(paragraph)
+        length += len(paragraph.encode("utf-8")) + 2
+    # タグはドキュメント全体に散らばせる
+    for i, tag in enumerate(tags):
+        position = (i + 1) * len(paragraphs) // (len(tags) + 1)
+        paragraphs[position] += " " + tag
+    return "\n\n".join(paragraphs)
+
+
+def generate_html(size):
+    body = "".join(f"<p>{' '.join(WORDS)} {i}</p>" for i in range(max(1, size // 100)))
+    return f"<html><head><title>Bench</title></head><body><nav>nav</nav><main>{body}</main></body></html>"
+
+
+def measure(func, repeat, budget):
+    """
+    return: (min, median) 秒
+    budget秒を超えたら、repeat回に達していなくても打ち切る
+    """
+    timings = []
+    started = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+        if time.perf_counter() - started > budget:
+            break
+    return min(timings), statistics.median(timings)
+
+
+def cases(size, tag_count, custom_tags, nesting, workdir):
+    include_path = os.path.join(workdir, "include.md")
+    with open(include_path, "w", encoding="utf-8") as f:
+        f.write("included text\n" * 100)
+    filepath = os.path.join(workdir, "bench.md")
+    document = generate_document(size, tag_count, custom_tags, nesting, "include.md")
+    templates = build_templates(custom_tags)
+    history = {"previous_prompt": "", "previous_response": ""}
+    html = generate_html(size)
+    response = document[: min(len(document), 64 * 1024)] + "<prompt:bullet>x</prompt><chat>y</chat>"
+    tag = templates["tags"][0] if templates["tags"] else {"tag": "custom", "format": "{prompt}"}
+
+    def pre_prompt():
+        manager = TextManager(filepath, templates, history)
+        manager.text = document
+        manager._pre_prompt(save=False)
+
+    return {
+        "extract_tag_contents": lambda: TextManager.extract_tag_contents("prompt", document),
+        "attar_and_llm": lambda: [TextManager.attar_and_llm("(gpt):funny:detail") for _ in range(1000)],
+        "safe_text": lambda: TextManager.safe_text(TextManager.safe_text(response, "prompt"), "chat"),
+        "convert_custom_tag": lambda: [
+            TextManager.convert_custom_tag(dict(tag), "prompt", ["a", "b"], "gpt") for _ in range(1000)],
+        "_pre_prompt": pre_prompt,
+        "replace_include_tags": lambda: TextManager.replace_include_tags(filepath, document),
+        "build_attrs_rules": lambda: [
+            TextManager.build_attrs_rules(["bullet", "detail"], templates) for _ in range(1000)],
+        "html_to_text": lambda: HTMLClient.html_to_text(html, False, simple_text=True),
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, current in sorted(results.items()):
+        if name not in baseline:
+            continue
+        previous = baseline[name]["min"]
+        ratio = current["min"] / previous if previous else 1.0
+        mark = "REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{name:60s} {previous * 1000:10.3f}ms -> {current['min'] * 1000:10.3f}ms ({ratio:5.2f}x) {mark}")
+        if mark:
+            regressions.append(name)
+    return regressions
+
+
+@click.command()
+@click.option("--sizes", default="1K,100K,1M,10M", show_default=True, help="Document sizes (K/M suffix)")
+@click.option("--tags", "tag_counts", default="10,100", show_default=True, help="Tag counts per document")
+@click.option("--custom-tags", default=30, show_default=True, help="Number of custom tags in templates")
+@click.option("--nesting", default=1, show_default=True, help="Nesting depth of <prompt> tags")
+@click.option("--repeat", default=5, show_default=True, help="Repeat count per case")
+@click.option("--budget", default=10.0, show_default=True, help="Max seconds per case")
+@click.option("--only", default=None, help="Comma separated case names")
+@click.option("--save", "save_path", default=None, help="Save results as JSON baseline")
+@click.option("--compare", "compare_path", default=None, help="Compare with JSON baseline")
+@click.option("--threshold", default=0.2, show_default=True, help="Allowed slowdown ratio in --compare")
+def main(sizes, tag_counts, custom_tags, nesting, repeat, budget, only, save_path, compare_path, threshold):
+    tagwriting.utils.verbose = False
+    only = set(only.split(",")) if only else None
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size_text in sizes.split(","):
+            size = parse_size(size_text)
+            for tag_count in (int(t) for t in tag_counts.split(",")):
+                for name, func in cases(size, tag_count, custom_tags, nesting, workdir).items():
+                    if only and name not in only:
+                        continue
+                    key = f"{name}[size={size_text.strip()},tags={tag_count},custom={custom_tags},nest={nesting}]"
+                    best, median = measure(func, repeat, budget)
+                    results[key] = {"min": best, "median": median}
+                    print(f"{key:60s} min={best * 1000:10.3f}ms median={median * 1000:10.3f}ms")
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {"python": platform.python_version(), "platform": platform.platform()},
+                "results": results,
+            }, f, indent=2)
+        print(f"saved: {save_path}")
+
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {threshold:.0%}")
+            sys.exit(1)
+        print("no regression")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+"""
+watch -> LLM -> 書き込み までのEnd-to-Endのレイテンシを測るharness。
+
+- 一時ディレクトリに対してConsoleClientを起動し、BASE_URLをmock server(mock_llm_server.py)に向ける
+- エディタの保存を`--rate`回/秒で、`--files`個のファイルに順番に行う
+- 保存してから、LLMのレスポンスがファイルに書き込まれるまでの時間を測る
+
+Report:
+  - latency p50/p95/p99 (保存 -> 最終書き込み)
+  - FileChangeHandlerで捨てられたイベント (debounced, unchanged, ...)
+  - 重複したLLM呼び出し (mock serverが同じ内容のリクエストを数える)
+  - RSSの増加 (--duration を長くするとsoak testになる)
+
+Usage:
+  python benchmarks/e2e_latency.py --files 10 --rate 5 --duration 30 --latency 0.5
+  python benchmarks/e2e_latency.py --stream --error-rate 0.05 --json result.json
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import tempfile
+import threading
+import contextlib
+import click
+import yaml
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from tagwriting.main import ConsoleClient  # noqa: E402
+from mock_llm_server import MockLLMServer  # noqa: E402
+import tagwriting.utils  # noqa: E402
+
+RESPONSE_PATTERN = re.compile(r"MOCK:(q\d+)")
+
+
+def current_rss():
+    """
+    return: 現在のRSS (bytes)。取得できない環境では0
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        # macOSはbytes、Linuxはkilobytes (ピーク値)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        return 0
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[index]
+
+
+class Harness:
+    def __init__(self, workdir, files, rate, duration, drain, config):
+        self.workdir = workdir
+        self.paths = [os.path.join(workdir, f"doc{i}.md") for i in range(files)]
+        self.rate = rate
+        self.duration = duration
+        self.drain = drain
+        self.config = config
+        self.saved_at = {}
+        self.latencies = {}
+        self.rss = []
+        self._stop = threading.Event()
+
+    def setup(self, base_url):
+        with open(os.path.join(self.workdir, ".env"), "w", encoding="utf-8") as f:
+            f.write(f"TAGWRITING_API_KEY=dummy\nTAGWRITING_BASE_URL={base_url}\nTAGWRITING_MODEL=mock\n")
+        yaml_path = os.path.join(self.workdir, "templates.yaml")
+        with open(yaml_path, "w", encoding="utf-8") as f:
+            yaml.safe_dump({
+                "target": ["*.md"],
+                "history": {"file": None},
+                "config": dict(self.config, history_warning=False, verbose_print=False),
+            }, f)
+        for path in self.paths:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("# doc\n")
+        client = ConsoleClient()
+        client.watch_path = self.workdir
+        client.watch_path_is_dir = True
+        client.dirpath = os.path.dirname(self.workdir)
+        client.load_templates(yaml_path)
+        return client
+
+    def save_loop(self):
+        """
+        エディタの保存をシミュレートする
+        """
+        interval = 1.0 / self.rate
+        started = time.perf_counter()
+        count = 0
+        while time.perf_counter() - started < self.duration:
+            request_id = f"q{count}"
+            path = self.paths[count % len(self.paths)]
+            self.saved_at[request_id] = time.perf_counter()
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(f"# doc\n\n<chat>{request_id}</chat>\n")
+            count += 1
+            next_time = started + count * interval
+            time.sleep(max(0.0, next_time - time.perf_counter()))
+
+    def watch_loop(self):
+        """
+        ファイルを監視して、レスポンスが書き込まれた時刻を記録する
+        """
+        while not self._stop.is_set():
+            now = time.perf_counter()
+            for path in self.paths:
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        text = f.read()
+                except OSError:
+                    continue
+                for request_id in RESPONSE_PATTERN.findall(text):
+                    if request_id not in self.latencies and request_id in self.saved_at:
+                        self.latencies[request_id] = now - self.saved_at[request_id]
+            time.sleep(0.005)
+
+    def rss_loop(self):
+        while not self._stop.is_set():
+            self.rss.append(current_rss())
+            self._stop.wait(1.0)
+
+    def run(self, client):
+        observer, work_queue, handler = client.start_watching()
+        # observerの起動を待つ
+        time.sleep(0.5)
+        threads = [threading.Thread(target=self.watch_loop, daemon=True),
+                   threading.Thread(target=self.rss_loop, daemon=True)]
+        for thread in threads:
+            thread.start()
+        self.save_loop()
+        deadline = time.perf_counter() + self.drain
+        while time.perf_counter() < deadline and len(self.latencies) < len(self.saved_at):
+            time.sleep(0.05)
+        self._stop.set()
+        for thread in threads:
+            thread.join()
+        ConsoleClient.stop_watching(observer, work_queue)
+        return dict(handler.stats)
+
+
+@click.command()
+@click.option("--files", default=10, show_default=True, help="Number of watched files")
+@click.option("--rate", default=5.0, show_default=True, help="Saves per second (across all files)")
+@click.option("--duration", default=10.0, show_default=True, help="Seconds to keep saving (soak: long)")
+@click.option("--drain", default=10.0, show_default=True, help="Seconds to wait for pending responses")
+@click.option("--latency", default=0.2, show_default=True, help="Mock LLM latency (seconds)")
+@click.option("--jitter", default=0.0, show_default=True, help="Mock LLM latency jitter")
+@click.option("--error-rate", default=0.0, show_default=True, help="Mock LLM error ratio")
+@click.option("--stream/--no-stream", default=False, show_default=True, help="Use streaming responses")
+@click.option("--workers", default=2, show_default=True, help="config.queue_workers")
+@click.option("--verbose", is_flag=True, help="Show tagwriting output")
+@click.option("--json", "json_path", default=None, help="Write report as JSON")
+def main(files, rate, duration, drain, latency, jitter, error_rate, stream, workers, verbose, json_path):
+    server = MockLLMServer(latency=latency, jitter=jitter, error_rate=error_rate, seed=0)
+    server.start()
+    cwd = os.getcwd()
+    rss_start = current_rss()
+    with tempfile.TemporaryDirectory() as workdir:
+        # .envはcurrent directoryから読まれる
+        os.chdir(workdir)
+        try:
+            harness = Harness(os.path.realpath(workdir), files, rate, duration, drain, {
+                "stream": stream,
+                "stream_interval": 0.05,
+                "queue_workers": workers,
+                "fetch_cache": False,
+            })
+            output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+            with output:
+                client = harness.setup(server.base_url)
+                tagwriting.utils.verbose = False
+                handler_stats = harness.run(client)
+        finally:
+            os.chdir(cwd)
+    server.stop()
+
+    latencies = list(harness.latencies.values())
+    report = {
+        "saves": len(harness.saved_at),
+        "completed": len(latencies),
+        "lost": len(harness.saved_at) - len(latencies),
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else float("nan"),
+        },
+        "handler": handler_stats,
+        "llm": server.stats(),
+        "rss": {
+            "start": rss_start,
+            "end": harness.rss[-1] if harness.rss else current_rss(),
+            "growth": (harness.rss[-1] if harness.rss else current_rss()) - rss_start,
+        },
+    }
+    print(f"saves: {report['saves']}, completed: {report['completed']}, lost: {report['lost']}")
+    print("latency: " + ", ".join(f"{k}={v * 1000:.1f}ms" for k, v in report["latency"].items()))
+    print("handler: " + ", ".join(f"{k}={v}" for k, v in handler_stats.items()))
+    print("llm: " + ", ".join(f"{k}={v}" for k, v in report["llm"].items()))
+    print(f"rss: start={rss_start / 1e6:.1f}MB end={report['rss']['end'] / 1e6:.1f}MB "
+          f"growth={report['rss']['growth'] / 1e6:+.1f}MB")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
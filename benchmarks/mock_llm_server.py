@@ -0,0 +1,175 @@
+"""
+OpenAI互換のchat/completionsを返すローカルのmock server。
+
+- latency: レスポンスを返すまでの時間(秒) + jitter
+- stream: `stream: true`のリクエストにはSSEで返す (chunk_delay秒ごと)
+- error_rate: 指定した割合で500を返す
+- GET /stats: リクエスト数や、同じ内容のリクエスト(重複呼び出し)の数を返す
+
+Usage:
+  python benchmarks/mock_llm_server.py --port 8000 --latency 0.5 --error-rate 0.1
+  -> .env: TAGWRITING_BASE_URL=http://127.0.0.1:8000/v1
+"""
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import click
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, jitter=0.0,
+                 error_rate=0.0, chunk_delay=0.01, chunk_size=8, seed=None):
+        super().__init__(address, MockLLMHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.streams = 0
+        self.seen = {}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def record(self, payload):
+        """
+        return: Trueのときはエラーを返す
+        """
+        digest = hashlib.sha256(json.dumps(payload.get("messages"), sort_keys=True).encode()).hexdigest()
+        with self.lock:
+            self.requests += 1
+            self.seen[digest] = self.seen.get(digest, 0) + 1
+            if payload.get("stream"):
+                self.streams += 1
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "streams": self.streams,
+                "duplicates": sum(count - 1 for count in self.seen.values()),
+            }
+
+    def delay(self):
+        with self.lock:
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0
+        time.sleep(max(0.0, self.latency + jitter))
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(200, {"status": "ok"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip("/").endswith("chat/completions"):
+            self._send_json(404, {"error": "not found"})
+            return
+        failed = self.server.record(payload)
+        self.server.delay()
+        if failed:
+            self._send_json(500, {"error": {"message": "injected error"}})
+            return
+        content = self.build_content(payload)
+        if payload.get("stream"):
+            self._send_stream(content)
+        else:
+            self._send_json(200, {
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}}],
+                "model": payload.get("model"),
+            })
+
+    @classmethod
+    def build_content(cls, payload):
+        """
+        user promptの最後の行をそのまま返す -> "MOCK:{最後の行}"
+        """
+        messages = payload.get("messages") or [{"content": ""}]
+        lines = messages[-1].get("content", "").strip().splitlines() or [""]
+        return f"MOCK:{lines[-1].strip()}"
+
+    def _send_stream(self, content):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        size = self.server.chunk_size
+        for i in range(0, len(content), size):
+            chunk = {"choices": [{"index": 0, "delta": {"content": content[i:i + size]}}]}
+            # 実際のサーバーと同じく、charsetなしのtext/event-streamに非ASCIIをそのまま書く
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+            time.sleep(self.server.chunk_delay)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):X}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", show_default=True)
+@click.option("--port", default=8000, show_default=True)
+@click.option("--latency", default=0.5, show_default=True, help="Response latency (seconds)")
+@click.option("--jitter", default=0.0, show_default=True, help="Latency jitter (+/- seconds)")
+@click.option("--error-rate", default=0.0, show_default=True, help="Ratio of injected 500 errors")
+@click.option("--chunk-delay", default=0.01, show_default=True, help="Delay between stream chunks")
+def main(host, port, latency, jitter, error_rate, chunk_delay):
+    server = MockLLMServer((host, port), latency, jitter, error_rate, chunk_delay)
+    print(f"Mock LLM server: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+CLIの起動時間のベンチマーク。
+
+- help: `python -m tagwriting.main --help` が終わるまで
+- import: `import tagwriting.main` が終わるまで
+- first_watch: processを起動してから、observerが監視を始めるまで
+- 自己時間の大きいmodule (`python -X importtime`)
+
+Usage:
+  python benchmarks/startup.py
+  python benchmarks/startup.py --repeat 20 --save baseline.json
+  python benchmarks/startup.py --compare baseline.json --threshold 0.2
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+import tempfile
+import click
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+FIRST_WATCH = """
+import sys
+from tagwriting.main import ConsoleClient
+client = ConsoleClient()
+client.watch_path = sys.argv[1]
+client.watch_path_is_dir = True
+client.dirpath = sys.argv[1]
+client.load_templates(None)
+observer, work_queue, _ = client.start_watching()
+print("READY", flush=True)
+ConsoleClient.stop_watching(observer, work_queue)
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    # .pycを作り直す時間は測らない
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def run_until(args, cwd, marker=None):
+    """
+    return: 起動してから終了するまで(markerがあれば、markerの行が出力されるまで)の秒数
+    """
+    started = time.perf_counter()
+    process = subprocess.Popen(args, cwd=cwd, env=child_env(),
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    elapsed = None
+    if marker is not None:
+        for line in process.stdout:
+            if line.startswith(marker):
+                elapsed = time.perf_counter() - started
+                break
+    process.communicate()
+    if elapsed is None:
+        elapsed = time.perf_counter() - started
+    if process.returncode != 0:
+        raise RuntimeError(f"failed: {' '.join(args)}")
+    return elapsed
+
+
+def import_offenders(cwd, top):
+    """
+    return: [(module, self_us, cumulative_us)] 自己時間の大きい順
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import tagwriting.main"],
+                            cwd=cwd, env=child_env(), capture_output=True, text=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    rows.sort(key=lambda row: row[1], reverse=True)
+    return rows[:top]
+
+
+def measure(func, repeat):
+    # 1回目はcacheを温めるために捨てる
+    func()
+    timings = [func() for _ in range(repeat)]
+    return {"min": min(timings), "median": statistics.median(timings)}
+
+
+@click.command()
+@click.option("--repeat", default=10, show_default=True, help="Repeat count per case")
+@click.option("--top", default=10, show_default=True, help="Number of slow modules to show")
+@click.option("--save", "save_path", default=None, help="Save results as JSON baseline")
+@click.option("--compare", "compare_path", default=None, help="Compare with JSON baseline")
+@click.option("--threshold", default=0.2, show_default=True, help="Allowed slowdown ratio in --compare")
+def main(repeat, top, save_path, compare_path, threshold):
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        cases = {
+            "help": lambda: run_until([sys.executable, "-m", "tagwriting.main", "--help"], workdir),
+            "import": lambda: run_until([sys.executable, "-c", "import tagwriting.main"], workdir),
+            "first_watch": lambda: run_until(
+                [sys.executable, "-c", FIRST_WATCH, workdir], workdir, marker="READY"),
+        }
+        for name, func in cases.items():
+            results[name] = measure(func, repeat)
+            print(f"{name:12s} min={results[name]['min'] * 1000:8.1f}ms "
+                  f"median={results[name]['median'] * 1000:8.1f}ms")
+        print("\nslowest imports (self time):")
+        for name, self_us, cumulative_us in import_offenders(workdir, top):
+            print(f"  {name:40s} self={self_us / 1000:7.1f}ms cumulative={cumulative_us / 1000:7.1f}ms")
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "meta": {"python": platform.python_version(), "platform": platform.platform()},
+                "results": results,
+            }, f, indent=2)
+        print(f"saved: {save_path}")
+
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        regressions = []
+        for name, current in results.items():
+            if name not in baseline:
+                continue
+            previous = baseline[name]["min"]
+            ratio = current["min"] / previous if previous else 1.0
+            mark = "REGRESSION" if ratio > 1 + threshold else ""
+            print(f"{name:12s} {previous * 1000:8.1f}ms -> {current['min'] * 1000:8.1f}ms ({ratio:5.2f}x) {mark}")
+            if mark:
+                regressions.append(name)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {threshold:.0%}")
+            sys.exit(1)
+        print("no regression")
+
+
+if __name__ == "__main__":
+    main()
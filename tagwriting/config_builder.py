@@ -31,9 +31,24 @@ Timestamp: {timestamp}
 
 class ConfigBuilder:
     @classmethod
-    def build(cls, templates):
+    def base_dir(cls, yaml_path, fallback):
+        """
+        キャッシュ等の相対パスの基準: yamlがあればそのディレクトリ、なければfallback (監視するディレクトリ)
+        """
+        if yaml_path:
+            return os.path.dirname(os.path.abspath(yaml_path))
+        return os.path.abspath(fallback)
+
+    @classmethod
+    def resolve_path(cls, path, base_dir=None):
+        return os.path.abspath(os.path.join(base_dir or os.getcwd(), path))
+
+    @classmethod
+    def build(cls, templates, base_dir=None):
         """ 
         Setting default templates param
+
+        base_dir: fetch_cache_path等の相対パスの基準 (None: カレントディレクトリ)
         """
         if templates is None:
             templates = {}
@@ -64,6 +79,30 @@ class ConfigBuilder:
             templates["history"] = {
                 "file": "{filename}.history.md", 
                 "template": DEFAULT_HISTORY_TEMPLATE}
+        # history notes:
+        #   backend: markdown ({filename}.history.mdに追記する) or sqlite (history.pathにまとめて保存する)
+        #     -> default: markdown
+        #     -> sqliteの履歴は `tagwriting history` で検索し、`--format markdown`でtemplateの形式に出力できる
+        #   path: sqliteのファイル
+        #     -> default: ".tagwriting/history.sqlite3"
+        #   max_bytes: これを超えたらrotateする (path -> path.1 -> ... keep個まで)
+        #     -> default: 64MB, keep: 3
+        #   batch_size / flush_interval: background threadでまとめて書き込む件数 / 秒数
+        #     -> default: 100 / 1.0
+        history = templates["history"]
+        if "backend" not in history:
+            history["backend"] = "markdown"
+        if "path" not in history:
+            history["path"] = os.path.join(".tagwriting", "history.sqlite3")
+        history["path"] = ConfigBuilder.resolve_path(history["path"], base_dir)
+        if "max_bytes" not in history:
+            history["max_bytes"] = 64 * 1024 * 1024
+        if "keep" not in history:
+            history["keep"] = 3
+        if "batch_size" not in history:
+            history["batch_size"] = 100
+        if "flush_interval" not in history:
+            history["flush_interval"] = 1.0
         if "hook" not in templates:
             templates["hook"] = {}
 
@@ -104,6 +143,186 @@ class ConfigBuilder:
         #     -> default: True
         if "history_warning" not in templates["config"]:
             templates["config"]["history_warning"] = True
+        #   fetch_cache: <url>/<wikipedia>の取得結果をディスクにキャッシュする
+        #     -> default: True
+        if "fetch_cache" not in templates["config"]:
+            templates["config"]["fetch_cache"] = True
+        #   fetch_cache_path: キャッシュファイル(SQLite)のパス
+        #     -> default: ".tagwriting/fetch_cache.sqlite3"
+        if "fetch_cache_path" not in templates["config"]:
+            templates["config"]["fetch_cache_path"] = os.path.join(".tagwriting", "fetch_cache.sqlite3")
+        templates["config"]["fetch_cache_path"] = ConfigBuilder.resolve_path(
+            templates["config"]["fetch_cache_path"], base_dir)
+        #   fetch_cache_ttl: キャッシュの有効期限(秒)。過ぎたものはETag等で再検証する
+        #     -> default: 86400 (1 day)
+        if "fetch_cache_ttl" not in templates["config"]:
+            templates["config"]["fetch_cache_ttl"] = 86400
+        #   fetch_cache_max_bytes: キャッシュの最大サイズ。超えたらLRUで削除する
+        #     -> default: 64MB
+        if "fetch_cache_max_bytes" not in templates["config"]:
+            templates["config"]["fetch_cache_max_bytes"] = 64 * 1024 * 1024
+        #   batch_process: 一回のイベントでファイル内の全てのタグを並列に処理する
+        #     -> default: False
+        if "batch_process" not in templates["config"]:
+            templates["config"]["batch_process"] = False
+        #   batch_concurrency: batch_processのときに同時に投げるLLMリクエストの数
+        #     -> default: 4
+        if "batch_concurrency" not in templates["config"]:
+            templates["config"]["batch_concurrency"] = 4
+        #   stream: LLMのレスポンスをstream(SSE)で受け取り、途中経過をファイルに書き込む
+        #     -> default: False
+        if "stream" not in templates["config"]:
+            templates["config"]["stream"] = False
+        #   stream_interval: streamのときに途中経過を書き込む間隔(秒)
+        #     -> default: 0.5
+        if "stream_interval" not in templates["config"]:
+            templates["config"]["stream_interval"] = 0.5
+        #   llm_prewarm: 起動時にLLMのbase_urlへ接続しておく
+        #     -> True or list[llm_name] (nullは.env)
+        #     -> default: False
+        if "llm_prewarm" not in templates["config"]:
+            templates["config"]["llm_prewarm"] = False
+        #   llm_groups: backend group -> [llm_name, ...] (nullは.env / 先頭がprimary)
+        #     -> <prompt(group)>のようにgroupの名前を指定すると、hedged requestで問い合わせる
+        #     -> default: {}
+        if "llm_groups" not in templates["config"]:
+            templates["config"]["llm_groups"] = {}
+        #   llm_group: (llm_name)の指定がないタグで使うgroup
+        #     -> default: None (.envだけを使う)
+        if "llm_group" not in templates["config"]:
+            templates["config"]["llm_group"] = None
+        #   llm_hedge_delay: primaryからこの秒数の間に回答がなければ、次のbackendにも投げる
+        #     -> default: 2.0
+        if "llm_hedge_delay" not in templates["config"]:
+            templates["config"]["llm_hedge_delay"] = 2.0
+        #   queue_workers: ファイルの変更を処理するworker threadの数
+        #     -> default: 2
+        if "queue_workers" not in templates["config"]:
+            templates["config"]["queue_workers"] = 2
+        #   queue_size: 処理待ちのファイルの最大数。一杯のときは新しいイベントを待たせる
+        #     -> default: 64
+        if "queue_size" not in templates["config"]:
+            templates["config"]["queue_size"] = 64
+        #   watch_backend: auto (OSのnative: inotify等) / inotify / polling (network filesystem向け)
+        #     -> default: auto
+        if "watch_backend" not in templates["config"]:
+            templates["config"]["watch_backend"] = "auto"
+        #   watch_polling_interval: pollingのときの間隔(秒)
+        #     -> default: 1.0
+        if "watch_polling_interval" not in templates["config"]:
+            templates["config"]["watch_polling_interval"] = 1.0
+        #   watch_batch_window: この秒数の間に来たイベントをまとめて処理する (0: まとめない)
+        #     -> default: 0.05
+        if "watch_batch_window" not in templates["config"]:
+            templates["config"]["watch_batch_window"] = 0.05
+        #   gitignore: .gitignoreで除外されるファイル/ディレクトリを監視しない
+        #     -> default: False
+        if "gitignore" not in templates["config"]:
+            templates["config"]["gitignore"] = False
+        #   splice_write_threshold: これ以上の大きさ(byte)のファイルは、変わった範囲だけを書き込む
+        #     -> 書き込みは速くなるが、atomicではない (その場で書き換えるので、途中でcrashしたときや
+        #        同時に読んだeditorには、書きかけのファイルが見えることがある)
+        #     -> 0: 常にファイル全体をatomic writeする
+        #     -> default: 0
+        if "splice_write_threshold" not in templates["config"]:
+            templates["config"]["splice_write_threshold"] = 0
+        #   large_file_threshold: これ以上の大きさ(byte)のファイルは、全体を読み込まずに処理する
+        #     -> mmapでタグの位置だけを探し、タグの範囲だけを書き直す (0: 使わない)
+        #     -> splice_write_thresholdと同じく、その場で書き換えるのでatomicではない
+        #     -> contextはタグの前後large_file_context_bytesだけになる
+        #     -> batch_process / batch commandでも、このファイルはタグを一つずつ処理する
+        #     -> default: 0
+        if "large_file_threshold" not in templates["config"]:
+            templates["config"]["large_file_threshold"] = 0
+        #   large_file_context_bytes: large fileのとき、contextにするタグの前後の大きさ(byte)
+        #     -> default: 256KB
+        if "large_file_context_bytes" not in templates["config"]:
+            templates["config"]["large_file_context_bytes"] = 256 * 1024
+        #   response_cache: LLMのレスポンスを(backend, model, system prompt, user prompt)でキャッシュする
+        #     -> Undo/Redoや再起動後に同じプロンプトが来ても、LLMに問い合わせずに書き戻す
+        #     -> default: False
+        if "response_cache" not in templates["config"]:
+            templates["config"]["response_cache"] = False
+        #   response_cache_path: キャッシュファイル(SQLite)のパス
+        #     -> default: ".tagwriting/response_cache.sqlite3"
+        if "response_cache_path" not in templates["config"]:
+            templates["config"]["response_cache_path"] = os.path.join(".tagwriting", "response_cache.sqlite3")
+        templates["config"]["response_cache_path"] = ConfigBuilder.resolve_path(
+            templates["config"]["response_cache_path"], base_dir)
+        #   response_cache_ttl: キャッシュの有効期限(秒)
+        #     -> default: 604800 (7 days)
+        if "response_cache_ttl" not in templates["config"]:
+            templates["config"]["response_cache_ttl"] = 7 * 86400
+        #   response_cache_max_bytes: キャッシュの最大サイズ。超えたらLRUで削除する
+        #     -> default: 64MB
+        if "response_cache_max_bytes" not in templates["config"]:
+            templates["config"]["response_cache_max_bytes"] = 64 * 1024 * 1024
+        #   url_concurrency: <url>を同時に取得する数
+        #     -> default: 8
+        if "url_concurrency" not in templates["config"]:
+            templates["config"]["url_concurrency"] = 8
+        #   url_per_host: 同じホストへの同時接続数
+        #     -> default: 2
+        if "url_per_host" not in templates["config"]:
+            templates["config"]["url_per_host"] = 2
+        #   url_max_bytes: <url>で読み込む最大サイズ (超えた分は捨てる)
+        #     -> default: 5MB
+        if "url_max_bytes" not in templates["config"]:
+            templates["config"]["url_max_bytes"] = 5 * 1024 * 1024
+        #   html_parser: auto (lxmlがあればlxml) / lxml / html.parser
+        #     -> default: auto
+        if "html_parser" not in templates["config"]:
+            templates["config"]["html_parser"] = "auto"
+        #   html_workers: 大きいHTMLの変換に使うprocessの数 (0: 使わない)
+        #     -> default: 2
+        if "html_workers" not in templates["config"]:
+            templates["config"]["html_workers"] = 2
+        #   wikipedia_lang: <wikipedia>の言語 (タグで<wikipedia(en)>と上書きできる)
+        #     -> default: ja
+        if "wikipedia_lang" not in templates["config"]:
+            templates["config"]["wikipedia_lang"] = "ja"
+        #   wikipedia_endpoint: MediaWiki APIのURL ({lang}は言語に置換される)
+        #     -> default: https://{lang}.wikipedia.org/w/api.php
+        if "wikipedia_endpoint" not in templates["config"]:
+            templates["config"]["wikipedia_endpoint"] = "https://{lang}.wikipedia.org/w/api.php"
+        #   wikipedia_extract: full (記事全体) or intro (冒頭の要約だけ。まとめて取得できる)
+        #     -> default: full (タグで<wikipedia:intro>と上書きできる)
+        if "wikipedia_extract" not in templates["config"]:
+            templates["config"]["wikipedia_extract"] = "full"
+        #   wikipedia_chars: 記事本文の最大文字数
+        #     -> default: None (制限しない)
+        if "wikipedia_chars" not in templates["config"]:
+            templates["config"]["wikipedia_chars"] = None
+        #   wikipedia_concurrency: 同時に投げるリクエストの数
+        #     -> default: 4
+        if "wikipedia_concurrency" not in templates["config"]:
+            templates["config"]["wikipedia_concurrency"] = 4
+        #   context: <prompt>タグのcontext戦略 (タグのattrs `:full` / `:section` で上書きできる)
+        #     -> full: ファイル全体
+        #     -> section: @@processing@@を含む見出しのsectionと祖先の見出し
+        #     -> default: full
+        if "context" not in templates["config"]:
+            templates["config"]["context"] = "full"
+        #   context_neighbors: section戦略で、@@processing@@の前後に入れる段落の数 (null: section全体)
+        #     -> default: 2
+        if "context_neighbors" not in templates["config"]:
+            templates["config"]["context_neighbors"] = 2
+        #   context_max_tokens: section戦略のcontextの上限 (token数の概算)
+        #     -> default: 8000
+        if "context_max_tokens" not in templates["config"]:
+            templates["config"]["context_max_tokens"] = 8000
+        #   metrics_file: 処理の段階ごとの時間とカウンタをJSON linesで追記するファイル
+        #     -> 相対パスは、cache等と同じくbase_dirが基準
+        #     -> default: None (出力しない)
+        if "metrics_file" not in templates["config"]:
+            templates["config"]["metrics_file"] = None
+        if templates["config"]["metrics_file"]:
+            templates["config"]["metrics_file"] = ConfigBuilder.resolve_path(
+                templates["config"]["metrics_file"], base_dir)
+        #   metrics_port: localhostでPrometheus形式のmetricsを返すport (GET /metrics)
+        #     -> default: None (起動しない)
+        if "metrics_port" not in templates["config"]:
+            templates["config"]["metrics_port"] = None
 
         # selfpath:
         #   -> for hot reload yaml file.
@@ -0,0 +1,182 @@
+import re
+from bisect import bisect_right
+from collections import namedtuple
+
+# context戦略
+#   full: ファイル全体をcontextにする (従来の動作)
+#   section: @@processing@@を含む見出しのsectionと、その祖先の見出しだけをcontextにする
+CONTEXT_STRATEGIES = ("full", "section")
+
+Heading = namedtuple("Heading", ["start", "end", "level", "title"])
+
+HEADING_PATTERN = re.compile(r"^(#{1,6})[ \t]+(.*?)[ \t#]*$", re.MULTILINE)
+FENCE_PATTERN = re.compile(r"^[ \t]{0,3}(`{3,}|~{3,})", re.MULTILINE)
+PARAGRAPH_PATTERN = re.compile(r"\n[ \t]*\n")
+
+
+def estimate_tokens(text) -> int:
+    """
+    LLMのtoken数の概算 (tokenizerは使わない)
+      - ASCII: 4文字で1token
+      - それ以外(日本語など): 1文字で1token
+    """
+    ascii_count = len(text.encode("ascii", "ignore"))
+    return (ascii_count + 3) // 4 + (len(text) - ascii_count)
+
+
+def clip_around(text, position, max_tokens):
+    """
+    textをpositionを中心にmax_tokens程度に切り詰める
+    """
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(1, int(len(text) * max_tokens / tokens))
+    start = max(0, min(position - keep // 2, len(text) - keep))
+    return text[start:start + keep]
+
+
+class SectionIndex:
+    """
+    Markdownの見出しの木を一回だけ走査して、offsetから
+    それを含むsection / 祖先の見出し / 周辺の段落を引けるようにする。
+
+    - コードブロック(``` / ~~~)の中の`#`は見出しとして扱わない
+    - 見出しのないファイルは、ファイル全体が一つのsectionになる
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.headings = SectionIndex.parse_headings(text)
+        self._starts = [h.start for h in self.headings]
+
+    @classmethod
+    def fenced_ranges(cls, text):
+        """
+        return: [(start, end)] コードブロックの範囲
+        """
+        ranges = []
+        opened = None
+        for match in FENCE_PATTERN.finditer(text):
+            fence = match.group(1)
+            if opened is None:
+                opened = (match.start(), fence)
+            elif fence[0] == opened[1][0] and len(fence) >= len(opened[1]):
+                ranges.append((opened[0], match.end()))
+                opened = None
+        if opened is not None:
+            ranges.append((opened[0], len(text)))
+        return ranges
+
+    @classmethod
+    def parse_headings(cls, text):
+        ranges = SectionIndex.fenced_ranges(text)
+        range_starts = [r[0] for r in ranges]
+        headings = []
+        for match in HEADING_PATTERN.finditer(text):
+            i = bisect_right(range_starts, match.start()) - 1
+            if i >= 0 and match.start() < ranges[i][1]:
+                continue
+            headings.append(Heading(match.start(), match.end(), len(match.group(1)), match.group(2)))
+        return headings
+
+    def _heading_index(self, offset):
+        return bisect_right(self._starts, offset) - 1
+
+    def section(self, offset):
+        """
+        return: (heading or None, start, end)
+          -> offsetを含む一番内側のsection (次の見出しの直前まで)
+        """
+        i = self._heading_index(offset)
+        if i < 0:
+            end = self._starts[0] if self._starts else len(self.text)
+            return None, 0, end
+        end = self._starts[i + 1] if i + 1 < len(self._starts) else len(self.text)
+        return self.headings[i], self.headings[i].start, end
+
+    def ancestors(self, offset):
+        """
+        return: list[Heading] offsetを含むsectionの祖先の見出し (浅い順)
+        """
+        i = self._heading_index(offset)
+        if i < 0:
+            return []
+        result = []
+        level = self.headings[i].level
+        for j in range(i - 1, -1, -1):
+            if level == 1:
+                break
+            if self.headings[j].level < level:
+                level = self.headings[j].level
+                result.append(self.headings[j])
+        result.reverse()
+        return result
+
+    def paragraphs(self, start, end):
+        """
+        return: [(start, end)] text[start:end]を空行で区切った段落の範囲
+        """
+        spans = []
+        position = start
+        for match in PARAGRAPH_PATTERN.finditer(self.text, start, end):
+            if match.start() > position:
+                spans.append((position, match.start()))
+            position = match.end()
+        if end > position:
+            spans.append((position, end))
+        return spans
+
+    def window(self, offset, neighbors=2, max_tokens=None):
+        """
+        offsetの周辺だけを取り出す。
+
+          # 祖先の見出し
+          ## offsetを含むsectionの見出し
+          (offsetの段落と、前後neighbors個までの段落)
+
+        neighbors: Noneのときはsection全体
+        max_tokens: 近い段落から順に、estimate_tokensの合計がこれを超えない範囲で入れる
+        """
+        heading, start, end = self.section(offset)
+        lines = [self.text[h.start:h.end] for h in self.ancestors(offset)]
+        body_start = start
+        if heading is not None:
+            lines.append(self.text[heading.start:heading.end])
+            body_start = heading.end
+        header = "\n".join(lines)
+        spans = self.paragraphs(body_start, end)
+        if not spans:
+            return header
+        k = next((i for i, (s, e) in enumerate(spans) if offset < e), len(spans) - 1)
+        budget = None if max_tokens is None else max_tokens - estimate_tokens(header)
+        s, e = spans[k]
+        center = self.text[s:e]
+        if budget is not None:
+            center = clip_around(center, offset - s, max(1, budget))
+            budget -= estimate_tokens(center)
+        chosen = {k: center}
+        if neighbors is None:
+            neighbors = len(spans)
+        for distance in range(1, neighbors + 1):
+            for i in (k - distance, k + distance):
+                if i < 0 or i >= len(spans):
+                    continue
+                paragraph = self.text[spans[i][0]:spans[i][1]]
+                if budget is not None:
+                    cost = estimate_tokens(paragraph)
+                    if cost > budget:
+                        continue
+                    budget -= cost
+                chosen[i] = paragraph
+        # 省略した部分は"..."にする
+        parts = [header] if header else []
+        previous = -1
+        for i in sorted(chosen):
+            if i != previous + 1:
+                parts.append("...")
+            parts.append(chosen[i])
+            previous = i
+        if previous != len(spans) - 1:
+            parts.append("...")
+        return "\n\n".join(parts)
@@ -0,0 +1,145 @@
+import os
+import time
+import json
+import hashlib
+import sqlite3
+import threading
+import contextlib
+from tagwriting.utils import verbose_print
+
+
+class DiskCache:
+    """
+    SQLiteを使ったプロセス間で共有可能なキャッシュ。
+
+    - key -> value (str) を保存する
+    - ttl: 保存してから`ttl`秒を過ぎたものはstale扱い
+      -> staleなものも`meta`(ETag / Last-Modified)と一緒に返すので、
+         呼び出し側で再検証(If-None-Match / If-Modified-Since)ができる
+    - max_bytes: valueの合計サイズがこれを超えたら、最後にアクセスされた順(LRU)で削除する
+
+    Reason:
+      SQLiteはファイルロックを持っているので、複数のtagwritingプロセスが
+      同じキャッシュファイルを使っても壊れない。
+    """
+
+    def __init__(self, path, table="cache", ttl=86400, max_bytes=64 * 1024 * 1024):
+        self.path = os.path.abspath(path)
+        self.table = table
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " meta TEXT NOT NULL DEFAULT '{}',"
+                " size INTEGER NOT NULL,"
+                " stored_at REAL NOT NULL,"
+                " accessed_at REAL NOT NULL)")
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_accessed_at ON {self.table}(accessed_at)")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # 接続は操作ごとに開く: threadやprocessをまたいでconnectionを共有しない
+        # sqlite3.Connectionのwithはcommitするだけなので、終わったら閉じる (終了時に開いたまま残さない)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        """
+        return:
+          -> None: キャッシュなし
+          -> (value, meta, fresh): meta = {"etag": ..., "last_modified": ...}
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                f"SELECT value, meta, stored_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+        value, meta, stored_at = row
+        fresh = self.ttl is None or self.ttl <= 0 or now - stored_at < self.ttl
+        return value, json.loads(meta), fresh
+
+    def set(self, key, value, meta=None):
+        now = time.time()
+        meta = json.dumps(meta or {})
+        size = len(value.encode('utf-8'))
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, meta, size, stored_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)", (key, value, meta, size, now, now))
+            self._evict(conn)
+
+    def touch(self, key):
+        """
+        再検証(304 Not Modified)が成功したときに、保存時刻を更新してfreshに戻す
+        """
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"UPDATE {self.table} SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, key))
+
+    def delete(self, key):
+        with self._lock, self._connect() as conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def _evict(self, conn):
+        if not self.max_bytes:
+            return
+        total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {self.table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = conn.execute(f"SELECT key, size FROM {self.table} ORDER BY accessed_at ASC").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            verbose_print(f"[green][Process] Cache evict: {key}[/green]")
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            total -= size
+
+    @classmethod
+    def validators(cls, meta) -> dict:
+        """
+        metaから再検証用のHTTP headerを作る
+        """
+        headers = {}
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    @classmethod
+    def key_digest(cls, *parts) -> str:
+        """
+        複数の値から、内容で決まるキーを作る
+          -> key_digest(base_url, model, system_prompt, user_prompt)
+        """
+        return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_templates(cls, templates, name="fetch"):
+        """
+        config.{name}_cache, {name}_cache_path, {name}_cache_ttl, {name}_cache_max_bytesから作る
+          -> name: "fetch" or "response"
+        config.{name}_cacheがFalseのときはNoneを返す
+        """
+        config = templates["config"]
+        if not config.get(f"{name}_cache", False):
+            return None
+        return cls(
+            config[f"{name}_cache_path"],
+            table=name,
+            ttl=config[f"{name}_cache_ttl"],
+            max_bytes=config[f"{name}_cache_max_bytes"])
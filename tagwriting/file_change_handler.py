@@ -1,17 +1,98 @@
 import os
 import time
-import fnmatch
+import hashlib
+import threading
 from watchdog.events import FileSystemEventHandler
+from tagwriting.utils import verbose_print
+from tagwriting.metrics import metrics
+from tagwriting.path_matcher import PathMatcher, TextFileCache
+
+
+class ContentHashes:
+    """
+    tagwritingが最後に読み込んだ/書き込んだファイルの内容のhash。
+
+    Reason:
+      - 自分で書き込んだ(_save_text)ことによるイベントを処理しない
+      - 内容が変わっていない保存(エディタのauto save等)を処理しない
+    """
+
+    def __init__(self):
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def digest(cls, data: bytes) -> str:
+        return ContentHashes.digest_parts((data,))
+
+    @classmethod
+    def digest_parts(cls, parts) -> str:
+        """
+        partsをつなげた内容のhash (つなげたbytesを作らない)
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for part in parts:
+            h.update(part)
+        return h.hexdigest()
+
+    @classmethod
+    def file_digest(cls, path, chunk_size=1024 * 1024) -> str:
+        """
+        ファイルをchunkごとに読んでhashを求める (大きなファイルを一度にメモリに載せない)
+        """
+        with open(path, 'rb') as f:
+            return ContentHashes.digest_parts(iter(lambda: f.read(chunk_size), b""))
+
+    def record(self, path, data: bytes):
+        self.record_digest(path, ContentHashes.digest(data))
+
+    def record_digest(self, path, digest):
+        with self._lock:
+            self._hashes[os.path.abspath(path)] = digest
+
+    def get(self, path):
+        with self._lock:
+            return self._hashes.get(os.path.abspath(path))
+
+    def is_unchanged(self, path, data: bytes) -> bool:
+        with self._lock:
+            return self._hashes.get(os.path.abspath(path)) == ContentHashes.digest(data)
+
 
 class FileChangeHandler(FileSystemEventHandler):
-    def __init__(self, dirpath, on_change, templates, debounce_interval=0.5):
+    def __init__(self, dirpath, on_change, templates, debounce_interval=0.5, content_hashes=None,
+                 batch_window=0.0, gitignore=None):
+        """
+        batch_window: 0より大きいとき、その秒数の間に来たイベントをまとめてから処理する
+          -> ビルドツール等が同じファイルを何度も書き換えるときに、同じパスの処理を一回にする
+        gitignore: GitIgnore or None -> .gitignoreで除外されるファイルも無視する
+        """
         super().__init__()
         self.dirpath = os.path.abspath(dirpath)
         self.on_change = on_change
-        self._last_called = 0
+        # path -> 最後に処理した時刻
+        #   -> 別のファイルのイベントがdebounceで捨てられないように、ファイルごとに持つ
+        self._last_called = {}
         self._debounce_interval = debounce_interval
-        self._ignore = templates["ignore"]
-        self._target = templates["target"]
+        self.update_templates(templates)
+        self._text_files = TextFileCache()
+        self._gitignore = gitignore
+        self._batch_window = batch_window
+        # path -> None (順番を保ったset)
+        self._batch = {}
+        self._batch_timer = None
+        self._batch_lock = threading.Lock()
+        self._content_hashes = content_hashes if content_hashes is not None else ContentHashes()
+        # イベントの集計: どこで捨てられたか
+        self.stats = {"received": 0, "ignored": 0, "not_target": 0, "batched": 0, "binary": 0,
+                      "debounced": 0, "unchanged": 0, "dispatched": 0}
+
+    def update_templates(self, templates):
+        """
+        target / ignoreをコンパイルし直す (起動時 / hot reload)
+        """
+        self._ignore = PathMatcher.compile(tuple(templates["ignore"]))
+        self._target = PathMatcher.compile(tuple(templates["target"]))
         self._selfpath = templates["selfpath"]
 
     @classmethod
@@ -19,61 +100,97 @@ class FileChangeHandler(FileSystemEventHandler):
         """
         任意のファイルリスト(patterns)にpathがマッチするか判定
         - patterns: glob, ディレクトリ、絶対パス対応
+          -> ディレクトリ(".git", "build/")は、その下のファイルにもマッチする
         - patternsが空の場合はFalse（is_target/is_ignored側で適宜True/False返す）
         """
-        path = os.path.abspath(path)
-        for pattern in patterns:
-            if pattern.endswith(os.sep) or pattern.endswith('/') or pattern.endswith('\\'):
-                dir_pattern = os.path.abspath(pattern.rstrip('/\\'))
-                if os.path.commonpath([path, dir_pattern]) == dir_pattern:
-                    return True
-            elif any(char in pattern for char in '*?[]'):
-                if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(os.path.basename(path), pattern):
-                    return True
-            else:
-                file_pattern = os.path.abspath(pattern)
-                if path == file_pattern:
-                    return True
-        return False
+        return PathMatcher.compile(tuple(patterns)).match(path)
 
-    def _is_debounce(self):
+    def _is_debounce(self, path):
         now = time.time()
-        if now - self._last_called > self._debounce_interval:
-            self._last_called = now
+        if now - self._last_called.get(path, 0) > self._debounce_interval:
+            self._last_called[path] = now
             return True
+        return False
 
-    def is_ignored(self, path):
-        return self.match_patterns(path, self._ignore)
+    def _is_changed(self, path):
+        """
+        前回読み込んだ/書き込んだときから内容が変わっているか
+        """
+        try:
+            digest = ContentHashes.file_digest(path)
+        except OSError:
+            return False
+        if self._content_hashes.get(path) == digest:
+            return False
+        self._content_hashes.record_digest(path, digest)
+        return True
+
+    def is_ignored(self, path, is_dir=False):
+        """
+        is_dir: ディレクトリのときはTrue (.gitignoreの"node_modules/"のようなディレクトリだけのruleに使う)
+        """
+        if self._ignore.match(path):
+            return True
+        return self._gitignore is not None and self._gitignore.ignored(path, is_dir)
 
     def is_target(self, path):
         if not self._target:
             return True
-        return self.match_patterns(path, self._target)
+        return self._target.match(path)
 
     def is_text_file(self, path, blocksize=512):
-        try:
-            with open(path, 'rb') as f:
-                chunk = f.read(blocksize)
-            # NULLバイトが含まれていればバイナリファイルとみなす
-            if b'\0' in chunk:
-                return False
-            # ASCII範囲外のバイトが多すぎる場合もバイナリとみなす
-            text_characters = bytearray({7,8,9,10,12,13,27} | set(range(0x20, 0x100)))
-            nontext = chunk.translate(None, text_characters)
-            return float(len(nontext)) / len(chunk) < 0.30 if chunk else False
-        except Exception:
-            return False
+        # (inode, mtime, size)が変わっていなければ、前回の結果を使う
+        return self._text_files.is_text_file(path, blocksize)
+
+    def _count(self, reason):
+        self.stats[reason] += 1
+        metrics.incr("events", reason=reason)
 
     def on_modified(self, event):
         # 流石に全部のmodifiedを出力するのは冗長なのでコメントアウト
         # print(f"[white][event]File modified: {event.src_path}[/white]")
+        self._count("received")
         if self.is_ignored(event.src_path):
+            self._count("ignored")
             return
         # event.src_pathがtemplatesファイルでなく、かつ対象ファイルでない
         if not self.is_target(event.src_path) and event.src_path != self._selfpath:
+            self._count("not_target")
+            return
+        if self._batch_window > 0:
+            with self._batch_lock:
+                if event.src_path in self._batch:
+                    self._count("batched")
+                    return
+                self._batch[event.src_path] = None
+                if self._batch_timer is None:
+                    self._batch_timer = threading.Timer(self._batch_window, self.flush)
+                    self._batch_timer.daemon = True
+                    self._batch_timer.start()
+            return
+        self._handle(event.src_path)
+
+    def flush(self):
+        """
+        batch_windowの間に溜まったイベントを処理する
+        """
+        with self._batch_lock:
+            paths = list(self._batch)
+            self._batch = {}
+            self._batch_timer = None
+        for path in paths:
+            self._handle(path)
+
+    def _handle(self, path):
+        if not self.is_text_file(path):
+            self._count("binary")
             return
-        if not self.is_text_file(event.src_path):
+        if not self._is_debounce(path):
+            self._count("debounced")
             return
-        if not self._is_debounce():
+        if not self._is_changed(path):
+            self._count("unchanged")
+            verbose_print(f"[white][Info] Unchanged: {path}[/white]")
             return
-        self.on_change(event.src_path)
+        self._count("dispatched")
+        self.on_change(path)
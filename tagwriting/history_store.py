@@ -0,0 +1,245 @@
+import os
+import time
+import queue
+import atexit
+import sqlite3
+import hashlib
+import datetime
+import threading
+import contextlib
+from rich import print
+from tagwriting.utils import verbose_print
+from tagwriting.metrics import metrics
+
+# history tableの列 (insert / selectの順)
+HISTORY_COLUMNS = ("timestamp", "file", "prompt", "prompt_hash", "response", "llm", "model")
+
+
+class HistoryStore:
+    """
+    LLMとのやりとり履歴をSQLiteに保存する (history.backend: sqlite)。
+
+    - append()はqueueに入れるだけ -> LLMの処理の後にファイルを開いて書き込むのを待たない
+    - background threadが、batch_size件 or flush_interval秒ごとに一つのtransactionで書き込む
+    - index: (file, timestamp), prompt_hash, (model, timestamp), timestamp
+    - max_bytesを超えたらrotateする: path -> path.1 -> path.2 ... (keep個まで残す)
+    - query()は、rotateしたファイルも新しい順に検索する
+    """
+    _stores = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, keep=3, batch_size=100, flush_interval=1.0):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # sqlite3.Connectionのwithはcommitするだけなので、closingで閉じる
+        with contextlib.closing(HistoryStore.connect(self.path)) as conn, conn:
+            HistoryStore.create_schema(conn)
+
+    @classmethod
+    def connect(cls, path):
+        return sqlite3.connect(path, timeout=30)
+
+    @classmethod
+    def create_schema(cls, conn):
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " timestamp REAL NOT NULL,"
+            " file TEXT NOT NULL,"
+            " prompt TEXT NOT NULL,"
+            " prompt_hash TEXT NOT NULL,"
+            " response TEXT NOT NULL,"
+            " llm TEXT,"
+            " model TEXT)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_file ON history(file, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_prompt_hash ON history(prompt_hash)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_model ON history(model, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS history_timestamp ON history(timestamp)")
+
+    @classmethod
+    def prompt_hash(cls, prompt) -> str:
+        return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def from_templates(cls, templates):
+        """
+        history.pathごとに一つのstoreを使い回す
+        """
+        conf = templates["history"]
+        path = os.path.abspath(conf["path"])
+        with cls._lock:
+            store = cls._stores.get(path)
+            if store is None:
+                store = cls(path, conf["max_bytes"], conf["keep"], conf["batch_size"], conf["flush_interval"])
+                cls._stores[path] = store
+            return store
+
+    @classmethod
+    def flush_all(cls):
+        with cls._lock:
+            stores = list(cls._stores.values())
+        for store in stores:
+            store.flush()
+
+    @classmethod
+    def close_all(cls):
+        with cls._lock:
+            stores = list(cls._stores.values())
+            cls._stores.clear()
+        for store in stores:
+            store.close()
+
+    def append(self, file, prompt, response, llm=None, model=None, timestamp=None):
+        self._ensure_writer()
+        self._queue.put((
+            timestamp if timestamp is not None else time.time(), os.path.abspath(file),
+            prompt, HistoryStore.prompt_hash(prompt), response, llm, model))
+
+    def flush(self):
+        """
+        queueに入っている履歴を書き終わるまで待つ
+        """
+        self._queue.join()
+
+    def close(self):
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_writer(self):
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = HistoryStore.connect(self.path)
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    self._queue.task_done()
+                    return
+                batch = [item]
+                stop = False
+                # 最初の一件からflush_interval秒の間に来たものをまとめる
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                try:
+                    conn = self._write_batch(conn, batch)
+                except Exception as e:
+                    # threadが止まるとflush()が返らなくなるので、捨てて続ける
+                    print(f"[red][Error] History write failed: {e}[/red]")
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self._queue.task_done()
+                if stop:
+                    return
+        finally:
+            conn.close()
+
+    @metrics.timed("history_write")
+    def _write_batch(self, conn, batch):
+        """
+        return: 書き込み後のconnection (rotateしたときは新しいファイルのもの)
+        """
+        with conn:
+            conn.executemany(
+                f"INSERT INTO history ({', '.join(HISTORY_COLUMNS)}) VALUES ({', '.join('?' * len(HISTORY_COLUMNS))})",
+                batch)
+        metrics.incr("history_entries", len(batch))
+        verbose_print(f"[green][Process] History: {len(batch)} entries -> {self.path}[/green]")
+        if self.max_bytes and self.size() >= self.max_bytes:
+            conn = self._rotate(conn)
+        return conn
+
+    def size(self):
+        # WALに書いた分は、checkpointするまでDBファイルに反映されない
+        return sum(os.path.getsize(path) for path in (self.path, self.path + "-wal") if os.path.exists(path))
+
+    def _rotate(self, conn):
+        # WALの内容をDBに書き出してから、ファイルをずらす
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.close()
+        for index in range(self.keep, 0, -1):
+            source = self.path if index == 1 else f"{self.path}.{index - 1}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index}")
+        if self.keep <= 0:
+            os.remove(self.path)
+        for suffix in ("-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+        verbose_print(f"[green][Process] History rotated: {self.path}[/green]")
+        conn = HistoryStore.connect(self.path)
+        HistoryStore.create_schema(conn)
+        return conn
+
+    def files(self):
+        """
+        return: 新しい順のDBファイル (rotateしたものを含む)
+        """
+        paths = [self.path] + [f"{self.path}.{index}" for index in range(1, self.keep + 1)]
+        return [path for path in paths if os.path.exists(path)]
+
+    def query(self, file=None, prompt=None, model=None, search=None, since=None, until=None, limit=20):
+        """
+        file: 絶対パスに直して一致するもの
+        prompt: promptが一致するもの (prompt_hashのindexで引く)
+        search: prompt / responseに含まれる文字列
+        since / until: datetime or UNIX time
+        return: list[dict] 新しい順
+        """
+        where, params = [], []
+        if file is not None:
+            where.append("file = ?")
+            params.append(os.path.abspath(file))
+        if prompt is not None:
+            where.append("prompt_hash = ?")
+            params.append(HistoryStore.prompt_hash(prompt))
+        if model is not None:
+            where.append("model = ?")
+            params.append(model)
+        if search:
+            where.append("(instr(prompt, ?) > 0 OR instr(response, ?) > 0)")
+            params.extend([search, search])
+        for column, op, value in (("timestamp", ">=", since), ("timestamp", "<", until)):
+            if value is None:
+                continue
+            if isinstance(value, datetime.datetime):
+                value = value.timestamp()
+            where.append(f"{column} {op} ?")
+            params.append(value)
+        sql = f"SELECT {', '.join(HISTORY_COLUMNS)} FROM history"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        rows = []
+        for path in self.files():
+            if limit is not None and len(rows) >= limit:
+                break
+            remaining = -1 if limit is None else limit - len(rows)
+            with contextlib.closing(HistoryStore.connect(path)) as conn:
+                rows.extend(dict(zip(HISTORY_COLUMNS, row)) for row in conn.execute(sql, params + [remaining]))
+        return rows
+
+
+# processの終了時に、queueに残っている履歴を書き込む
+atexit.register(HistoryStore.close_all)
@@ -1,33 +1,244 @@
-import requests
-from bs4 import BeautifulSoup
-from markdownify import markdownify
+import re
+import html
+import atexit
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from rich import print
 from tagwriting.utils import verbose_print  # verbose_printを利用するためimport
 
+TITLE_PATTERN = re.compile(rb'<title[^>]*>(.*?)</title\s*>', re.IGNORECASE | re.DOTALL)
+HEAD_END_PATTERN = re.compile(rb'</head\s*>|<body[\s>]', re.IGNORECASE)
+META_CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+
+def _convert(args):
+    # ProcessPoolExecutorから呼ぶ (pickleできるようにmodule levelに置く)
+    return HTMLClient.html_to_text(*args)
+
+
 class HTMLClient:
+    # url -> title or None (リクエストをまたいで保持する)
+    _titles = OrderedDict()
+    _titles_lock = threading.Lock()
+    TITLE_CACHE_SIZE = 1024
+
+    # これより小さいHTMLは、process poolに送らずにその場で変換する
+    PROCESS_POOL_THRESHOLD = 256 * 1024
+    _pool = None
+    _pool_lock = threading.Lock()
+
+    @classmethod
+    def read_head(cls, url, max_bytes=32 * 1024, timeout=10):
+        """
+        <head>の終わり(または<body>の始まり)か、max_bytesまでだけを読み込む。
+          -> return: (bytes, charset or None)
+        """
+        import requests
+        with requests.get(url, timeout=timeout, stream=True, headers={'User-Agent': 'Mozilla/5.0'}) as response:
+            if response.status_code != 200:
+                return b"", None
+            charset = response.encoding if "charset" in response.headers.get("Content-Type", "") else None
+            data = b""
+            for chunk in response.iter_content(chunk_size=4096):
+                data += chunk
+                if len(data) >= max_bytes or HEAD_END_PATTERN.search(data):
+                    break
+        return data[:max_bytes], charset
+
+    @classmethod
+    def parse_title(cls, data, charset=None):
+        """
+        bytesから<title>を取り出す
+          - charset: HTTP header > <meta charset> > utf-8
+        """
+        match = TITLE_PATTERN.search(data)
+        if not match:
+            return None
+        if charset is None:
+            meta = META_CHARSET_PATTERN.search(data)
+            charset = meta.group(1).decode("ascii") if meta else "utf-8"
+        try:
+            title = match.group(1).decode(charset, errors="replace")
+        except LookupError:
+            title = match.group(1).decode("utf-8", errors="replace")
+        title = " ".join(html.unescape(title).split())
+        return title or None
+
+    @classmethod
+    def get_title(cls, url, timeout=10):
+        """
+        ページの<title>を返す (ページ全体はダウンロードしない)
+          -> 取得できなかった場合はNone
+        """
+        data, charset = HTMLClient.read_head(url, timeout=timeout)
+        return HTMLClient.parse_title(data, charset)
+
+    @classmethod
+    def get_titles(cls, urls, deadline=5.0, concurrency=8):
+        """
+        urlsの<title>を並列に取得する。
+          - 取得済みのtitleはキャッシュから返す
+          - deadline秒を過ぎても取得できなかったものは、titleの代わりにurlを使う
+
+        return: dict[url, title]
+        """
+        titles = {}
+        missing = []
+        with cls._titles_lock:
+            for url in urls:
+                if url in cls._titles:
+                    titles[url] = cls._titles[url] or url
+                elif url not in missing:
+                    missing.append(url)
+        if not missing:
+            return titles
+
+        def fetch(url):
+            try:
+                title = HTMLClient.get_title(url, timeout=deadline)
+            except Exception as e:
+                verbose_print(f"[yellow][Warning] Failed to get title: {url}: {e}[/yellow]")
+                return
+            with cls._titles_lock:
+                cls._titles[url] = title
+                while len(cls._titles) > cls.TITLE_CACHE_SIZE:
+                    cls._titles.popitem(last=False)
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(missing))))
+        futures = [executor.submit(fetch, url) for url in missing]
+        wait(futures, timeout=deadline)
+        # deadlineを過ぎたものは待たない
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        with cls._titles_lock:
+            for url in missing:
+                titles[url] = cls._titles.get(url) or url
+        return titles
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def parser(cls, name="auto"):
+        """
+        BeautifulSoupのparser
+          - auto: lxmlがinstallされていればlxml、なければhtml.parser
+        """
+        if name in ("auto", "lxml"):
+            try:
+                import lxml  # noqa: F401
+                return "lxml"
+            except ImportError:
+                if name == "lxml":
+                    print("[yellow][Warning] lxml is not installed. Use html.parser.[/yellow]")
+        return "html.parser"
+
+    @classmethod
+    def fetch(cls, url, headers=None, max_bytes=5 * 1024 * 1024, timeout=10):
+        """
+        max_bytesまでだけを読み込む (streaming)
+          -> return: (response, text or None)
+          -> 200以外のときはtext = None
+
+        charset: HTTP header > <meta charset> > utf-8 > 先頭64KBからの推定
+        """
+        import requests
+        with requests.get(url, headers=headers, timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                return response, None
+            data = b""
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                data += chunk
+                if len(data) >= max_bytes:
+                    print(f"[yellow][Warning] URL body exceeds {max_bytes} bytes. Truncated: {url}[/yellow]")
+                    data = data[:max_bytes]
+                    break
+            charset = response.encoding if "charset" in response.headers.get("Content-Type", "") else None
+        return response, HTMLClient.decode(data, charset)
+
+    @classmethod
+    def decode(cls, data, charset=None):
+        if charset is None:
+            meta = META_CHARSET_PATTERN.search(data[:4096])
+            charset = meta.group(1).decode("ascii") if meta else None
+        if charset is not None:
+            try:
+                return data.decode(charset, errors="replace")
+            except LookupError:
+                pass
+        try:
+            return data.decode("utf-8")
+        except UnicodeDecodeError as e:
+            # max_bytesで途中の文字が切れただけなら、utf-8のまま
+            if e.start >= len(data) - 3:
+                return data.decode("utf-8", errors="ignore")
+            import requests
+            detected = requests.compat.chardet.detect(data[:64 * 1024]).get("encoding") or "utf-8"
+            return data.decode(detected, errors="replace")
+
     @classmethod
-    def get_title(cls, url):
-        response = requests.get(url, timeout=10)
-        # [TODO] なんか中国語だとバグったのであとで調べる
-        soup = BeautifulSoup(response.text, 'html.parser')
-        return soup.title.string
+    def html_to_text_async(cls, html_text, url_strip, simple_text, parser="auto", workers=2):
+        """
+        html_to_textを、大きいHTMLはprocess poolで実行する (watcherのthreadでCPUを使わない)
+          - workers: 0のときはprocess poolを使わない
+        """
+        args = (html_text, url_strip, simple_text, parser)
+        if workers <= 0 or len(html_text) < cls.PROCESS_POOL_THRESHOLD:
+            return _convert(args)
+        with cls._pool_lock:
+            if cls._pool is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # worker threadから作るので、forkしない (multithreadのprocessのforkはdeadlockしうる)
+                cls._pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            pool = cls._pool
+        try:
+            return pool.submit(_convert, args).result()
+        except Exception as e:
+            # process poolが使えない環境 (daemon process等) では、その場で変換する
+            verbose_print(f"[yellow][Warning] HTML process pool failed: {e}[/yellow]")
+            return _convert(args)
 
     @classmethod
-    def html_to_text(cls, html_text, url_strip, simple_text) -> (str, str):
+    def shutdown_pool(cls):
+        """
+        html_to_text_asyncのprocess poolを止める (次に使うときは作り直す)
+        """
+        with cls._pool_lock:
+            pool, cls._pool = cls._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    @classmethod
+    def html_to_text(cls, html_text, url_strip, simple_text, parser="auto") -> (str, str):
         """
         Args:
             html_text (str): HTML text
+            parser (str): auto / lxml / html.parser
         Returns:
             -> (str, str): (HTML inner text, title)
         """
-        soup = BeautifulSoup(html_text, 'html.parser')
+        # bs4 / markdownifyは重いので、<url>を変換するときに初めて読み込む
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(html_text, HTMLClient.parser(parser))
+        # NavigableStringはparse treeへの参照を持つ (process poolから返すとpickleできない) ので、strにする
+        title = str(soup.title.string) if soup.title and soup.title.string is not None else None
         target = soup.find('main')
         if simple_text:
             if target:
-                return target.get_text(strip=url_strip), soup.title.string
+                return target.get_text(strip=url_strip), title
             else:
-                return soup.get_text(strip=url_strip), soup.title.string
+                return soup.get_text(strip=url_strip), title
         else:
-            markdown = markdownify(html_text)
+            # 作ったsoupをそのまま使う (markdownify()はもう一度parseする)
+            from markdownify import MarkdownConverter
+            markdown = MarkdownConverter().convert_soup(soup)
             verbose_print(f"[green][Process] HTML to markdown:[/green]")
             verbose_print(f"[white][Info] Markdown: {markdown}[/white]")
-            return markdown, soup.title.string
+            return markdown, title
+
+
+# processの終了時に、process poolを止める
+atexit.register(HTMLClient.shutdown_pool)
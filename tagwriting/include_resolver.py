@@ -0,0 +1,90 @@
+import os
+import threading
+from collections import OrderedDict
+from rich import print
+from tagwriting.tag_scanner import TagScanner
+from tagwriting.utils import verbose_print
+
+
+class IncludeResolver:
+    """
+    <include>filepath.md</include> を展開する。
+
+    - include先のファイルに<include>があれば、再帰的に展開する
+      -> パスはinclude先のファイルからの相対パス
+    - 循環(a.md -> b.md -> a.md)は検出して、そのタグは展開しない
+    - ファイルの内容は(path, mtime, size)をkeyにしてキャッシュする
+    - 一つのrequestの中で同じファイルが何度も参照された場合、展開するのは最初の一回だけ
+      -> seen: requestごとのset (contextとpromptで共有する)
+    - ファイルが見つからない場合は、そのタグだけをそのまま残す
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        # abs_path -> (mtime_ns, size, text)
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, path):
+        """
+        return: ファイルの内容 (mtime / sizeが変わっていなければキャッシュから)
+        """
+        st = os.stat(path)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                self._files.move_to_end(path)
+                return cached[2]
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        with self._lock:
+            self._files[path] = (st.st_mtime_ns, st.st_size, text)
+            self._files.move_to_end(path)
+            while len(self._files) > self.max_entries:
+                self._files.popitem(last=False)
+        return text
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+    def resolve(self, filepath, text, seen=None, stack=None):
+        """
+        filepath: textが書かれているファイル (相対パスの基準)
+        seen: このrequestで既に展開したファイルのset
+        stack: 展開中のファイル (循環検出用)
+        """
+        if "<include" not in text:
+            return text
+        if seen is None:
+            seen = set()
+        if stack is None:
+            # 編集中のファイル自身は、一回だけなら展開できる
+            stack = ()
+        base_dir = os.path.dirname(filepath)
+
+        def replacer(token):
+            rel_path = TagScanner.inner_text(text, token).strip()
+            abs_path = os.path.abspath(os.path.join(base_dir, rel_path))
+            if abs_path in stack:
+                print(f"[yellow][Warning] Include cycle detected: {' -> '.join(stack + (abs_path,))}[/yellow]")
+                return TagScanner.tag_text(text, token)
+            if abs_path in seen:
+                verbose_print(f"[white][Info] include: {rel_path} (already included)[/white]")
+                return ""
+            try:
+                content = self.read(abs_path)
+            except (OSError, ValueError) as e:
+                # ValueError: binary / UTF-8でないファイル (UnicodeDecodeError)
+                print(f"[yellow][Warning] include error: {rel_path}: {e}[/yellow]")
+                return TagScanner.tag_text(text, token)
+            seen.add(abs_path)
+            content = self.resolve(abs_path, content, seen, stack + (abs_path,))
+            verbose_print(f"[white][Info] include: {rel_path} ({len(content.encode('utf-8'))} bytes)[/white]")
+            return content
+
+        return TagScanner.compile(("include",)).sub(text, "include", replacer)
+
+
+# process全体で一つ
+include_resolver = IncludeResolver()
@@ -0,0 +1,122 @@
+import os
+import mmap
+from tagwriting.file_change_handler import ContentHashes
+from tagwriting.utils import verbose_print
+
+# 改行コード("\r\n" or "\n")を調べる範囲
+NEWLINE_PROBE_BYTES = 64 * 1024
+
+
+def decode_text(data, errors="strict"):
+    # text modeで読み込んだときと同じく、改行を"\n"にそろえる
+    return data.decode('utf-8', errors).replace('\r\n', '\n').replace('\r', '\n')
+
+
+class LargeFile:
+    """
+    大きなファイル(config.large_file_threshold以上)を、全体をdecodeせずに扱う。
+
+    - mmapしたファイルをbinaryのTagScannerで走査して、タグの位置(byte offset)だけを持つ
+    - decodeするのは、タグの中身とcontextにする周辺だけ
+    - 書き込みはregion splice: [start, end)を置き換え、長さが変わるときはそれより後ろだけを書き直す
+      -> 末尾に追記していくjournalでは、書き直すのはファイルの最後の方だけになる
+    """
+
+    def __init__(self, path, content_hashes=None):
+        self.path = path
+        self.content_hashes = content_hashes
+        self.size = 0
+        self.newline = "\n"
+
+    def _open(self):
+        f = open(self.path, 'rb')
+        try:
+            return f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+
+    def scan(self, scanner):
+        """
+        scanner: TagScanner (binary=True)
+        return: list[TagToken] (位置はbyte offset)
+        """
+        self.size = os.path.getsize(self.path)
+        if self.size == 0:
+            return []
+        f, mm = self._open()
+        with f, mm:
+            self.size = len(mm)
+            # 書き戻すテキストの改行は、ファイルの改行にそろえる
+            self.newline = "\r\n" if mm.find(b"\r\n", 0, NEWLINE_PROBE_BYTES) >= 0 else "\n"
+            return scanner.scan(mm)
+
+    def read(self, start, end, errors="strict"):
+        """
+        return: [start, end)をdecodeしたテキスト (改行は"\\n"にそろえる)
+        """
+        f, mm = self._open()
+        with f, mm:
+            data = mm[max(0, start):min(end, len(mm))]
+        return decode_text(data, errors)
+
+    def window(self, start, end, radius):
+        """
+        [start, end)の前後radius byteずつを、行の境界で切ったテキスト
+        return: (before, after)
+        """
+        f, mm = self._open()
+        with f, mm:
+            begin = max(0, start - radius)
+            if begin > 0:
+                newline = mm.find(b"\n", begin, start)
+                begin = newline + 1 if newline >= 0 else begin
+            finish = min(len(mm), end + radius)
+            if finish < len(mm):
+                newline = mm.rfind(b"\n", end, finish)
+                finish = newline + 1 if newline >= 0 else finish
+            before, after = mm[begin:start], mm[end:finish]
+        # 行の境界で切れなかったときに、文字の途中で切れた分は捨てる
+        return decode_text(before, 'ignore'), decode_text(after, 'ignore')
+
+    def find(self, needle, hint=0):
+        """
+        needle(str)の位置をhintの近くから探す
+        return: byte offset or -1
+        """
+        data = needle.encode('utf-8')
+        f, mm = self._open()
+        with f, mm:
+            # 待っている間に前が編集されていることがあるので、少し前から探す
+            position = mm.find(data, max(0, hint - NEWLINE_PROBE_BYTES))
+            if position < 0:
+                position = mm.find(data)
+            return position
+
+    def encode(self, text):
+        return text.replace("\n", self.newline).encode('utf-8')
+
+    def splice(self, start, end, text):
+        """
+        ファイルの[start, end)をtextで置き換える
+        """
+        replacement = self.encode(text)
+        f, mm = self._open()
+        with f, mm:
+            # 書き込みによるイベントが先に届くことがあるので、書き込む前に記録する
+            if self.content_hashes is not None:
+                with memoryview(mm) as view:
+                    digest = ContentHashes.digest_parts((view[:start], replacement, view[end:]))
+                self.content_hashes.record_digest(self.path, digest)
+            # 長さが同じなら置き換える範囲だけ、違うなら後ろも読んでおいて書き直す
+            tail = b"" if len(replacement) == end - start else mm[end:]
+        with open(self.path, 'r+b') as f:
+            f.seek(start)
+            f.write(replacement)
+            if len(replacement) != end - start:
+                f.write(tail)
+                f.truncate()
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(replacement) - (end - start)
+        verbose_print(f"[green][Process] Region splice: {len(replacement) + len(tail)} bytes from offset {start}[/green]")
@@ -1,22 +1,32 @@
 import os
-import requests
+import json
+import queue
+import threading
 from rich import print
 from pathlib import Path
-from dotenv import load_dotenv
 from tagwriting.html_client import HTMLClient
 from tagwriting.utils import verbose_print
+from tagwriting.metrics import metrics
 
 class LLMSimpleClient:
-    def __init__(self, llm_name = None) -> None:
-        if llm_name:
-            env_filepath = Path.cwd() / f".env.{llm_name}"
-        else:
-            env_filepath = Path.cwd() / ".env"
-        load_dotenv(dotenv_path=env_filepath, override=True)
-        self.api_key = os.getenv("TAGWRITING_API_KEY") or os.getenv("API_KEY")
-        self.base_url = os.getenv("TAGWRITING_BASE_URL") or os.getenv("BASE_URL")
-        self.model = os.getenv("TAGWRITING_MODEL") or os.getenv("MODEL")
+    def __init__(self, llm_name = None, session=None) -> None:
+        from dotenv import dotenv_values
+        env_filepath = LLMSimpleClient.env_filepath(llm_name)
+        # load_dotenvはos.environを書き換えてしまうので、dotenv_valuesで読む
+        # -> .envの値を優先し、無ければ環境変数を使う
+        env = {**os.environ, **{k: v for k, v in dotenv_values(env_filepath).items() if v is not None}}
+        self.api_key = env.get("TAGWRITING_API_KEY") or env.get("API_KEY")
+        self.base_url = env.get("TAGWRITING_BASE_URL") or env.get("BASE_URL")
+        self.model = env.get("TAGWRITING_MODEL") or env.get("MODEL")
         self.filepath = env_filepath
+        # session: requests.Session (keep-alive). Noneのときは毎回requests.postする
+        self.session = session
+
+    @classmethod
+    def env_filepath(cls, llm_name=None):
+        if llm_name:
+            return Path.cwd() / f".env.{llm_name}"
+        return Path.cwd() / ".env"
 
     def build_headers(self) -> dict:
         return {
@@ -36,34 +46,275 @@ class LLMSimpleClient:
 
     def build_url(self, endpoint) -> str:
         # merge base url and endpoint
-        if not self.base_url.endswith('/'):
-            self.base_url += '/'
-        return self.base_url + endpoint
+        # base_urlは書き換えない (response cacheのkeyに使う)
+        return self.base_url.rstrip('/') + '/' + endpoint.lstrip('/')
     
-    def ask_ai(self, system_prompt, user_prompt):
+    def ask_ai(self, system_prompt, user_prompt, stream=False, on_delta=None, cancel=None):
+        """
+        stream: Trueのとき、OpenAI互換のSSE(`stream: true`)でレスポンスを受け取る
+        on_delta: streamのとき、受け取った途中までのテキストを渡すcallback
+          -> on_delta(partial_text)
+        cancel: threading.Event or None -> setされたら接続を閉じてNoneを返す (HedgedClient用)
+        """
         if not self.api_key:
             raise RuntimeError(f"API_KEY not found in {self.filepath}. ")
+        # requestsは最初のリクエストのときに読み込む (起動を速くする)
+        import requests
+        completion = None
         try:
             print(f"[green][Process] Post request to {self.build_url('/chat/completions')}[/green]")
             payload = self.build_payload(system_prompt, user_prompt)
+            if stream:
+                payload["stream"] = True
             verbose_print(f"[white][Info] Request: {payload}[/white]")
-            completion = requests.post(
-                self.build_url("chat/completions"), headers=self.build_headers(), json=payload)
-            data = completion.json()
-            verbose_print(f"[green][Process] Response: {data}[/green]")
-            # response['choices'][0]['message']['citations']
-            response =  data["choices"][0]["message"]["content"]
-            
+            metrics.incr("llm_requests")
+            metrics.incr("llm_bytes_sent", len(json.dumps(payload).encode('utf-8')))
+            http = self.session or requests
+            completion = http.post(
+                self.build_url("chat/completions"), headers=self.build_headers(), json=payload, stream=stream)
+            metrics.incr("http_responses", target="llm", status=str(completion.status_code))
+            if cancel is not None and cancel.is_set():
+                completion.close()
+                return None
+            if stream:
+                response, citations = self.read_stream(completion, on_delta, cancel)
+                if response is None:
+                    return None
+            else:
+                if completion.status_code != 200:
+                    print(f"[red][bold][Error][/bold] status_code={completion.status_code}[/red]")
+                    print(completion.text)
+                    return None
+                data = completion.json()
+                verbose_print(f"[green][Process] Response: {data}[/green]")
+                # response['choices'][0]['message']['citations']
+                response =  data["choices"][0]["message"]["content"]
+                citations = data.get("citations")
+
             # maybe Perplexity AI only
-            if  "citations" in data:
+            if citations:
                 response += "\n\n"
                 response += "Sources: \n\n"
-                citations = data["citations"]
+                titles = HTMLClient.get_titles(citations)
                 for i, citation in enumerate(citations, 1):
-                    title = HTMLClient.get_title(citation)
-                    response += f"{i}. [{title}]({citation})\n"
+                    response += f"{i}. [{titles[citation]}]({citation})\n"
             return response
         except requests.exceptions.JSONDecodeError as e:
             print(f"[red][bold][Error][/bold] JSONDecodeError:[/red]")
             print(completion)
             return None
+        except json.JSONDecodeError as e:
+            print(f"[red][bold][Error][/bold] Stream JSONDecodeError: {e}[/red]")
+            return None
+
+    @classmethod
+    def read_stream(cls, completion, on_delta=None, cancel=None):
+        """
+        SSEを読み込む:
+          data: {"choices": [{"delta": {"content": "Hel"}}]}
+          data: {"choices": [{"delta": {"content": "lo"}}]}
+          data: [DONE]
+
+        cancel: setされたら、次の行で接続を閉じる
+        return: (content, citations)
+        """
+        if completion.status_code != 200:
+            print(f"[red][bold][Error][/bold] Stream status_code={completion.status_code}[/red]")
+            print(completion.text)
+            return None, None
+        content = ""
+        citations = None
+        # SSEはUTF-8: Content-Typeにcharsetがないと、decode_unicodeはISO-8859-1で読んでしまう
+        for raw in completion.iter_lines():
+            if cancel is not None and cancel.is_set():
+                completion.close()
+                return None, None
+            line = raw.decode('utf-8')
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if chunk.get("citations"):
+                citations = chunk["citations"]
+            choices = chunk.get("choices") or []
+            if not choices:
+                continue
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                content += delta
+                if on_delta is not None:
+                    on_delta(content)
+        completion.close()
+        verbose_print(f"[green][Process] Stream Response: {content}[/green]")
+        return content, citations
+
+
+class HedgedClient:
+    """
+    同じ問い合わせを複数のbackend(.env / .env.{llm_name})に投げて、最初に返ってきた回答を使う。
+
+    - 最初はclients[0] (primary)にだけ投げる
+    - hedge_delay秒以内に返ってこなければ、次のbackendにも投げる (失敗したときはすぐに投げる)
+    - 最初に返ってきた回答を使い、残りはcancelする
+      -> まだ投げていないbackendには投げない / 返ってきたレスポンスは読まずに閉じる
+    - streamの途中経過は、最初にchunkを返したbackendのものだけをon_deltaに渡す
+
+    LLMSimpleClientと同じく、base_url / model / ask_aiを持つ
+    modelはgroup全体("a|b")なので、実際に回答したbackendはwinner / winner_modelで見る
+    """
+
+    def __init__(self, clients, hedge_delay=2.0):
+        self.clients = list(clients)
+        self.hedge_delay = hedge_delay
+        # 最後のask_aiで回答を使ったbackend (全て失敗したときはNone)
+        self.winner = None
+
+    @property
+    def base_url(self):
+        return "|".join(client.base_url or "" for client in self.clients)
+
+    @property
+    def model(self):
+        return "|".join(client.model or "" for client in self.clients)
+
+    @property
+    def winner_model(self):
+        return self.winner.model if self.winner is not None else None
+
+    def ask_ai(self, system_prompt, user_prompt, stream=False, on_delta=None):
+        self.winner = None
+        results = queue.Queue()
+        cancel = threading.Event()
+        # streamの途中経過を書き込むbackend
+        owner = []
+        owner_lock = threading.Lock()
+
+        def run(index):
+            def delta(partial):
+                with owner_lock:
+                    if not owner:
+                        owner.append(index)
+                    if owner[0] != index:
+                        return
+                on_delta(partial)
+            client = self.clients[index]
+            try:
+                response = client.ask_ai(system_prompt, user_prompt, stream,
+                                         delta if on_delta is not None else None, cancel=cancel)
+            except Exception as e:
+                print(f"[yellow][Warning] {client.base_url}: {e}[/yellow]")
+                response = None
+            results.put((index, response))
+
+        launched = 0
+        pending = 0
+
+        def launch():
+            nonlocal launched, pending
+            if launched > 0:
+                metrics.incr("llm_hedge", result="sent")
+                verbose_print(f"[green][Process] Hedge request: {self.clients[launched].base_url}[/green]")
+            threading.Thread(target=run, args=(launched,), daemon=True).start()
+            launched += 1
+            pending += 1
+
+        launch()
+        while pending:
+            try:
+                index, response = results.get(
+                    timeout=self.hedge_delay if launched < len(self.clients) else None)
+            except queue.Empty:
+                # hedge_delay秒以内に返ってこない -> 次のbackendにも投げる
+                launch()
+                continue
+            pending -= 1
+            if response is not None:
+                cancel.set()
+                self.winner = self.clients[index]
+                metrics.incr("llm_hedge", result="primary" if index == 0 else "secondary")
+                verbose_print(f"[green][Process] Hedge winner: {self.clients[index].base_url}[/green]")
+                return response
+            # 失敗したときは、待たずに次のbackendに投げる
+            if launched < len(self.clients):
+                launch()
+        metrics.incr("llm_hedge", result="failed")
+        return None
+
+
+class LLMClientRegistry:
+    """
+    LLMSimpleClientを名前(llm_name)ごとに使い回す。
+
+    - .env / .env.{llm_name} はmtimeが変わったときだけ読み直す
+    - base_urlごとにrequests.Sessionを持ち、keep-aliveで接続を使い回す
+      -> 毎回のTCP+TLS handshakeを避ける
+    """
+    _clients = {}
+    _sessions = {}
+    _lock = threading.Lock()
+    pool_maxsize = 10
+
+    @classmethod
+    def _env_mtime(cls, env_filepath):
+        try:
+            return os.path.getmtime(env_filepath)
+        except OSError:
+            return None
+
+    @classmethod
+    def session(cls, base_url):
+        with cls._lock:
+            if base_url not in cls._sessions:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=cls.pool_maxsize)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                cls._sessions[base_url] = session
+            return cls._sessions[base_url]
+
+    @classmethod
+    def get(cls, llm_name=None) -> LLMSimpleClient:
+        mtime = cls._env_mtime(LLMSimpleClient.env_filepath(llm_name))
+        with cls._lock:
+            cached = cls._clients.get(llm_name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        if cached is not None:
+            verbose_print(f"[green][Process] Reload env: {LLMSimpleClient.env_filepath(llm_name)}[/green]")
+        client = LLMSimpleClient(llm_name)
+        if client.base_url:
+            client.session = cls.session(client.base_url)
+        with cls._lock:
+            cls._clients[llm_name] = (mtime, client)
+        return client
+
+    @classmethod
+    def prewarm(cls, llm_names):
+        """
+        起動時に接続を張っておく (background thread)。
+        llm_names: list[str or None] -> Noneは.env
+        """
+        def warm(llm_name):
+            client = cls.get(llm_name)
+            if not client.base_url or client.session is None:
+                return
+            import requests
+            try:
+                client.session.head(client.base_url, timeout=5)
+                verbose_print(f"[green][Process] Prewarmed: {client.base_url}[/green]")
+            except requests.exceptions.RequestException as e:
+                verbose_print(f"[yellow][Warning] Prewarm failed: {client.base_url} {e}[/yellow]")
+        for llm_name in llm_names:
+            threading.Thread(target=warm, args=(llm_name,), daemon=True).start()
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._clients.clear()
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
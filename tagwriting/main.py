@@ -1,30 +1,48 @@
 import os
 import re
+import sys
 import time
-import requests
 import datetime
-import subprocess
-import yaml
+import threading
+import contextlib
+from urllib.parse import urlparse
 import click
-from rich.console import Console
 from rich import print
-from watchdog.observers import Observer
-import importlib.metadata
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tagwriting.html_client import HTMLClient
-from tagwriting.llm_simple_client import LLMSimpleClient
-from tagwriting.file_change_handler import FileChangeHandler
-from tagwriting.utils import verbose_print
-from tagwriting.config_builder import ConfigBuilder
+from tagwriting.llm_simple_client import LLMClientRegistry, HedgedClient
+from tagwriting.file_change_handler import FileChangeHandler, ContentHashes
+from tagwriting.utils import verbose_print, atomic_write, splice_write
+from tagwriting.config_builder import ConfigBuilder, DEFAULT_HISTORY_TEMPLATE
+from tagwriting.disk_cache import DiskCache
+from tagwriting.tag_scanner import TagScanner, parse_attrs_and_llm
+from tagwriting.work_queue import WorkQueue
+from tagwriting.metrics import metrics
+from tagwriting.context_window import SectionIndex, CONTEXT_STRATEGIES
+from tagwriting.include_resolver import include_resolver
+from tagwriting.large_file import LargeFile
+from tagwriting.history_store import HistoryStore
+from tagwriting.path_matcher import GitIgnore
+from tagwriting.watcher import PrunedWatcher
+
+# MediaWiki APIの`titles=A|B|C` / `exlimit`の上限
+WIKIPEDIA_TITLES_LIMIT = 20
 
 
 class TextManager:
-    def __init__(self, filepath, templates, history):
+    def __init__(self, filepath, templates, history, fetch_cache=None, content_hashes=None, response_cache=None):
         """
         filepath: str = "foobar.md"
         templates: list[dict] = [{"tag": "tag_name", "format": "prompt formt"}]
            - example: [{"tag": "summary",  "format": "summarize: {prompt}"}]
         history:
            - example: {"previous_prompt": "", "previous_response": ""}
+        fetch_cache: DiskCache or None
+           - <url>/<wikipedia>の取得結果をイベントをまたいで保持するキャッシュ
+        content_hashes: ContentHashes or None
+           - 読み書きした内容を記録し、自分の書き込みによるイベントを無視させる
+        response_cache: DiskCache or None
+           - LLMのレスポンスを、問い合わせ内容のhashで保持するキャッシュ
         """
         self.filepath = os.path.abspath(filepath)
         self.history = history
@@ -32,6 +50,20 @@ class TextManager:
             templates = []
         self.templates = templates
         self.url_catch = {}
+        self.fetch_cache = fetch_cache
+        self.content_hashes = content_hashes
+        self.response_cache = response_cache
+        self._disk_data = None
+        self._disk_stat = None
+        # extract_prompt_tags_batchで失敗したタグの数
+        self.batch_failures = 0
+        # extract_prompt_tag: 空のタグを消した場合はTrue (LLMに問い合わせずに、残りのタグを続けて処理できる)
+        self.tag_removed = False
+        self.scanner = TagScanner.from_templates(self.templates)
+        # context: sectionのときに使う見出しのindex (textが変わったら作り直す)
+        self._section_index = None
+        # ファイルの読み書きを直列化する (batch / stream)
+        self._lock = threading.Lock()
 
 
     @classmethod
@@ -42,28 +74,21 @@ class TextManager:
           - "(gpt)" -> (gpt, [])
           - "funny:detail" -> (None, ["funny", "detail"])
         """
-        if attrs_and_llm is None:
-            return [], None
-        # llm name = "(gpt)" -> gpt
-        llm_name = re.search(r'\([\w]+\)', attrs_and_llm)
-        if llm_name:
-            attrs_and_llm = attrs_and_llm.replace(f'{llm_name.group(0)}', '')
-            llm_name = llm_name.group(0).replace('(', '').replace(')', '')
-        attrs = attrs_and_llm.split(':') if attrs_and_llm else []
-        attrs = list(filter(None, attrs))
-        return attrs, llm_name
+        return parse_attrs_and_llm(attrs_and_llm)
 
     @classmethod
-    def extract_tag_contents(cls, tag_name, text):
+    def extract_tag_contents(cls, tag_name, text, tokens=None):
         """
         get tag and inner text.
           example: <prompt(gpt):funny>内容</prompt>
             -> ("<prompt:funny>内容</prompt>", "内容", ["funny"], "gpt")
 
-        [TODO] recursive process:
+        recursive process:
           example: <prompt>summarize: <prompt> Python language </prompt></prompt>
             -> <prompt>Python language</prompt>
             -> ("<prompt>Python language</prompt>", "Python language", [])
+
+        tokens: TagScanner.scanの結果があれば、再走査せずにそれを使う
         """
 
         # match list: 
@@ -71,11 +96,12 @@ class TextManager:
         #   -> <prompt:funny>foobar</prompt>
         #   -> <prompt(gpt):funny>foobar</prompt>
         #   -> <prompt(gpt)>foobar</prompt>
-        pattern = f'<{tag_name}([^>]*?)>(.*?)</{tag_name}>'
-        match_tag =  re.search(pattern, text, flags=re.DOTALL)
-        if match_tag:
-            attrs, llm_name = TextManager.attar_and_llm(match_tag.group(1))
-            return (match_tag.group(0), match_tag.group(2), attrs, llm_name) 
+        if tokens is None:
+            tokens = TagScanner.compile((tag_name,)).scan(text)
+        token = TagScanner.first(tokens, tag_name)
+        if token:
+            return (TagScanner.tag_text(text, token), TagScanner.inner_text(text, token),
+                    token.attrs, token.llm_name)
         return None
 
     @classmethod
@@ -83,14 +109,17 @@ class TextManager:
         """
         Convert custom tag to safe tag:
         
-        tag: dict = {"tag": "tag_name", "format": "prompt formt", "change": "prompt"}
+        tag: dict = {"tag": "tag_name", "format": "prompt formt", "change": "prompt", "context": "section"}
         prompt: str = "prompt text"
         attrs: list = ["attr1", "attr2"]
         llm_name: str = "gpt"
 
         return:
-          <prompt(gpt):attr1:attr2>prompt text</prompt>
+          <prompt(gpt):attr1:attr2:section>prompt text</prompt>
         """        
+        # tag['context']はcontext戦略のattrとして引き継ぐ
+        if tag.get("context") in CONTEXT_STRATEGIES and tag["context"] not in attrs:
+            attrs = list(attrs) + [tag["context"]]
         attrs_text = ":".join(attrs) if attrs else ""
         attrs_text = f":{attrs_text}" if attrs_text != "" else ""
         llm_name = f"({llm_name.lower()})" if llm_name is not None else ""
@@ -107,7 +136,8 @@ class TextManager:
             tag["change"] = "prompt" 
         return f"<{tag['change']}{llm_name}{attrs_text}>{tag['format'].format(prompt=prompt)}</{tag['change']}>"
 
-    def _pre_prompt(self):
+    @metrics.timed("pre_prompt")
+    def _pre_prompt(self, save=True):
         """
         Simple replace for tags:
             example: tag = {"tag":"summary", "format":"summarize: {prompt}"}
@@ -116,31 +146,78 @@ class TextManager:
         First Template Only:
             -> "<summary>adabracatabra</summary> <summary> foobar </summary>"
             -> "<prompt>summarize: adabracatabra</prompt> <summary> foobar </summary>"
+
+        走査結果はself.tokensに残し、<prompt>/<chat>の検出で使い回す。
+        return: 置換した場合はTrue
         """
+        self.tokens = self.scanner.scan(self.text)
         for tag in self.templates["tags"]:
-            result = TextManager.extract_tag_contents(tag['tag'], self.text)
+            result = TextManager.extract_tag_contents(tag['tag'], self.text, self.tokens)
             if result is not None:
                 tags, prompt, attrs, llm_name = result
                 replace_tags = TextManager.convert_custom_tag(tag, prompt, attrs, llm_name)
                 self.text = self.text.replace(tags, replace_tags)
-                self._save_text()
-                return
+                self.tokens = self.scanner.scan(self.text)
+                if save:
+                    self._save_text()
+                return True
+        return False
 
+    @metrics.timed("load")
     def _load_text(self):
         try:
-            with open(self.filepath, 'r', encoding='utf-8') as f:
-                self.text = f.read()
+            with open(self.filepath, 'rb') as f:
+                data = f.read()
+            # text modeで読み込んだときと同じく、改行を"\n"にそろえる
+            self.text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+            self._remember_disk(data)
         except Exception as e:
             print(f"[red][Error]: {e}")
             self.text = None
 
+    @metrics.timed("save")
     def _save_text(self):
+        """
+        atomic write (temp file + fsync + rename)で書き込む。
+
+        config.splice_write_threshold (opt-in) 以上の大きなファイルで、
+        前回読み書きしたときからディスク上のファイルが変わっていない場合は、
+        変わった範囲だけを書き込む (この場合はatomicではない)。
+        """
         try:
-            with open(self.filepath, 'w', encoding='utf-8') as f:
-                f.write(self.text)
+            # text modeで書き込むと"\n"はos.linesepになる
+            data = self.text.replace("\n", os.linesep).encode('utf-8')
+            # 書き込みによるイベントが先に届くことがあるので、書き込む前に記録する
+            if self.content_hashes is not None:
+                self.content_hashes.record(self.filepath, data)
+            threshold = self.templates["config"].get("splice_write_threshold", 0)
+            if threshold and len(data) >= threshold and self._is_disk_unchanged():
+                splice_write(self.filepath, self._disk_data, data)
+            else:
+                atomic_write(self.filepath, data)
+            self._remember_disk(data)
         except Exception as e:
             print(f"[red][Error]: {e}") 
 
+    def _remember_disk(self, data):
+        """
+        ディスク上の内容とstatを覚えておく (splice writeの比較元)
+        """
+        if self.content_hashes is not None:
+            self.content_hashes.record(self.filepath, data)
+        self._disk_data = data
+        stat = os.stat(self.filepath)
+        self._disk_stat = (stat.st_size, stat.st_mtime_ns)
+
+    def _is_disk_unchanged(self):
+        if self._disk_data is None:
+            return False
+        try:
+            stat = os.stat(self.filepath)
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == self._disk_stat
+
     @classmethod
     def safe_text(cls, response, tag):
         """
@@ -158,24 +235,17 @@ class TextManager:
         return response
 
     @classmethod
-    def replace_include_tags(cls, filepath, text):
+    def replace_include_tags(cls, filepath, text, seen=None):
         """
         <include>filepath.md</include> の形式で記述されたタグを、
         指定ファイルの内容で置換する。
         パスは現在加工しているファイルからの相対パス。
+
+        - include先のincludeも展開する (循環は展開しない)
+        - seen: 同じrequestで既に展開したファイル -> 2回目以降は展開しない
+        - 見つからないファイルのタグはそのまま残す
         """
-        pattern = r'<include>(.*?)</include>'
-        def replacer(match):
-            rel_path = match.group(1).strip()
-            base_dir = os.path.dirname(filepath)
-            abs_path = os.path.abspath(os.path.join(base_dir, rel_path))
-            with open(abs_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        try: 
-            return re.sub(pattern, replacer, text, flags=re.DOTALL)
-        except Exception as e:
-            print(f"[include error: {e}]")
-            return None
+        return include_resolver.resolve(filepath, text, seen)
 
     def replace_url_tags(self, text):
         """
@@ -202,31 +272,138 @@ class TextManager:
            - テキストは何度も短期間で変換されるため、そのたびにURLを取得する必要はない。
            - URL先のテキストは、ローカルテキストの場合に比べて、より頻繁に変換される可能性は低い。
         """
-        pattern = r'<url>(.*?)</url>'
-        def replacer(match):
-            url = match.group(1).strip()
+        return self.replace_url_tags_many([text])[0]
+
+    def replace_url_tags_many(self, texts):
+        """
+        複数のtext(prompt / context)の<url>タグをまとめて置換する。
+
+          1. 全てのtextから重複のないURLを集める
+          2. 並列に取得する (config.url_concurrency / ホストごとにconfig.url_per_host)
+          3. 一回の走査で置換する
+
+        エラーになったURLのタグは置換せず、そのまま残す。
+        """
+        scanner = TagScanner.compile(("url",))
+        tokens_list = [scanner.scan(text) for text in texts]
+        urls = []
+        for text, tokens in zip(texts, tokens_list):
+            for token in TagScanner.outermost(tokens, ("url",)):
+                url = TagScanner.inner_text(text, token).strip()
+                if url not in urls:
+                    urls.append(url)
+        fetched = self.fetch_urls(urls)
+
+        results = []
+        for text, tokens in zip(texts, tokens_list):
+            def replacer(token, text=text):
+                url = TagScanner.inner_text(text, token).strip()
+                if url not in fetched:
+                    return TagScanner.tag_text(text, token)
+                return fetched[url] or ""
+            results.append(scanner.sub(text, "url", replacer, tokens))
+        return results
+
+    def fetch_urls(self, urls):
+        """
+        return: dict[url, text or None]
+          -> エラー(例外)になったURLは含まない
+        """
+        fetched = {}
+        missing = []
+        for url in urls:
             if url in self.url_catch:
-                return self.url_catch[url]
+                fetched[url] = self.url_catch[url]
             else:
-                print(f"[green][Process] Fetching URL: {url}")
-                response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'}, timeout=10)
-                verbose_print(f"[green][Result] URL Response: {response}[/green]")
-                response.encoding = response.apparent_encoding
-                if response.status_code == 200:
-                    html_text, title = HTMLClient.html_to_text(
-                        response.text, self.templates["config"]["url_strip"], simple_text=True)
-                    if self.templates["config"]["url_source"]:
-                       html_text += f"\n\nSource URL: [{title}]({url})"
+                missing.append(url)
+        if not missing:
+            return fetched
+        config = self.templates["config"]
+        concurrency = max(1, min(config.get("url_concurrency", 8), len(missing)))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(self._fetch_url, url): url for url in missing}
+            for future in as_completed(futures):
+                url = futures[future]
+                try:
+                    html_text = future.result()
+                except Exception as e:
+                    print(f"[red][Error] URL fetch error: {url}: {e}[/red]")
+                    continue
+                if html_text is not None:
                     self.url_catch[url] = html_text
-                    return html_text
-                else:
-                    print(f"[url error: status_code={response.status_code}]")
-                    return ""
+                fetched[url] = html_text
+        return fetched
+
+    # (host, limit) -> [BoundedSemaphore, 使用中/待っている数]: 同じホストへの同時接続数を、process全体で制限する
+    #   -> 誰も使っていないホストは消す (長いwatchの間に増え続けないように)
+    _host_slots = {}
+    _host_slots_lock = threading.Lock()
+
+    @classmethod
+    @contextlib.contextmanager
+    def host_slot(cls, url, limit):
+        key = (urlparse(url).netloc.lower(), limit)
+        with cls._host_slots_lock:
+            entry = cls._host_slots.get(key)
+            if entry is None:
+                entry = cls._host_slots[key] = [threading.BoundedSemaphore(max(1, limit)), 0]
+            entry[1] += 1
         try:
-            return re.sub(pattern, replacer, text, flags=re.DOTALL)
-        except Exception as e:
-            print(f"[red][Error] Replace Include Tags Error: {e}[/red]")
-            return text
+            with entry[0]:
+                yield
+        finally:
+            with cls._host_slots_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del cls._host_slots[key]
+
+    def _fetch_url(self, url):
+        """
+        URLを取得してテキストに変換する。
+
+        fetch_cacheがある場合:
+          - freshなキャッシュはそのまま返す
+          - staleなキャッシュはETag/Last-Modifiedで再検証し、304なら再利用する
+        """
+        config = self.templates["config"]
+        # 変換結果はurl_strip / url_sourceで変わるので、keyに含める
+        cache_key = "url:" + DiskCache.key_digest(url, config["url_strip"], config["url_source"])
+        cached = self.fetch_cache.get(cache_key) if self.fetch_cache else None
+        headers = {'User-Agent': 'Mozilla/5.0'}
+        if cached is not None:
+            value, meta, fresh = cached
+            if fresh:
+                metrics.incr("cache", cache="url", result="hit")
+                verbose_print(f"[green][Process] URL cache hit: {url}[/green]")
+                return value
+            headers.update(self.fetch_cache.validators(meta))
+        print(f"[green][Process] Fetching URL: {url}")
+        # slotを使うのは通信の間だけ (テキストへの変換中は、同じホストの次のリクエストを待たせない)
+        with TextManager.host_slot(url, config.get("url_per_host", 2)):
+            response, body = HTMLClient.fetch(
+                url, headers=headers, max_bytes=config.get("url_max_bytes", 5 * 1024 * 1024))
+        verbose_print(f"[green][Result] URL Response: {response}[/green]")
+        metrics.incr("http_responses", target="url", status=str(response.status_code))
+        if response.status_code == 304 and cached is not None:
+            metrics.incr("cache", cache="url", result="revalidated")
+            verbose_print(f"[green][Process] URL not modified: {url}[/green]")
+            self.fetch_cache.touch(cache_key)
+            return cached[0]
+        metrics.incr("cache", cache="url", result="miss")
+        if response.status_code == 200:
+            html_text, title = HTMLClient.html_to_text_async(
+                body, config["url_strip"], simple_text=True,
+                parser=config.get("html_parser", "auto"), workers=config.get("html_workers", 2))
+            if config["url_source"]:
+               html_text += f"\n\nSource URL: [{title}]({url})"
+            if self.fetch_cache:
+                self.fetch_cache.set(cache_key, html_text, {
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified")})
+            return html_text
+        else:
+            print(f"[url error: status_code={response.status_code}]")
+            return None
 
     @classmethod
     def prepend_wikipedia_sources(cls, wikipedia_sources):
@@ -244,6 +421,31 @@ class TextManager:
                 wikipedia_resources += f"## {title}\n\n{extract}\n\n"
         return wikipedia_resources
 
+    @classmethod
+    def wikipedia_tags(cls, text, config):
+        """
+        <wikipedia>記事タイトル</wikipedia> の形式で記述されたタグを全て検出する。
+
+          - <wikipedia(en)>Python</wikipedia> -> 言語 (default: config.wikipedia_lang)
+          - <wikipedia:intro>Python</wikipedia> -> 冒頭の要約だけ (default: config.wikipedia_extract)
+          - <wikipedia:full>Python</wikipedia> -> 記事全体
+
+        Returns:
+            Set[Tuple[str, str, str]]: (言語, 抽出方法, タイトル) のセット
+        """
+        tags = set()
+        for token in TagScanner.compile(("wikipedia",)).scan(text):
+            title = TagScanner.inner_text(text, token).strip()
+            if not title:
+                continue
+            lang = token.llm_name or config.get("wikipedia_lang", "ja")
+            extract = config.get("wikipedia_extract", "full")
+            for attr in token.attrs:
+                if attr in ("intro", "full"):
+                    extract = attr
+            tags.add((lang, extract, title))
+        return tags
+
     def fetch_wikipedia_tags(self, text):
         """
         <wikipedia>記事タイトル</wikipedia> の形式で記述されたタグを全て検出し、
@@ -252,45 +454,115 @@ class TextManager:
         Returns:
             Set[Tuple[str, str or None]]: (タイトル, 記事本文 or None) のセット
         """
+        return self.fetch_wikipedia(TextManager.wikipedia_tags(text, self.templates["config"]))
+
+    def fetch_wikipedia(self, tags):
+        """
+        tags: Set[Tuple[言語, 抽出方法, タイトル]] (TextManager.wikipedia_tags)
+
+        - キャッシュにないタイトルだけを取得する
+        - intro: `titles=A|B|C`で、言語ごとにまとめて取得する (APIの上限: 20件)
+        - full: APIが一回に一件しか返さないので、並列に取得する
+
+        Returns:
+            Set[Tuple[str, str or None]]: (タイトル, 記事本文 or None) のセット
+        """
+        if not tags:
+            return set()
         print("[green][Process] Fetching Wikipedia tags...[/green]")
-        pattern = r'<wikipedia>(.*?)</wikipedia>'
-        titles = set(title.strip() for title in re.findall(pattern, text, flags=re.DOTALL))
         results = set()
-        for title in titles:
-            cache_key = f"wikipedia:{title}"
+        groups = {}
+        for lang, extract, title in tags:
+            cache_key = self._wikipedia_cache_key(lang, extract, title)
             if cache_key in self.url_catch:
-                extract = self.url_catch[cache_key]
-                results.add((title, extract))
+                results.add((title, self.url_catch[cache_key]))
                 continue
-            try:
-                api = "https://ja.wikipedia.org/w/api.php"
-                params = {
-                    "action": "query",
-                    "prop": "extracts",
-                    "explaintext": True,
-                    "format": "json",
-                    "titles": title,
-                }
-                response = requests.get(api, params=params, timeout=10)
-                if response.status_code == 200:
-                    data = response.json()
-                    pages = data.get("query", {}).get("pages", {})
-                    if not pages:
-                        raise Exception("No pages found")
-                    page = next(iter(pages.values()))
-                    extract = page.get("extract", None)
-                    if extract:
-                        extract = extract.strip()
-                        self.url_catch[cache_key] = extract
-                        results.add((title, extract))
-                        continue
-                    else:
-                        continue
-                else:
-                    continue
-            except Exception as e:
-                print(f"[wikipedia error: {e}]")
-                results.add((title, None))
+            cached = self.fetch_cache.get(cache_key) if self.fetch_cache else None
+            if cached is not None and cached[2]:
+                metrics.incr("cache", cache="wikipedia", result="hit")
+                verbose_print(f"[green][Process] Wikipedia cache hit: {title}[/green]")
+                self.url_catch[cache_key] = cached[0]
+                results.add((title, cached[0]))
+                continue
+            metrics.incr("cache", cache="wikipedia", result="miss")
+            groups.setdefault((lang, extract), []).append(title)
+
+        batches = []
+        for (lang, extract), titles in groups.items():
+            titles.sort()
+            if extract == "intro":
+                for i in range(0, len(titles), WIKIPEDIA_TITLES_LIMIT):
+                    batches.append((lang, extract, titles[i:i + WIKIPEDIA_TITLES_LIMIT]))
+            else:
+                batches.extend((lang, extract, [title]) for title in titles)
+        if not batches:
+            return results
+
+        concurrency = self.templates["config"].get("wikipedia_concurrency", 4)
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(batches)))) as executor:
+            for extracts in executor.map(lambda batch: self._fetch_wikipedia_batch(*batch), batches):
+                results |= extracts
+        return results
+
+    def _wikipedia_cache_key(self, lang, extract, title):
+        chars = self.templates["config"].get("wikipedia_chars")
+        return f"wikipedia:{lang}:{extract}:{chars}:{title}"
+
+    def _fetch_wikipedia_batch(self, lang, extract, titles):
+        """
+        一回のリクエストで取得する
+          return: Set[Tuple[str, str or None]]
+        """
+        config = self.templates["config"]
+        api = config.get("wikipedia_endpoint", "https://{lang}.wikipedia.org/w/api.php").format(lang=lang)
+        params = {
+            "action": "query",
+            "prop": "extracts",
+            "explaintext": True,
+            "redirects": True,
+            "format": "json",
+            "titles": "|".join(titles),
+        }
+        if extract == "intro":
+            params["exintro"] = True
+            params["exlimit"] = len(titles)
+        if config.get("wikipedia_chars"):
+            params["exchars"] = config["wikipedia_chars"]
+        import requests
+        try:
+            response = requests.get(api, params=params, timeout=10)
+            metrics.incr("http_responses", target="wikipedia", status=str(response.status_code))
+            if response.status_code != 200:
+                raise Exception(f"HTTP {response.status_code}")
+            query = response.json().get("query", {})
+            pages = query.get("pages", {})
+            if not pages:
+                raise Exception("No pages found")
+        except Exception as e:
+            print(f"[wikipedia error: {e}]")
+            return set((title, None) for title in titles)
+
+        # 正規化 / リダイレクトされたタイトルを、タグに書かれたタイトルに戻す
+        renamed = {}
+        for item in query.get("normalized", []) + query.get("redirects", []):
+            renamed[item["from"]] = item["to"]
+        extracts = {page.get("title"): page.get("extract") for page in pages.values()}
+        results = set()
+        for title in titles:
+            resolved = title
+            # normalized -> redirects の順に辿る (ループしないように回数を制限する)
+            for _ in range(len(renamed)):
+                if resolved not in renamed:
+                    break
+                resolved = renamed[resolved]
+            extract_text = extracts.get(resolved)
+            if extract_text:
+                extract_text = extract_text.strip()
+                cache_key = self._wikipedia_cache_key(lang, extract, title)
+                self.url_catch[cache_key] = extract_text
+                if self.fetch_cache:
+                    self.fetch_cache.set(cache_key, extract_text)
+                results.add((title, extract_text))
         return results
 
     @classmethod
@@ -334,16 +606,199 @@ class TextManager:
                 print(f"[red][bold][Warning][/bold] Attribute rule not defined: '{attr}'[/red]")
         return rules        
 
+    @classmethod
+    def split_context_attrs(cls, attrs, templates):
+        """
+        attrsからcontext戦略(full / section)を取り出す。
+          - templates["attrs"]に同じ名前のattrが定義されている場合は、そちらを優先する
+          - 指定がなければconfig.context
+
+        example:
+          - ["bullet", "section"] -> ("section", ["bullet"])
+        """
+        strategy = templates["config"].get("context", "full")
+        rest = []
+        for attr in attrs:
+            if attr in CONTEXT_STRATEGIES and attr not in templates["attrs"]:
+                strategy = attr
+            else:
+                rest.append(attr)
+        return strategy, rest
+
+    def build_context(self, text, placeholder, strategy):
+        """
+        <prompt>タグのcontextを作る。
+          - full: textをそのまま使う
+          - section: placeholderを含む見出しのsection(+祖先の見出し)を、
+                     config.context_neighbors / config.context_max_tokensの範囲で使う
+        """
+        if strategy != "section":
+            return text
+        offset = text.find(placeholder)
+        if offset < 0:
+            return text
+        if self._section_index is None or self._section_index.text is not text:
+            self._section_index = SectionIndex(text)
+        config = self.templates["config"]
+        return self._section_index.window(
+            offset, config.get("context_neighbors", 2), config.get("context_max_tokens"))
+
     def _build_attrs_rules(self, attrs) -> str:
         return TextManager.build_attrs_rules(attrs, self.templates)
 
     def _build_wikipedia_resources(self, context, prompt) -> str:
-        wikipedia_tags = self.fetch_wikipedia_tags(context)
-        wikipedia_tags = wikipedia_tags | self.fetch_wikipedia_tags(prompt)
+        # contextとpromptのタグをまとめて、重複を除いてから取得する
+        config = self.templates["config"]
+        wikipedia_tags = TextManager.wikipedia_tags(context, config) | TextManager.wikipedia_tags(prompt, config)
         # Wikipedia記事の取得結果を反映
-        return TextManager.prepend_wikipedia_sources(wikipedia_tags)
+        return TextManager.prepend_wikipedia_sources(self.fetch_wikipedia(wikipedia_tags))
+
+    def llm_client(self, llm_name):
+        """
+        llm_name: タグの(llm_name)
+          -> config.llm_groupsのgroupの名前: HedgedClient
+          -> それ以外: .env.{llm_name}のLLMSimpleClient
+        (llm_name)の指定がないときは、config.llm_groupを使う
+        """
+        config = self.templates["config"]
+        groups = config.get("llm_groups") or {}
+        if llm_name is None and config.get("llm_group") in groups:
+            llm_name = config["llm_group"]
+        if llm_name in groups:
+            return HedgedClient([LLMClientRegistry.get(name) for name in groups[llm_name]],
+                                config.get("llm_hedge_delay", 2.0))
+        return LLMClientRegistry.get(llm_name)
+
+    @metrics.timed("ask_llm")
+    def _ask_llm(self, prompt, attrs, llm_name, context, on_delta=None):
+        """
+        include / url / wikipediaを展開して、LLMに問い合わせる。
+
+        on_delta: config.streamのとき、途中までのレスポンスを受け取るcallback
+
+        return:
+          -> (prompt, response, model): promptはinclude等を展開した後のもの / modelは回答したbackendのmodel
+          -> None: LLM error
+        """
+        # ---- Include ----
+        # contextとpromptで同じファイルを二重に展開しないように、seenを共有する
+        with metrics.span("include"):
+            seen = set()
+            context = TextManager.replace_include_tags(self.filepath, context, seen)
+            # Promptの内部にあるincludeタグも置換する
+            prompt = TextManager.replace_include_tags(self.filepath, prompt, seen)
+
+        attrs_rules = self._build_attrs_rules(attrs)
+
+        # ---- URL ----
+
+        print(f"[green][Process] fetch URL data ... [/green]")
+
+        with metrics.span("url"):
+            prompt, context = self.replace_url_tags_many([prompt, context])
+
+        print(f"[green][Process] URL Tags Replaced[/green]")
+        # ---- Wikipedia ----
+        with metrics.span("wikipedia"):
+            wikipedia_resources = self._build_wikipedia_resources(context, prompt)
+
+        # ---- LLM ----
+        llm_client = self.llm_client(llm_name)
+        system_prompt = self.templates["system_prompt"].format(attrs_rules=attrs_rules)
+        user_prompt = self.templates["user_prompt"].format(
+            context=context, prompt=prompt, wikipedia_resources=wikipedia_resources)
+
+        # ---- Response Cache ----
+        cache_key = None
+        if self.response_cache is not None:
+            # "…/v1"と"…/v1/"は同じbackend
+            cache_key = DiskCache.key_digest(
+                (llm_client.base_url or "").rstrip('/'), llm_client.model, system_prompt, user_prompt)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None and cached[2]:
+                metrics.incr("cache", cache="response", result="hit")
+                print("[green][bold][Processs][/bold] Response cache hit. Skipping request.[/green]")
+                return prompt, cached[0], cached[1].get("model", llm_client.model)
+            metrics.incr("cache", cache="response", result="miss")
+
+        with metrics.span("llm"):
+            response = llm_client.ask_ai(
+                system_prompt,
+                user_prompt,
+                stream=self.templates["config"].get("stream", False),
+                on_delta=on_delta
+            )
+        if response is None:
+            return None
+        # groupのときは、group全体ではなく回答したbackendのmodelを記録する
+        model = llm_client.winner_model if isinstance(llm_client, HedgedClient) else llm_client.model
+
+        # prompt or chat tagがレスポンスに入っていた時に、
+        # その部分を削除する
+        response = TextManager.safe_text(response, 'prompt')
+        response = TextManager.safe_text(response, 'chat')
+        response = response.replace("@@processing@@", "", 1)
+        if cache_key is not None:
+            self.response_cache.set(cache_key, response, {"model": model})
+        return prompt, response, model
+
+    def _stream_writer(self, placeholder):
+        """
+        Streaming: 途中までのレスポンスをplaceholderの直前に書き込む。
+
+          "@@processing@@" -> "Hel@@processing@@" -> "Hello, wor@@processing@@"
+
+        config.stream_interval秒ごとにしか書き込まない。
+        return: (on_delta, state)
+          -> state["written"]: ファイルに書き込み済みの途中テキスト
+        """
+        state = {"written": "", "flushed_at": time.time()}
+        interval = self.templates["config"].get("stream_interval", 0.5)
+        def on_delta(partial):
+            now = time.time()
+            if now - state["flushed_at"] < interval:
+                return
+            state["flushed_at"] = now
+            # 途中のテキストにタグが入っていると、保存イベントで処理が走ってしまうので除去する
+            partial = TextManager.safe_text(partial, 'prompt')
+            partial = TextManager.safe_text(partial, 'chat')
+            partial = partial.replace("@@processing@@", "")
+            with self._lock:
+                self._load_text()
+                current = state["written"] + placeholder
+                if self.text is None or current not in self.text:
+                    return
+                self.text = self.text.replace(current, partial + placeholder, 1)
+                self._save_text()
+                state["written"] = partial
+        return on_delta, state
+
+    def _splice_response(self, placeholder, response, state=None):
+        """
+        placeholder (と、streamで書き込んだ途中テキスト) をresponseで置き換える
+        """
+        written = state["written"] if state else ""
+        if written and written + placeholder in self.text:
+            self.text = self.text.replace(written + placeholder, response, 1)
+        else:
+            self.text = self.text.replace(placeholder, response, 1)
+
+    def is_large_file(self):
+        """
+        config.large_file_threshold以上のファイルは、全体を読み込まずに処理する
+        """
+        threshold = self.templates["config"].get("large_file_threshold", 0)
+        if not threshold:
+            return False
+        try:
+            return os.path.getsize(self.filepath) >= threshold
+        except OSError:
+            return False
 
     def extract_prompt_tag(self):
+        self.tag_removed = False
+        if self.is_large_file():
+            return self.extract_prompt_tag_large()
         self._load_text()
 
         # loadが失敗した場合:
@@ -365,7 +820,9 @@ class TextManager:
                     self.text = self.text.replace("@@processing@@", f"{self.history['previous_response']}")
                     self._save_text()
                     return None
-            self._pre_prompt()
+            # カスタムタグの変換は、placeholderの挿入と一緒に保存する
+            self._pre_prompt(save=False)
+            tokens = self.tokens
             """
             Process:
               -> "<prompt>Do you think this product?</prompt>" 
@@ -376,11 +833,11 @@ class TextManager:
             # ---- Prompt or Chat ----
             result_kind = None
 
-            result  = TextManager.extract_tag_contents('prompt', self.text)
+            result  = TextManager.extract_tag_contents('prompt', self.text, tokens)
             if result is not None:
                 result_kind = 'prompt'
             else:
-                result = TextManager.extract_tag_contents('chat', self.text)
+                result = TextManager.extract_tag_contents('chat', self.text, tokens)
                 result_kind = 'chat'            
             # <prompt> or <chat> tag is not found:
             #  -> stop process
@@ -388,6 +845,7 @@ class TextManager:
                 return None
 
             tag, prompt, attrs, llm_name = result
+            strategy, attrs = TextManager.split_context_attrs(attrs, self.templates)
 
             # Promptが空白文字のみだった場合、self.textをbackup_textに差し戻して終了
             if prompt == '' or prompt.isspace():
@@ -401,12 +859,14 @@ class TextManager:
                 verbose_print("[white][Info][/white]")
                 verbose_print(self.text)
                 self._save_text()
+                self.tag_removed = True
                 print("[yellow][bold][Processs][/bold] Prompt is empty or contains only whitespace. Reverting to backup text.[/yellow]")
                 return None
             # Safety Undo Check
             # -> config.yamlのconfig.duplicate_promptを参照
             # -> 以前と同じPromptが入ってきた場合、実行を止める
-            if self.templates["config"].get('duplicate_prompt', False):
+            # -> response_cacheがある場合は、キャッシュから書き戻すのでチェックしない
+            if self.templates["config"].get('duplicate_prompt', False) and self.response_cache is None:
                 if prompt == self.history["previous_prompt"]:
                     print("[green][bold][Processs][/bold] Duplicate prompt detected. Skipping.[/green]")
                     print(f"[green][bold][Processs][/bold] Previous prompt: {self.history['previous_prompt']}[/green]")
@@ -416,6 +876,7 @@ class TextManager:
             # <prompt> or <chat>によってコンテキスト戦略を変える。
             # <prompt>タグの場合は、
             #   -> self.textをコンテキストとして使用する
+            #   -> context: sectionのときは、@@processing@@の周辺のsectionだけ
             # <chat>タグの場合は、
             #   -> コンテキストをなくす("@@processing@@")だけにする
 
@@ -425,59 +886,28 @@ class TextManager:
             if result_kind == 'prompt':
                 # 同じ<prompt>hoge</prompt>というタグが出てくる可能性があるので、
                 # 1回だけ置換する
-                context = self.text.replace(tag, "@@processing@@", 1)
+                context = self.build_context(
+                    self.text.replace(tag, "@@processing@@", 1), "@@processing@@", strategy)
             else:
                 # <chat>タグの場合は、全てのコンテキストを除去する
                 #   -> @@processing@@をそのまま使用
                 context = "@@processing@@"
             
-            # ---- Include ----
-            context = TextManager.replace_include_tags(self.filepath, context)
-            # Includeエラーが起きたときは一回ストップする
-            if context is None:
-                return None
-            # Promptの内部にあるincludeタグも置換する
-            prompt = TextManager.replace_include_tags(self.filepath, prompt)
-            if prompt is None:
-                return None
-
-            attrs_rules = self._build_attrs_rules(attrs)
- 
-            # ---- URL ----
-            
-            print(f"[green][Process] fetch URL data ... [/green]")
-
-            prompt = self.replace_url_tags(prompt)
-            context = self.replace_url_tags(context)
-
-            print(f"[green][Process] URL Tags Replaced[/green]")
-            # ---- Wikipedia ----
-            wikipedia_resources = self._build_wikipedia_resources(context, prompt)
-
-            # ---- LLM ----
-            llm_client = LLMSimpleClient(llm_name)
-            response = llm_client.ask_ai(
-                self.templates["system_prompt"].format(attrs_rules=attrs_rules),
-                self.templates["user_prompt"].format(context=context, prompt=prompt, wikipedia_resources=wikipedia_resources)
-            )
-
+            on_delta, state = self._stream_writer("@@processing@@")
+            result = self._ask_llm(prompt, attrs, llm_name, context, on_delta)
             # responseがNoneのときは、中断
-            if response is None:
+            if result is None:
                 self.text = backup_text
                 self._save_text()
                 return None
+            prompt, response, model = result
 
-            # prompt or chat tagがレスポンスに入っていた時に、
-            # その部分を削除する
-            response = TextManager.safe_text(response, 'prompt')
-            response = TextManager.safe_text(response, 'chat')
-            response = response.replace("@@processing@@", "", 1)
-            
             # ObsidianのようなHard save - loadするeditor向け対応
-            self._load_text()
-            self.text = self.text.replace("@@processing@@", f"{response}", 1)
-            self._save_text()
-            self.append_history(prompt, response)
+            with self._lock:
+                self._load_text()
+                self._splice_response("@@processing@@", response, state)
+                self._save_text()
+            self.append_history(prompt, response, llm_name, model)
             return (prompt, response)
         except AttributeError as e:
             # エラーが発生した場合:
@@ -490,14 +920,251 @@ class TextManager:
             e.__traceback__.print_exc()
             return None
 
-    def append_history(self, prompt, result):
+    def extract_prompt_tag_large(self):
+        """
+        Large-file mode: extract_prompt_tagと同じ処理を、ファイル全体を読み込まずに行う。
+
+          -> mmapしたファイルを走査して、最初の<prompt> / <chat>の位置(byte offset)だけを求める
+          -> タグを"@@processing@@"に置き換える / responseで置き換えるときは、その範囲だけを書き直す
+          -> contextは、タグの前後config.large_file_context_bytesだけ (context戦略はその中で使う)
+
+        streamの途中経過は書き込まない (書き込むたびに後ろを書き直すことになるので)
+        """
+        placeholder = "@@processing@@"
+        large_file = LargeFile(self.filepath, self.content_hashes)
+        scanner = TagScanner.compile(self.scanner.names, binary=True)
+        try:
+            with metrics.span("load"):
+                tokens = large_file.scan(scanner)
+        except (OSError, ValueError) as e:
+            print(f"[red][Error]: {e}")
+            return None
+        verbose_print(f"[white][Info] Large file: {large_file.size} bytes, {len(tokens)} tags[/white]")
+
+        # simple_merge
+        if self.templates['config'].get('simple_merge', False):
+            position = large_file.find(placeholder)
+            if position >= 0:
+                print("[green][bold][Processs][/bold] find `@@processing@@`. Simple merge. [/green]")
+                print(f"[green][bold][Processs][/bold] >> {self.history['previous_response']}[/green]")
+                large_file.splice(position, position + len(placeholder.encode('utf-8')),
+                                  self.history['previous_response'])
+                return None
+
+        # カスタムタグは、変換した範囲だけを書き直してから走査し直す
+        for tag in self.templates["tags"]:
+            token = TagScanner.first(tokens, tag['tag'])
+            if token is not None:
+                prompt = large_file.read(token.inner_start, token.inner_end)
+                replace_tags = TextManager.convert_custom_tag(tag, prompt, token.attrs, token.llm_name)
+                large_file.splice(token.start, token.end, replace_tags)
+                tokens = large_file.scan(scanner)
+                break
+
+        # ---- Prompt or Chat ----
+        result_kind = 'prompt'
+        token = TagScanner.first(tokens, 'prompt')
+        if token is None:
+            result_kind = 'chat'
+            token = TagScanner.first(tokens, 'chat')
+        if token is None:
+            return None
+
+        tag = large_file.read(token.start, token.end)
+        prompt = large_file.read(token.inner_start, token.inner_end)
+        strategy, attrs = TextManager.split_context_attrs(token.attrs, self.templates)
+
+        # Promptが空白文字のみだった場合、タグだけを消して終了 (無限ループ防止)
+        if prompt == '' or prompt.isspace():
+            large_file.splice(token.start, token.end, prompt)
+            self.tag_removed = True
+            print("[yellow][bold][Processs][/bold] Prompt is empty or contains only whitespace. Removing tag.[/yellow]")
+            return None
+        if self.templates["config"].get('duplicate_prompt', False) and self.response_cache is None:
+            if prompt == self.history["previous_prompt"]:
+                print("[green][bold][Processs][/bold] Duplicate prompt detected. Skipping.[/green]")
+                print(f"[green][bold][Processs][/bold] Previous prompt: {self.history['previous_prompt']}[/green]")
+                return None
+
+        # ---- Context ----
+        if result_kind == 'prompt':
+            radius = self.templates["config"].get("large_file_context_bytes", 256 * 1024)
+            before, after = large_file.window(token.start, token.end, radius)
+            context = self.build_context(before + placeholder + after, placeholder, strategy)
+        else:
+            context = placeholder
+
+        with self._lock:
+            large_file.splice(token.start, token.end, placeholder)
+
+        def restore(text):
+            # placeholderを探し直して、その範囲だけを書き直す
+            # -> ObsidianのようなHard save - loadするeditor向け対応
+            with self._lock:
+                position = large_file.find(placeholder, token.start)
+                if position < 0:
+                    print(f"[yellow][Warning] Placeholder removed: {placeholder}[/yellow]")
+                    return False
+                large_file.splice(position, position + len(placeholder.encode('utf-8')), text)
+                return True
+
+        try:
+            result = self._ask_llm(prompt, attrs, token.llm_name, context)
+        except AttributeError as e:
+            restore(tag)
+            print(f"[red][Error]: {e}")
+            return None
+        # responseがNoneのときは、タグを元に戻す
+        if result is None:
+            restore(tag)
+            return None
+        prompt, response, model = result
+        if restore(response):
+            self.append_history(prompt, response, token.llm_name, model)
+        return (prompt, response)
+
+    @classmethod
+    def batch_placeholder(cls, index):
+        return f"@@processing:{index}@@"
+
+    def _extract_prompt_tags_large(self):
+        """
+        large fileは全体を読み込まない(placeholderをまとめて書けない)ので、タグを一つずつ処理する
+        """
+        results = []
+        while True:
+            self.tag_removed = False
+            result = self.extract_prompt_tag_large()
+            if result is not None:
+                results.append(result)
+            elif not self.tag_removed:
+                return results
+
+    def extract_prompt_tags_batch(self):
+        """
+        Batch mode: ファイル内の全ての<prompt>/<chat>タグを一回のイベントで処理する。
+
+        Process:
+          -> "<prompt>A</prompt> <chat>B</chat>"
+          -> "@@processing:0@@ @@processing:1@@"  (一回だけ保存)
+          -> LLMへのリクエストを並列に投げる (config.batch_concurrency)
+          -> 返ってきた順に、それぞれのplaceholderへ書き戻す
+
+        return: list[(prompt, response)]
+        """
+        if self.is_large_file():
+            return self._extract_prompt_tags_large()
+        self._load_text()
+        if self.text is None:
+            return []
+
+        # カスタムタグを全て<prompt>/<chat>に変換する
+        while self._pre_prompt(save=False):
+            pass
+
+        # 入れ子の場合は、内側のタグ(他のprompt/chatを含まないもの)だけを対象にする
+        candidates = [t for t in self.tokens if t.name in ('prompt', 'chat')]
+        leaves = [t for t in candidates
+                  if not any(o is not t and t.start <= o.start and o.end <= t.end for o in candidates)]
+        leaves.sort(key=lambda t: t.start)
+
+        jobs = []
+        parts = []
+        position = 0
+        for token in leaves:
+            prompt = TagScanner.inner_text(self.text, token)
+            parts.append(self.text[position:token.start])
+            position = token.end
+            if prompt == '' or prompt.isspace():
+                # 空のタグは消す (無限ループ防止)
+                print("[yellow][bold][Processs][/bold] Prompt is empty or contains only whitespace. Removing tag.[/yellow]")
+                parts.append(prompt)
+                continue
+            if self.templates["config"].get('duplicate_prompt', False) and self.response_cache is None:
+                if prompt == self.history["previous_prompt"]:
+                    print("[green][bold][Processs][/bold] Duplicate prompt detected. Skipping.[/green]")
+                    parts.append(TagScanner.tag_text(self.text, token))
+                    continue
+            placeholder = TextManager.batch_placeholder(len(jobs))
+            parts.append(placeholder)
+            jobs.append((placeholder, token.name, TagScanner.tag_text(self.text, token),
+                         prompt, token.attrs, token.llm_name))
+        parts.append(self.text[position:])
+        self.text = "".join(parts)
+        self._save_text()
+        if not jobs:
+            return []
+
+        placeholder_text = self.text
+        def build_context(placeholder, kind, strategy):
+            if kind == 'chat':
+                return "@@processing@@"
+            # 見出しのindexはplaceholder_textに対して一回だけ作る
+            context = self.build_context(placeholder_text, placeholder, strategy)
+            context = context.replace(placeholder, "@@processing@@", 1)
+            # 他の処理中のplaceholderはcontextから除く
+            for other, *_ in jobs:
+                context = context.replace(other, "")
+            return context
+
+        results = []
+        concurrency = self.templates["config"].get("batch_concurrency", 4)
+        print(f"[green][Process] Batch: {len(jobs)} tags (concurrency={concurrency})[/green]")
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            futures = {}
+            for placeholder, kind, tag, prompt, attrs, llm_name in jobs:
+                on_delta, state = self._stream_writer(placeholder)
+                strategy, attrs = TextManager.split_context_attrs(attrs, self.templates)
+                future = executor.submit(
+                    self._ask_llm, prompt, attrs, llm_name, build_context(placeholder, kind, strategy), on_delta)
+                futures[future] = (placeholder, tag, state, llm_name)
+            for future in as_completed(futures):
+                placeholder, tag, state, llm_name = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"[red][Error]: {e}")
+                    result = None
+                with self._lock:
+                    # ObsidianのようなHard save - loadするeditor向け対応
+                    self._load_text()
+                    if self.text is None or placeholder not in self.text:
+                        print(f"[yellow][Warning] Placeholder removed: {placeholder}[/yellow]")
+                        continue
+                    if result is None:
+                        # 失敗したタグは元に戻す
+                        self.batch_failures += 1
+                        self._splice_response(placeholder, tag, state)
+                        self._save_text()
+                        continue
+                    prompt, response, model = result
+                    for other, *_ in jobs:
+                        response = response.replace(other, "")
+                    self._splice_response(placeholder, response, state)
+                    self._save_text()
+                    self.append_history(prompt, response, llm_name, model)
+                    results.append((prompt, response))
+        return results
+
+    @metrics.timed("history")
+    def append_history(self, prompt, result, llm_name=None, model=None):
         """
         LLMとのやりとり履歴をhistory.file/templatに従って保存する仮実装。
         prompt: プロンプト文字列
         result: LLMの応答
+        llm_name: タグの(llm_name) -> history.backend: sqliteのときに、modelと一緒に記録する
+        model: 回答したmodel (None: llm_nameのclientのmodel)
         """
         history_conf = self.templates.get('history', {})
 
+        # sqlite: queueに入れるだけ (書き込みはbackground thread)
+        if history_conf.get('backend', 'markdown') == 'sqlite':
+            if model is None:
+                model = self.llm_client(llm_name).model
+            HistoryStore.from_templates(self.templates).append(
+                self.filepath, prompt, result, llm_name, model)
+            return
+
         # ファイル名決定
         base = os.path.splitext(os.path.basename(self.filepath))[0]
         file_tmpl = history_conf.get('file', '{filename}.history.md')
@@ -526,7 +1193,15 @@ class TextManager:
 
 class ConsoleClient:
     def __init__(self):
+        from rich.console import Console
         self.console = Console()
+        self.fetch_cache = None
+        self.response_cache = None
+        self.content_hashes = ContentHashes()
+        # start_watchingで作ったFileChangeHandler (hot reloadでtarget/ignoreを更新する)
+        self.event_handler = None
+        # history / templatesはworker threadから更新されるのでlockする
+        self._lock = threading.Lock()
         self.history = {
             "previous_prompt": "",
             "previous_response": ""
@@ -537,6 +1212,7 @@ class ConsoleClient:
         任意のシェルコマンドを実行し、結果を表示する
         """
         try:
+            import subprocess
             result = subprocess.run(command.format(**params), shell=False, capture_output=True, text=True)
             if result.stdout:
                 self.console.print(f"[cyan]stdout:[/cyan]\n{result.stdout}")
@@ -548,8 +1224,8 @@ class ConsoleClient:
             return -1
 
     @classmethod
-    def build_templates(cls, templates):
-        return ConfigBuilder.build(templates)
+    def build_templates(cls, templates, base_dir=None):
+        return ConfigBuilder.build(templates, base_dir)
 
     def start(self, watch_path, yaml_path):
         """
@@ -582,9 +1258,11 @@ class ConsoleClient:
         # 1. Welcome message
         self.console.rule("[bold blue]Tagwriting CLI[/bold blue]")
         self.console.print(f"[bold magenta]Hello, Tagwriting CLI![/bold magenta] :sparkles:", justify="center")
+        import importlib.metadata
         version = importlib.metadata.version("tagwriting")
         self.console.print(f"[yellow]Version: {version}[/yellow]", justify="center")
 
+        import yaml
         try:
             # 2. Load templates from yaml file
             self.load_templates(yaml_path)
@@ -628,14 +1306,34 @@ class ConsoleClient:
         """
         templates = None
         if yaml_path:
+            import yaml
             with open(yaml_path, 'r', encoding='utf-8') as f:
                 templates = yaml.safe_load(f)
-        self.templates = ConsoleClient.build_templates(templates)
+        # .tagwriting/ (cache等)は、起動したディレクトリではなくyaml or 監視するディレクトリに作る
+        base_dir = ConfigBuilder.base_dir(
+            yaml_path, self.watch_path if self.watch_path_is_dir else self.dirpath)
+        self.templates = ConsoleClient.build_templates(templates, base_dir)
         if self.watch_path_is_dir is False:
             self.templates["target"] = [self.watch_path]
             if not self.templates["default_template_target"]:
                 self.console.print(f"[yellow]Warning - Override target param: {self.watch_path}[/yellow]", justify="center")
         self.templates["selfpath"] = yaml_path
+        self.fetch_cache = DiskCache.from_templates(self.templates, "fetch")
+        self.response_cache = DiskCache.from_templates(self.templates, "response")
+        metrics.configure(self.templates["config"]["metrics_file"], self.templates["config"]["metrics_port"])
+        self._prewarm()
+
+    def _prewarm(self):
+        """
+        config.llm_prewarm:
+          -> True: .envのbase_urlに接続しておく
+          -> list: [null, "gpt"] のように、.env / .env.{llm_name}を指定する
+        """
+        prewarm = self.templates["config"]["llm_prewarm"]
+        if prewarm is True:
+            prewarm = [None]
+        if prewarm:
+            LLMClientRegistry.prewarm(prewarm)
 
     def on_change(self, filepath):
         """
@@ -650,32 +1348,56 @@ class ConsoleClient:
             -> If the changed file is the template file, reload the templates
           3. If the changed file is not the template file, process the file
         """
+        with metrics.span("event"):
+            self._on_change(filepath)
+
+    def _on_change(self, filepath):
         self.console.rule(f"[bold yellow]File changed: {os.path.basename(filepath)}[/bold yellow]")
         if self.templates["config"]["hot_reload_yaml"] and filepath == self.templates["selfpath"]:
             self.console.print(f"[bold yellow]Hot reload templates from {filepath}[/bold yellow]")
             # 編集中の壊れたファイルを読み込む場合があるので、Exceptionをキャッチしておいて、
             # クライアントが落ちないようにする
             try:
-                self.load_templates(self.templates["selfpath"])
+                with self._lock:
+                    self.load_templates(self.templates["selfpath"])
+                    if self.event_handler is not None:
+                        self.event_handler.update_templates(self.templates)
             except Exception as e:
                 self.console.print(f"[yellow][Warning]Failed to reload templates: {e}[/yellow]")
                 self.console.print("[yellow]Continue to watch files...[/yellow]")
         else:            
-            text_manager = TextManager(filepath, self.templates, self.history)
-            result = text_manager.extract_prompt_tag()
-            if result is not None:
-                prompt, response = result
-                self.console.print(f"[bold green]Prompt:[/bold green] {prompt}")
-                self.console.print(f"[bold green]Response:[/bold green] {response}")
-
-                # update history
-                self.history["previous_prompt"] = prompt
-                self.history["previous_response"] = response
-
-                # "text_generate_end" が存在する場合のみコマンド実行
-                if "text_generate_end" in self.templates["hook"]:
-                    self.run_shell_command(self.templates["hook"]["text_generate_end"],
-                        {"filepath": filepath})
+            text_manager = TextManager(
+                filepath, self.templates, self.history,
+                self.fetch_cache, self.content_hashes, self.response_cache)
+            if self.templates["config"]["batch_process"]:
+                results = text_manager.extract_prompt_tags_batch()
+                for result in results:
+                    self._show_result(*result)
+            else:
+                # 自分の書き込みによるイベントは無視されるので、
+                # タグが見つかる間は同じイベントの中で続けて処理する
+                results = []
+                while True:
+                    result = text_manager.extract_prompt_tag()
+                    if result is not None:
+                        results.append(result)
+                        self._show_result(*result)
+                    elif not text_manager.tag_removed:
+                        break
+
+            # "text_generate_end" が存在する場合のみコマンド実行
+            if results and "text_generate_end" in self.templates["hook"]:
+                self.run_shell_command(self.templates["hook"]["text_generate_end"],
+                    {"filepath": filepath})
+
+    def _show_result(self, prompt, response):
+        self.console.print(f"[bold green]Prompt:[/bold green] {prompt}")
+        self.console.print(f"[bold green]Response:[/bold green] {response}")
+
+        # update history
+        with self._lock:
+            self.history["previous_prompt"] = prompt
+            self.history["previous_response"] = response
 
     def _start_client_message(self):
         # show starting message:
@@ -683,6 +1405,48 @@ class ConsoleClient:
         self.console.print(f"[blue] exit: Ctrl+C[/blue]", justify="center")
         self.console.print(f"[green]Start clients... [/green]", justify="center")
 
+    def start_watching(self):
+        """
+        observerとworkerを起動する。
+
+        return: (observer, work_queue, event_handler)
+          -> 止めるときは stop_watching(observer, work_queue)
+        """
+        use_path = self.watch_path if self.watch_path_is_dir else self.dirpath
+        config = self.templates["config"]
+
+        # observer thread -> WorkQueue -> worker threads -> on_change
+        work_queue = WorkQueue(
+            self.on_change,
+            workers=config["queue_workers"],
+            maxsize=config["queue_size"])
+        work_queue.start()
+        gitignore = GitIgnore(use_path) if config["gitignore"] else None
+        event_handler = FileChangeHandler(
+            use_path, work_queue.submit, self.templates, content_hashes=self.content_hashes,
+            batch_window=config["watch_batch_window"], gitignore=gitignore)
+        # 除外するディレクトリにはwatchを登録しない
+        observer = PrunedWatcher(
+            event_handler,
+            lambda path, is_dir: event_handler.is_ignored(path, is_dir),
+            backend=config["watch_backend"],
+            polling_interval=config["watch_polling_interval"],
+            gitignore=gitignore)
+        # ファイルを一つだけ監視する場合は、そのディレクトリだけ (再帰しない)
+        observer.add_tree(use_path, recursive=self.watch_path_is_dir)
+        verbose_print(f"[white][Info] Watches: {observer.watch_count}[/white]")
+        observer.start()
+        self.event_handler = event_handler
+        return observer, work_queue, event_handler
+
+    @classmethod
+    def stop_watching(cls, observer, work_queue):
+        observer.stop()
+        observer.join()
+        work_queue.stop()
+        HistoryStore.close_all()
+        HTMLClient.shutdown_pool()
+
     def inloop(self):
         """
         1. show starting message
@@ -691,25 +1455,136 @@ class ConsoleClient:
           -> Start observer
         """
         self._start_client_message()
-        use_path = self.watch_path if self.watch_path_is_dir else self.dirpath
-
-        event_handler = FileChangeHandler(use_path, self.on_change, self.templates)
-        observer = Observer()
-        observer.schedule(event_handler, path=use_path, recursive=True)
-        observer.start()
+        observer, work_queue, _ = self.start_watching()
 
         try:
             while True:
                 time.sleep(1)
         except KeyboardInterrupt:
-            observer.stop()
-        observer.join()
+            pass
+        ConsoleClient.stop_watching(observer, work_queue)
+
+
+def process_file(filepath, templates):
+    """
+    BatchClientのworker process用。
+    ファイル内の全てのタグを一回だけ処理する。
+
+    return: (filepath, completions, failures, error)
+    """
+    import tagwriting.utils
+    tagwriting.utils.verbose = templates["config"]["verbose_print"]
+    try:
+        text_manager = TextManager(
+            filepath, templates, {"previous_prompt": "", "previous_response": ""},
+            DiskCache.from_templates(templates, "fetch"),
+            response_cache=DiskCache.from_templates(templates, "response"))
+        results = text_manager.extract_prompt_tags_batch()
+        # worker processはatexitを呼ばずに終わるので、ここで書き込んでおく
+        HistoryStore.flush_all()
+        return filepath, len(results), text_manager.batch_failures, None
+    except Exception as e:
+        return filepath, 0, 0, str(e)
+
+
+class BatchClient:
+    """
+    Headless batch mode: watcherを使わず、既にタグが書かれているファイルを一度だけ処理する。
+
+    Process:
+      1. target/ignoreに従ってファイルを探す
+      2. 処理待ちのタグ(カスタムタグ, <prompt>, <chat>)があるファイルだけを選ぶ
+      3. process poolで並列に処理する
+        -> ファイル内のタグはextract_prompt_tags_batchで並列に処理する
+      4. summaryを表示し、失敗があればexit codeを1にする
+    """
+    def __init__(self, root_path, yaml_path, workers=4, llm_concurrency=4):
+        from rich.console import Console
+        self.console = Console()
+        self.root_path = os.path.abspath(root_path)
+        self.base_dir = self.root_path if os.path.isdir(self.root_path) else os.path.dirname(self.root_path)
+        self.workers = max(1, workers)
+        templates = None
+        if yaml_path:
+            import yaml
+            with open(yaml_path, 'r', encoding='utf-8') as f:
+                templates = yaml.safe_load(f)
+        self.templates = ConfigBuilder.build(templates, ConfigBuilder.base_dir(yaml_path, self.base_dir))
+        self.templates["selfpath"] = yaml_path
+        self.templates["config"]["batch_concurrency"] = llm_concurrency
+        if os.path.isfile(self.root_path):
+            self.templates["target"] = [self.root_path]
 
+    def find_files(self):
+        """
+        return: list[str] 処理待ちのタグがあるファイル
+        """
+        handler = FileChangeHandler(self.root_path, None, self.templates)
+        scanner = TagScanner.from_templates(self.templates)
+        pending_names = {"prompt", "chat"} | {tag["tag"] for tag in self.templates["tags"]}
+        if os.path.isfile(self.root_path):
+            candidates = [self.root_path]
+        else:
+            candidates = []
+            for dirpath, dirnames, filenames in os.walk(self.root_path):
+                # ignoreされたディレクトリには入らない
+                dirnames[:] = [d for d in dirnames
+                               if not handler.is_ignored(os.path.join(dirpath, d), is_dir=True)
+                               and not handler.is_ignored(os.path.join(dirpath, d) + os.sep, is_dir=True)]
+                candidates.extend(os.path.join(dirpath, filename) for filename in filenames)
+        files = []
+        for path in sorted(candidates):
+            if handler.is_ignored(path) or not handler.is_target(path) or not handler.is_text_file(path):
+                continue
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+            except (OSError, UnicodeDecodeError):
+                continue
+            if any(token.name in pending_names for token in scanner.scan(text)):
+                files.append(path)
+        return files
 
-@click.command()
+    def run(self) -> int:
+        """
+        return: exit code
+        """
+        import tagwriting.utils
+        tagwriting.utils.verbose = self.templates["config"]["verbose_print"]
+        started = time.time()
+        files = self.find_files()
+        self.console.rule("[bold blue]Tagwriting Batch[/bold blue]")
+        self.console.print(f"[green]Files with pending tags: {len(files)} (workers={self.workers})[/green]")
+        completions = 0
+        failures = 0
+        errors = 0
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(process_file, path, self.templates) for path in files]
+            for future in as_completed(futures):
+                filepath, done, failed, error = future.result()
+                completions += done
+                failures += failed
+                relpath = os.path.relpath(filepath, self.base_dir)
+                if error is not None:
+                    errors += 1
+                    self.console.print(f"[red][Error] {relpath}: {error}[/red]")
+                elif failed:
+                    self.console.print(f"[yellow][Warning] {relpath}: {done} done, {failed} failed[/yellow]")
+                else:
+                    self.console.print(f"[green][Done] {relpath}: {done} done[/green]")
+        elapsed = time.time() - started
+        self.console.rule("[bold blue]Summary[/bold blue]")
+        self.console.print(f"files: {len(files)}, completions: {completions}, "
+                           f"failed tags: {failures}, file errors: {errors}, time: {elapsed:.1f}s")
+        return 1 if failures or errors else 0
+
+
+@click.group(invoke_without_command=True)
 @click.option('--watch', 'watch_path', default=".", help='Directory path or file path to watch')
 @click.option('--templates', 'yaml_path', default=None, help='Template yaml file path')#
-def main(watch_path, yaml_path):
+@click.pass_context
+def main(ctx, watch_path, yaml_path):
     # default
     # -> watch_path = "."
     # -> yaml_path = None
@@ -717,6 +1592,8 @@ def main(watch_path, yaml_path):
     # [TODO]: asterisk file path ("*.md", "*.txt", etc. ) is "multiple files"
     #  example: "*.md" -> "hoo.md" "bar.md"
     #  and raise "Error: Got unexpected extra arguments". fix this.
+    if ctx.invoked_subcommand is not None:
+        return
     if yaml_path is not None:
         yaml_path = os.path.abspath(yaml_path)
     watch_path = os.path.abspath(watch_path)
@@ -724,5 +1601,69 @@ def main(watch_path, yaml_path):
     client.start(watch_path, yaml_path)
 
 
+@main.command()
+@click.option('--path', 'root_path', default=".", help='Directory path or file path to process')
+@click.option('--templates', 'yaml_path', default=None, help='Template yaml file path')
+@click.option('--workers', default=4, show_default=True, help='Number of files processed in parallel')
+@click.option('--llm-concurrency', default=4, show_default=True, help='Number of LLM requests in parallel per file')
+def run(root_path, yaml_path, workers, llm_concurrency):
+    """
+    Process every pending tag once and exit (no watcher).
+    """
+    if yaml_path is not None:
+        yaml_path = os.path.abspath(yaml_path)
+    client = BatchClient(root_path, yaml_path, workers, llm_concurrency)
+    sys.exit(client.run())
+
+
+@main.command()
+@click.option('--templates', 'yaml_path', default=None, help='Template yaml file path')
+@click.option('--file', 'file_path', default=None, help='Only entries of this file')
+@click.option('--prompt', default=None, help='Only entries with exactly this prompt')
+@click.option('--model', default=None, help='Only entries of this model')
+@click.option('--search', default=None, help='Text contained in prompt or response')
+@click.option('--since', default=None, type=click.DateTime(), help='Only entries after this time')
+@click.option('--until', default=None, type=click.DateTime(), help='Only entries before this time')
+@click.option('--limit', default=20, show_default=True, help='Maximum number of entries')
+@click.option('--path', 'root_path', default=".", help='Watched directory (used when --templates is not given)')
+@click.option('--format', 'output_format', default="table", show_default=True,
+              type=click.Choice(["table", "markdown", "jsonl"]), help='Output format')
+def history(yaml_path, file_path, prompt, model, search, since, until, limit, root_path, output_format):
+    """
+    Search the history saved with `history.backend: sqlite`.
+    """
+    templates = None
+    if yaml_path:
+        import yaml
+        with open(yaml_path, 'r', encoding='utf-8') as f:
+            templates = yaml.safe_load(f)
+    templates = ConfigBuilder.build(templates, ConfigBuilder.base_dir(yaml_path, root_path))
+    store = HistoryStore.from_templates(templates)
+    rows = store.query(file=file_path, prompt=prompt, model=model, search=search,
+                       since=since, until=until, limit=limit)
+    if output_format == "jsonl":
+        import json
+        for row in rows:
+            click.echo(json.dumps(row, ensure_ascii=False))
+    elif output_format == "markdown":
+        # history.templateの形式で、古い順に出力する
+        template = templates["history"].get('template', DEFAULT_HISTORY_TEMPLATE)
+        for row in reversed(rows):
+            timestamp = datetime.datetime.fromtimestamp(row["timestamp"]).isoformat()
+            click.echo(template.format(prompt=row["prompt"], result=row["response"], timestamp=timestamp))
+    else:
+        from rich.console import Console
+        from rich.table import Table
+        table = Table()
+        for column in ("timestamp", "file", "model", "prompt", "response"):
+            table.add_column(column, overflow="fold")
+        for row in rows:
+            table.add_row(
+                datetime.datetime.fromtimestamp(row["timestamp"]).strftime("%Y-%m-%d %H:%M:%S"),
+                os.path.relpath(row["file"]), row["model"] or "",
+                row["prompt"][:80], row["response"][:80])
+        Console().print(table)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+import json
+import time
+import threading
+import functools
+import contextlib
+from rich import print
+
+
+class Metrics:
+    """
+    処理の段階ごとの時間(span)と、カウンタを集計する。
+
+    - span: load, pre_prompt, include, url, wikipedia, llm, save, history, ...
+      -> 「遅い」と言われたときに、LLMなのか<url>なのかWikipediaなのかを切り分ける
+    - counter: events, cache hit/miss, LLMに送ったbytes, HTTP status, ...
+
+    Export:
+      - jsonl_path: 1行1レコードのJSONで追記する
+      - port: localhostでPrometheusのtext formatを返す (GET /metrics)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._spans = {}
+        self._file = None
+        self._server = None
+
+    @classmethod
+    def _key(cls, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def configure(self, jsonl_path=None, port=None):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if jsonl_path:
+                self._file = open(jsonl_path, 'a', encoding='utf-8')
+        if port and self._server is None:
+            self.start_server(port)
+
+    def _write(self, record):
+        # lockの内側で呼ぶこと
+        if self._file is None:
+            return
+        record["ts"] = time.time()
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def incr(self, name, value=1, **labels):
+        key = Metrics._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._write({"type": "counter", "name": name, "value": value, **labels})
+
+    def observe(self, name, seconds, **labels):
+        key = Metrics._key(name, labels)
+        with self._lock:
+            count, total = self._spans.get(key, (0, 0.0))
+            self._spans[key] = (count + 1, total + seconds)
+            self._write({"type": "span", "name": name, "seconds": seconds, **labels})
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def timed(self, name):
+        """
+        decorator: 関数全体をspanで囲む
+          @metrics.timed("load")
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(Metrics._key(name, labels), 0)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._spans.clear()
+
+    @classmethod
+    def _format_labels(cls, labels):
+        if not labels:
+            return ""
+        inner = ",".join(f'{k}="{str(v)}"' for k, v in labels)
+        return "{" + inner + "}"
+
+    def prometheus_text(self) -> str:
+        """
+        tagwriting_{counter}_total{labels} value
+        tagwriting_stage_seconds_sum{stage="llm"} value
+        tagwriting_stage_seconds_count{stage="llm"} value
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"tagwriting_{name}_total{Metrics._format_labels(labels)} {value}")
+            for (name, labels), (count, total) in sorted(self._spans.items()):
+                stage_labels = Metrics._format_labels((("stage", name),) + labels)
+                lines.append(f"tagwriting_stage_seconds_sum{stage_labels} {total:.6f}")
+                lines.append(f"tagwriting_stage_seconds_count{stage_labels} {count}")
+        return "\n".join(lines) + "\n"
+
+    def start_server(self, port, host="127.0.0.1"):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"[yellow][Warning] Failed to start metrics server: {e}[/yellow]")
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        print(f"[green][Process] Metrics: http://{host}:{port}/metrics[/green]")
+
+
+# process全体で一つ
+metrics = Metrics()
@@ -0,0 +1,229 @@
+import os
+import re
+import fnmatch
+import functools
+import threading
+from collections import OrderedDict
+
+# is_text_fileで「テキストの文字」とみなすbyte
+TEXT_CHARACTERS = bytes(bytearray({7, 8, 9, 10, 12, 13, 27} | set(range(0x20, 0x100))))
+
+
+class PathMatcher:
+    """
+    target / ignoreのpatternsを、設定を読み込んだときに一回だけコンパイルする。
+
+    - glob ("*.md", "/abs/path/*.txt"): 一つの正規表現にまとめて、パス全体とbasenameで照合する
+    - それ以外 (".git", "/abs/dir/", "/abs/file.md"):
+        -> パスが一致するか、そのディレクトリの下にあればマッチ (prefix check)
+    """
+
+    def __init__(self, patterns):
+        self.patterns = tuple(patterns)
+        globs = []
+        self._paths = set()
+        for pattern in self.patterns:
+            if any(char in pattern for char in '*?[]'):
+                globs.append(fnmatch.translate(os.path.normcase(pattern)))
+            else:
+                self._paths.add(os.path.normcase(os.path.abspath(pattern.rstrip('/\\') or pattern)))
+        self._glob = re.compile("|".join(f"(?:{g})" for g in globs)) if globs else None
+
+    @classmethod
+    @functools.lru_cache(maxsize=32)
+    def compile(cls, patterns):
+        """
+        patterns: tuple[str] -> 同じpatternsではコンパイル済みのMatcherを使い回す
+        """
+        return cls(patterns)
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def match(self, path):
+        if not os.path.isabs(path):
+            path = os.path.abspath(path)
+        path = os.path.normcase(path)
+        if self._glob is not None:
+            if self._glob.match(path) or self._glob.match(os.path.basename(path)):
+                return True
+        if self._paths:
+            # 自分自身と、祖先のディレクトリを順に調べる
+            candidate = path.rstrip(os.sep) or path
+            while True:
+                if candidate in self._paths:
+                    return True
+                parent = os.path.dirname(candidate)
+                if parent == candidate:
+                    break
+                candidate = parent
+        return False
+
+
+class TextFileCache:
+    """
+    is_text_fileの結果を(inode, mtime, size)をkeyにしてキャッシュする。
+      -> ファイルが変わっていなければ、開いて読み直さない
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def detect(cls, path, blocksize=512):
+        with open(path, 'rb') as f:
+            chunk = f.read(blocksize)
+        # NULLバイトが含まれていればバイナリファイルとみなす
+        if b'\0' in chunk:
+            return False
+        # ASCII範囲外のバイトが多すぎる場合もバイナリとみなす
+        nontext = chunk.translate(None, TEXT_CHARACTERS)
+        return float(len(nontext)) / len(chunk) < 0.30 if chunk else False
+
+    def is_text_file(self, path, blocksize=512):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            cached = self._results.get(path)
+            if cached is not None and cached[0] == key:
+                self._results.move_to_end(path)
+                return cached[1]
+        try:
+            result = TextFileCache.detect(path, blocksize)
+        except OSError:
+            return False
+        with self._lock:
+            self._results[path] = (key, result)
+            self._results.move_to_end(path)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+        return result
+
+
+class GitIgnore:
+    """
+    .gitignoreのpatternsで、パスが除外されるかを判定する。
+
+    - load(dirpath): そのディレクトリの.gitignoreを読み込む (ディレクトリを辿りながら呼ぶ)
+    - 深い.gitignoreのpatternが優先される (後にマッチしたものが勝つ)
+    - 親ディレクトリが除外されていれば、その下のファイルも除外する
+    - 対応: "#", "!", "/"(anchor), 末尾の"/"(ディレクトリのみ), "*", "?", "[...]", "**"
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        # dirpath -> [(regex, negate, dir_only)]
+        self._rules = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def translate(cls, pattern):
+        """
+        .gitignoreの一行 -> (regex, negate, dir_only) or None
+        """
+        pattern = pattern.rstrip("\n")
+        if not pattern.strip() or pattern.startswith("#"):
+            return None
+        if not pattern.endswith("\\ "):
+            pattern = pattern.rstrip()
+        negate = pattern.startswith("!")
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith("\\"):
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if not pattern:
+            return None
+        anchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+        regex = ""
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex += "(?:.*/)?"
+                i += 3
+            elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+                regex += "/.*"
+                i += 3
+            elif pattern.startswith("**", i):
+                regex += ".*"
+                i += 2
+            elif pattern[i] == "*":
+                regex += "[^/]*"
+                i += 1
+            elif pattern[i] == "?":
+                regex += "[^/]"
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+                end = pattern.index("]", i + 1)
+                body = pattern[i + 1:end].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += f"[{body}]"
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        return re.compile(f"{regex}$"), negate, dir_only
+
+    def load(self, dirpath):
+        path = os.path.join(dirpath, ".gitignore")
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        rules = [rule for rule in (GitIgnore.translate(line) for line in lines) if rule is not None]
+        with self._lock:
+            self._rules[os.path.abspath(dirpath)] = rules
+
+    def _match(self, path, is_dir):
+        if os.path.basename(path) == ".git":
+            return True
+        result = False
+        base = os.path.dirname(path)
+        bases = []
+        while self._within(base):
+            bases.append(base)
+            parent = os.path.dirname(base)
+            if parent == base:
+                break
+            base = parent
+        with self._lock:
+            for base in reversed(bases):
+                rules = self._rules.get(base)
+                if not rules:
+                    continue
+                rel = os.path.relpath(path, base).replace(os.sep, "/")
+                for regex, negate, dir_only in rules:
+                    if dir_only and not is_dir:
+                        continue
+                    if regex.match(rel):
+                        result = not negate
+        return result
+
+    def _within(self, path):
+        return path == self.root or path.startswith(self.root.rstrip(os.sep) + os.sep)
+
+    def ignored(self, path, is_dir=False):
+        path = os.path.abspath(path)
+        if path == self.root or not self._within(path):
+            return False
+        # 親ディレクトリが除外されていれば、その下も除外
+        parent = os.path.dirname(path)
+        ancestors = []
+        while parent != self.root and self._within(parent):
+            ancestors.append(parent)
+            parent = os.path.dirname(parent)
+        for ancestor in reversed(ancestors):
+            if self._match(ancestor, True):
+                return True
+        return self._match(path, is_dir)
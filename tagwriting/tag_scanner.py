@@ -0,0 +1,142 @@
+import re
+import functools
+from collections import namedtuple
+
+# 組み込みタグ
+BUILTIN_TAGS = ("prompt", "chat", "include", "url", "wikipedia")
+
+# name: タグ名
+# start, end: タグ全体の位置 -> text[start:end] == "<prompt:funny>foobar</prompt>"
+# inner_start, inner_end: 内側のテキストの位置 -> text[inner_start:inner_end] == "foobar"
+# attrs: ["funny"]
+# llm_name: "gpt" or None
+TagToken = namedtuple(
+    "TagToken", ["name", "start", "end", "inner_start", "inner_end", "attrs", "llm_name"])
+
+
+def parse_attrs_and_llm(attrs_and_llm):
+    """
+    example:
+      - "(gpt):funny:detail" -> (["funny", "detail"], "gpt")
+      - "(gpt)" -> ([], "gpt")
+      - "funny:detail" -> (["funny", "detail"], None)
+    """
+    if attrs_and_llm is None:
+        return [], None
+    # llm name = "(gpt)" -> gpt
+    llm_name = re.search(r'\([\w]+\)', attrs_and_llm)
+    if llm_name:
+        attrs_and_llm = attrs_and_llm.replace(f'{llm_name.group(0)}', '')
+        llm_name = llm_name.group(0).replace('(', '').replace(')', '')
+    attrs = attrs_and_llm.split(':') if attrs_and_llm else []
+    attrs = list(filter(None, attrs))
+    return attrs, llm_name
+
+
+class TagScanner:
+    """
+    組み込みタグとカスタムタグを一つの正規表現にまとめ、テキストを一回だけ走査する。
+
+    - 開始タグ: <name>, <name:attr>, <name(llm):attr>
+    - 終了タグ: </name>
+    - 入れ子のタグはスタックで対応をとる
+      -> 内側のタグが先に閉じるので、tokensは「閉じた順」に並ぶ
+      example: "<prompt>foo <prompt>bar</prompt> baz</prompt>"
+        -> [<prompt>bar</prompt>, <prompt>foo <prompt>bar</prompt> baz</prompt>]
+    """
+
+    def __init__(self, names, binary=False):
+        """
+        binary: Trueのとき、bytes / mmapをdecodeせずに走査する
+          -> TagTokenの位置はbyte offset、name / attrsはstrにして返す
+        """
+        self.names = tuple(dict.fromkeys(names))
+        # 長い名前を先に並べる (例: "prompt" と "prompts")
+        alternation = "|".join(re.escape(name) for name in sorted(self.names, key=len, reverse=True))
+        # 名前の直後は "(", ":", ">" のみ許可する: <prompts> を <prompt> と誤認しないため
+        pattern = rf'<(/?)({alternation})(?=[(:>])([^>]*)>'
+        # UTF-8では、マルチバイト文字の途中に"<"や">"のbyteは現れない
+        self.pattern = re.compile(pattern.encode("utf-8") if binary else pattern)
+
+    @classmethod
+    @functools.lru_cache(maxsize=32)
+    def compile(cls, names, binary=False):
+        """
+        names: tuple[str] -> 同じタグの組み合わせではコンパイル済みのScannerを使い回す
+        """
+        return cls(names, binary)
+
+    @classmethod
+    def from_templates(cls, templates):
+        custom_tags = tuple(tag["tag"] for tag in templates.get("tags", []))
+        return cls.compile(BUILTIN_TAGS + custom_tags)
+
+    def scan(self, text):
+        """
+        return: list[TagToken] (閉じた順)
+        """
+        tokens = []
+        stack = []
+        for match in self.pattern.finditer(text):
+            is_close, name, attrs = match.group(1), match.group(2), match.group(3)
+            if isinstance(name, bytes):
+                name, attrs = name.decode("utf-8"), attrs.decode("utf-8", "replace")
+            if not is_close:
+                stack.append((name, match.start(), match.end(), attrs))
+                continue
+            if attrs:
+                # "</prompt:foo>" のような終了タグは無視
+                continue
+            # 対応する開始タグを探す。閉じられなかった内側の開始タグは捨てる
+            for index in range(len(stack) - 1, -1, -1):
+                if stack[index][0] == name:
+                    _, start, inner_start, raw_attrs = stack[index]
+                    del stack[index:]
+                    tag_attrs, llm_name = parse_attrs_and_llm(raw_attrs)
+                    tokens.append(TagToken(
+                        name, start, match.end(), inner_start, match.start(), tag_attrs, llm_name))
+                    break
+        return tokens
+
+    @classmethod
+    def first(cls, tokens, name):
+        for token in tokens:
+            if token.name == name:
+                return token
+        return None
+
+    @classmethod
+    def outermost(cls, tokens, names):
+        """
+        namesに含まれるtokenのうち、他のtokenに含まれないものを開始位置順に返す
+        """
+        selected = sorted((t for t in tokens if t.name in names), key=lambda t: t.start)
+        result = []
+        for token in selected:
+            if result and token.start < result[-1].end:
+                continue
+            result.append(token)
+        return result
+
+    def sub(self, text, name, replacer, tokens=None):
+        """
+        re.subの代わり: name tagをreplacer(token)の戻り値で置換する
+        """
+        if tokens is None:
+            tokens = self.scan(text)
+        parts = []
+        position = 0
+        for token in TagScanner.outermost(tokens, (name,)):
+            parts.append(text[position:token.start])
+            parts.append(replacer(token))
+            position = token.end
+        parts.append(text[position:])
+        return "".join(parts)
+
+    @classmethod
+    def tag_text(cls, text, token):
+        return text[token.start:token.end]
+
+    @classmethod
+    def inner_text(cls, text, token):
+        return text[token.inner_start:token.inner_end]
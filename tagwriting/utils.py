@@ -1,3 +1,5 @@
+import os
+import tempfile
 from rich import print
 
 verbose = False
@@ -6,3 +8,62 @@ def verbose_print(msg):
     global verbose
     if verbose:
         print(msg)
+
+def atomic_write(path, data: bytes):
+    """
+    temp file + fsync + renameで書き込む。
+    エディタやwatcherが書き込み途中のファイルを見ることがない。
+    """
+    path = os.path.realpath(path)
+    dirpath = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=dirpath)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        except OSError:
+            pass
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def common_prefix_length(a: bytes, b: bytes) -> int:
+    """
+    二分探索でbytesの共通prefixの長さを求める (1 byteずつ比較するより速い)
+    """
+    a, b = memoryview(a), memoryview(b)
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def splice_write(path, old: bytes, new: bytes):
+    """
+    ディスク上の内容(old)とnewを比べて、変わった範囲だけを書き込む。
+      -> 長さが同じ: 変わった範囲だけ
+      -> 長さが違う: 変わった位置から後ろだけ
+    その場で書き換えるので、atomic_writeと違って書きかけの状態が見えることがある
+    """
+    prefix = common_prefix_length(old, new)
+    with open(path, 'r+b') as f:
+        f.seek(prefix)
+        if len(old) == len(new):
+            suffix = common_prefix_length(old[prefix:][::-1], new[prefix:][::-1])
+            f.write(new[prefix:len(new) - suffix])
+        else:
+            f.write(new[prefix:])
+            f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+    verbose_print(f"[green][Process] Splice write: {len(new) - prefix} bytes from offset {prefix}[/green]")
@@ -0,0 +1,178 @@
+import os
+import threading
+from rich import print
+from watchdog.events import FileSystemEventHandler
+from tagwriting.utils import verbose_print
+
+
+class DirectoryEventHandler(FileSystemEventHandler):
+    """
+    非再帰でwatchしているディレクトリに、ディレクトリが作られた/消えたときにwatchを付け替える
+    """
+
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_created(self, event):
+        if event.is_directory:
+            self.watcher.add_tree(event.src_path)
+
+    def on_deleted(self, event):
+        if event.is_directory:
+            self.watcher.remove_tree(event.src_path)
+
+    def on_moved(self, event):
+        if event.is_directory:
+            self.watcher.remove_tree(event.src_path)
+            self.watcher.add_tree(event.dest_path)
+
+
+class PrunedWatcher:
+    """
+    除外するディレクトリ(.git, node_modules, ...)にwatchを登録しないobserver。
+
+    native (inotify等):
+      - 除外するディレクトリを含まないsubtree -> 再帰のwatch一つ
+      - 除外するディレクトリを含むディレクトリ -> 非再帰のwatch + 子を同じように辿る
+      -> 除外したディレクトリにはinotifyのwatchを使わない
+    polling (network filesystem向け):
+      - rootに再帰のwatchを一つだけ登録し、snapshotで除外するディレクトリを辿らない
+
+    is_pruned: (パス, is_dir) -> 除外するならTrue (ここではディレクトリだけを渡す)
+    gitignore: GitIgnore or None -> 辿ったディレクトリの.gitignoreを読み込む
+    """
+
+    def __init__(self, handler, is_pruned, backend="auto", polling_interval=1.0, gitignore=None):
+        self.handler = handler
+        self.is_pruned = is_pruned
+        self.backend = backend
+        self.gitignore = gitignore
+        self.observer = self.create_observer(backend, polling_interval)
+        # dirpath -> (ObservedWatch, recursive)
+        self._watches = {}
+        self._lock = threading.Lock()
+        self._directory_handler = DirectoryEventHandler(self)
+
+    def create_observer(self, backend, polling_interval):
+        if backend == "polling":
+            from watchdog.observers.polling import PollingObserverVFS
+            return PollingObserverVFS(os.stat, self._listdir, polling_interval=polling_interval)
+        if backend == "inotify":
+            try:
+                from watchdog.observers.inotify import InotifyObserver
+                return InotifyObserver()
+            except (ImportError, OSError) as e:
+                print(f"[yellow][Warning] inotify is not available ({e}). Use the default observer.[/yellow]")
+        from watchdog.observers import Observer
+        return Observer()
+
+    def _listdir(self, path):
+        # polling: 除外するディレクトリはsnapshotに含めない
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False) and self.is_pruned(entry.path, True):
+                continue
+            yield entry
+
+    @property
+    def watch_count(self):
+        with self._lock:
+            return len(self._watches)
+
+    def plan(self, dirpath, recursive_dirs, flat_dirs):
+        """
+        dirpath以下を辿り、再帰でwatchするディレクトリと非再帰でwatchするディレクトリに分ける。
+          return: Trueのとき、dirpath以下に除外するディレクトリがない
+        """
+        if self.gitignore is not None:
+            self.gitignore.load(dirpath)
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError:
+            return True
+        clean = True
+        clean_children = []
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if self.is_pruned(entry.path, True):
+                verbose_print(f"[white][Info] Skip watching: {entry.path}[/white]")
+                clean = False
+            elif self.plan(entry.path, recursive_dirs, flat_dirs):
+                clean_children.append(entry.path)
+            else:
+                clean = False
+        if not clean:
+            flat_dirs.append(dirpath)
+            recursive_dirs.extend(clean_children)
+        return clean
+
+    def add_tree(self, top, recursive=True):
+        """
+        topをwatchする (recursive=Falseのときはtopのディレクトリだけ)
+        """
+        top = os.path.abspath(top)
+        if not recursive:
+            self._schedule(top, False)
+            return
+        if self.is_pruned(top, True) or self._is_covered(top):
+            return
+        recursive_dirs, flat_dirs = [], []
+        if self.plan(top, recursive_dirs, flat_dirs):
+            recursive_dirs, flat_dirs = [top], []
+        if self.backend == "polling":
+            # pollingは_listdirで除外するので、topに一つだけ
+            recursive_dirs, flat_dirs = [top], []
+        for dirpath in flat_dirs:
+            self._schedule(dirpath, False)
+        for dirpath in recursive_dirs:
+            self._schedule(dirpath, True)
+
+    def _is_covered(self, path):
+        # 既に再帰のwatchの下にあるか
+        with self._lock:
+            parent = path
+            while True:
+                watch = self._watches.get(parent)
+                if watch is not None and (parent == path or watch[1]):
+                    return True
+                next_parent = os.path.dirname(parent)
+                if next_parent == parent:
+                    return False
+                parent = next_parent
+
+    def _schedule(self, dirpath, recursive):
+        with self._lock:
+            if dirpath in self._watches:
+                return
+        try:
+            watch = self.observer.schedule(self.handler, dirpath, recursive=recursive)
+        except OSError as e:
+            # inotifyのwatch数の上限など
+            print(f"[yellow][Warning] Failed to watch {dirpath}: {e}[/yellow]")
+            return
+        if not recursive:
+            self.observer.add_handler_for_watch(self._directory_handler, watch)
+        with self._lock:
+            self._watches[dirpath] = (watch, recursive)
+
+    def remove_tree(self, top):
+        top = os.path.abspath(top)
+        with self._lock:
+            removed = [path for path in self._watches
+                       if path == top or path.startswith(top.rstrip(os.sep) + os.sep)]
+            watches = [self._watches.pop(path)[0] for path in removed]
+        for watch in watches:
+            try:
+                self.observer.unschedule(watch)
+            except (KeyError, OSError):
+                pass
+
+    def start(self):
+        self.observer.start()
+
+    def stop(self):
+        self.observer.stop()
+
+    def join(self):
+        self.observer.join()
@@ -0,0 +1,89 @@
+import queue
+import threading
+from rich import print
+from tagwriting.utils import verbose_print
+
+
+class WorkQueue:
+    """
+    watchdogのobserver threadと処理(ConsoleClient.on_change)の間に入るqueue。
+
+    - workers: 処理を行うthreadの数
+      -> 一つのファイルの遅いLLM呼び出しが、他のファイルの処理を止めないようにする
+    - 同じファイルは同時に処理しない (per-file serialization)
+      -> 処理中にイベントが来たら、処理が終わった後に同じworkerでもう一度処理する
+    - 既にqueueに入っているファイルのイベントは一つにまとめる (coalescing)
+    - maxsize: queueが一杯のときはsubmitがblockする (backpressure)
+    """
+
+    def __init__(self, handler, workers=2, maxsize=64):
+        self._handler = handler
+        self._workers = max(1, workers)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._running = set()
+        self._dirty = set()
+        self._threads = []
+
+    def start(self):
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._worker, name=f"tagwriting-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def join(self):
+        """
+        queueが空になり、全ての処理が終わるまで待つ
+        """
+        self._queue.join()
+
+    def submit(self, path):
+        """
+        return: queueに追加した場合はTrue, まとめられた場合はFalse
+        """
+        with self._lock:
+            if path in self._pending:
+                verbose_print(f"[white][Info] Coalesced: {path}[/white]")
+                return False
+            if path in self._running:
+                verbose_print(f"[white][Info] Requeue after running: {path}[/white]")
+                self._dirty.add(path)
+                return False
+            self._pending.add(path)
+        self._queue.put(path)
+        return True
+
+    def _worker(self):
+        while True:
+            path = self._queue.get()
+            if path is None:
+                self._queue.task_done()
+                return
+            with self._lock:
+                self._pending.discard(path)
+                self._running.add(path)
+            try:
+                while True:
+                    self._run(path)
+                    with self._lock:
+                        if path not in self._dirty:
+                            self._running.discard(path)
+                            break
+                        self._dirty.discard(path)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, path):
+        try:
+            self._handler(path)
+        except Exception as e:
+            # workerが落ちると、以降のイベントが処理されなくなるので握りつぶす
+            print(f"[red][Error] {path}: {e}[/red]")
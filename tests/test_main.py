@@ -1,6 +1,18 @@
 import pytest
 from tagwriting.main import TextManager, FileChangeHandler, ConsoleClient, HTMLClient
+from tagwriting.disk_cache import DiskCache
+from tagwriting.file_change_handler import ContentHashes
+from tagwriting.utils import atomic_write, splice_write
+from tagwriting.tag_scanner import TagScanner
+from tagwriting.llm_simple_client import LLMSimpleClient, LLMClientRegistry, HedgedClient
+from tagwriting.metrics import Metrics
+from tagwriting.context_window import SectionIndex, estimate_tokens
+from tagwriting.include_resolver import IncludeResolver
+from tagwriting.history_store import HistoryStore
+import requests
 import os
+import json
+from collections import OrderedDict
 
 def test_extract_tag_contents_no_attr():
     text = "<prompt>foobar</prompt>"
@@ -27,11 +39,10 @@ def test_extract_tag_contents_not_found():
     result = TextManager.extract_tag_contents("prompt", text)
     assert result is None
 
-# TODO: この実装が終わったら対応する
-# def test_extract_tag_contents_inner_tag():
-#     text = "<prompt>foo <prompt>bar</prompt> baz</prompt>"
-#     result = TextManager.extract_tag_contents("prompt", text)
-#     assert result == ("<prompt>bar</prompt>", "bar", [], None)
+def test_extract_tag_contents_inner_tag():
+    text = "<prompt>foo <prompt>bar</prompt> baz</prompt>"
+    result = TextManager.extract_tag_contents("prompt", text)
+    assert result == ("<prompt>bar</prompt>", "bar", [], None)
 
 def test_extract_tag_contents_llm_name_and_attrs():
     text = "<prompt(gpt):funny:detail>foobar</prompt>"
@@ -133,6 +144,12 @@ def test_replace_include_tags(tmp_path):
     # エラー時はNoneを返すので、Noneまたは元テキストのままならOK
     assert result is None or result == missing_text
 
+    # binary / UTF-8でないファイルも、タグをそのまま残す
+    binary_file = tmp_path / "image.png"
+    binary_file.write_bytes(b"\x89PNG\r\n\x1a\n\xff\xfe\x00")
+    binary_text = f"before <include>{binary_file.name}</include> after"
+    assert TextManager.replace_include_tags(str(include_file), binary_text) == binary_text
+
     # 複数の<include>タグ
     multi_file = tmp_path / "multi.md"
     multi_file.write_text("A")
@@ -255,4 +272,903 @@ def test_html_to_text_main_not_exists():
     """
     result, _ = HTMLClient.html_to_text(html, url_strip=False, simple_text=True)
     assert "全体テキスト" in result
-    assert "フッター" in result
\ No newline at end of file
+    assert "フッター" in result
+
+def test_disk_cache_get_set(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"), ttl=60)
+    assert cache.get("url:https://example.com") is None
+    cache.set("url:https://example.com", "body", {"etag": '"abc"'})
+    value, meta, fresh = cache.get("url:https://example.com")
+    assert value == "body"
+    assert fresh
+    assert DiskCache.validators(meta) == {"If-None-Match": '"abc"'}
+
+def test_disk_cache_ttl_stale(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"), ttl=-1)
+    cache.set("k", "v")
+    # ttl <= 0 は期限なし
+    assert cache.get("k")[2]
+    cache.ttl = 0.000001
+    assert not cache.get("k")[2]
+    cache.touch("k")
+    cache.ttl = 60
+    assert cache.get("k")[2]
+
+def test_disk_cache_lru_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"), max_bytes=10)
+    cache.set("a", "12345")
+    cache.set("b", "12345")
+    # aにアクセスして、bを最も古いものにする
+    cache.get("a")
+    cache.set("c", "12345")
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+def test_disk_cache_meta_default(tmp_path):
+    import sqlite3
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"))
+    with sqlite3.connect(cache.path) as conn:
+        conn.execute("INSERT INTO cache (key, value, size, stored_at, accessed_at) VALUES ('k', 'v', 1, 0, 0)")
+    conn.close()
+    assert cache.get("k")[1] == {}
+
+def test_fetch_url_cache_key_includes_options(tmp_path, monkeypatch):
+    fetched = []
+    class Response:
+        status_code = 200
+        headers = {}
+    def fake_fetch(url, headers=None, max_bytes=None):
+        fetched.append(url)
+        return Response(), "<html><head><title>T</title></head><body><p> 本文 </p></body></html>"
+    monkeypatch.setattr(HTMLClient, "fetch", classmethod(lambda cls, url, **kwargs: fake_fetch(url, **kwargs)))
+    templates = ConsoleClient.build_templates({"config": {"url_strip": False, "url_source": False}})
+    cache = DiskCache(str(tmp_path / "fetch.sqlite3"))
+    manager = TextManager(str(tmp_path / "a.md"), templates, {"previous_prompt": "", "previous_response": ""}, cache)
+    plain = manager._fetch_url("https://example.com")
+    assert "Source URL" not in plain
+    assert manager._fetch_url("https://example.com") == plain
+    assert len(fetched) == 1
+    # url_source / url_stripを変えたら、古い変換結果は使わない
+    templates["config"]["url_source"] = True
+    assert "Source URL: [T](https://example.com)" in manager._fetch_url("https://example.com")
+    templates["config"]["url_strip"] = True
+    stripped = manager._fetch_url("https://example.com")
+    assert "本文" in stripped and " 本文 " not in stripped
+    assert len(fetched) == 3
+
+def test_disk_cache_closes_connections(tmp_path, monkeypatch):
+    import sqlite3
+    connections = []
+    connect = sqlite3.connect
+    def tracking_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        connections.append(conn)
+        return conn
+    monkeypatch.setattr("tagwriting.disk_cache.sqlite3.connect", tracking_connect)
+    cache = DiskCache(str(tmp_path / "cache.sqlite3"))
+    cache.set("k", "v")
+    assert cache.get("k")[0] == "v"
+    cache.touch("k")
+    assert connections
+    for conn in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+
+def test_cache_paths_resolve_against_watch_dir(tmp_path, monkeypatch):
+    watch_dir = tmp_path / "notes"
+    watch_dir.mkdir()
+    cwd = tmp_path / "elsewhere"
+    cwd.mkdir()
+    monkeypatch.chdir(cwd)
+    client = ConsoleClient()
+    client.watch_path_is_dir = True
+    client.watch_path = str(watch_dir)
+    client.dirpath = str(tmp_path)
+    client.load_templates(None)
+    config = client.templates["config"]
+    assert config["fetch_cache_path"] == str(watch_dir / ".tagwriting" / "fetch_cache.sqlite3")
+    assert client.fetch_cache.path == config["fetch_cache_path"]
+    assert config["response_cache_path"].startswith(str(watch_dir))
+    assert client.templates["history"]["path"].startswith(str(watch_dir))
+    assert not (cwd / ".tagwriting").exists()
+
+def test_cache_paths_resolve_against_yaml_dir(tmp_path, monkeypatch):
+    conf_dir = tmp_path / "conf"
+    conf_dir.mkdir()
+    yaml_path = conf_dir / "templates.yaml"
+    yaml_path.write_text("config:\n  fetch_cache_path: cache/fetch.sqlite3\n", encoding="utf-8")
+    monkeypatch.chdir(tmp_path)
+    client = ConsoleClient()
+    client.watch_path_is_dir = True
+    client.watch_path = str(tmp_path / "notes")
+    client.dirpath = str(tmp_path)
+    client.load_templates(str(yaml_path))
+    assert client.templates["config"]["fetch_cache_path"] == str(conf_dir / "cache" / "fetch.sqlite3")
+    from tagwriting.config_builder import ConfigBuilder
+    templates = ConfigBuilder.build({"config": {"metrics_file": "metrics.jsonl"}}, str(conf_dir))
+    assert templates["config"]["metrics_file"] == str(conf_dir / "metrics.jsonl")
+    assert ConfigBuilder.build(None, str(conf_dir))["config"]["metrics_file"] is None
+
+def test_tag_scanner_scan_all_tags():
+    scanner = TagScanner.compile(("prompt", "chat", "url", "summary"))
+    text = "<summary(gpt):funny>a</summary> <url>https://example.com</url> <chat>b</chat>"
+    tokens = scanner.scan(text)
+    assert [t.name for t in tokens] == ["summary", "url", "chat"]
+    assert tokens[0].attrs == ["funny"]
+    assert tokens[0].llm_name == "gpt"
+    assert TagScanner.inner_text(text, tokens[1]) == "https://example.com"
+    assert TagScanner.tag_text(text, tokens[2]) == "<chat>b</chat>"
+
+def test_tag_scanner_prefix_name():
+    # <prompts> は <prompt> ではない
+    scanner = TagScanner.compile(("prompt",))
+    assert scanner.scan("<prompts>foo</prompts>") == []
+
+def test_tag_scanner_unclosed_inner_tag():
+    scanner = TagScanner.compile(("prompt", "chat"))
+    text = "<prompt>foo <chat>bar</prompt>"
+    tokens = scanner.scan(text)
+    assert len(tokens) == 1
+    assert TagScanner.inner_text(text, tokens[0]) == "foo <chat>bar"
+
+def test_tag_scanner_sub():
+    scanner = TagScanner.compile(("url",))
+    text = "a <url>x</url> b <url>y</url>"
+    result = scanner.sub(text, "url", lambda t: TagScanner.inner_text(text, t).upper())
+    assert result == "a X b Y"
+
+class FakeLLMClient:
+    base_url = "http://localhost/v1"
+    model = "fake"
+    calls = 0
+
+    def __init__(self, llm_name=None):
+        self.llm_name = llm_name
+
+    def ask_ai(self, system_prompt, user_prompt, stream=False, on_delta=None):
+        FakeLLMClient.calls += 1
+        prompt = user_prompt.strip().splitlines()[-1]
+        if stream and on_delta:
+            on_delta(f"[{prompt[:1]}")
+        return f"[{prompt}]"
+
+def test_extract_prompt_tags_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: FakeLLMClient(llm_name)))
+    target = tmp_path / "batch.md"
+    target.write_text("A <prompt>one</prompt> B <chat>two</chat> C <summary>three</summary> D <prompt> </prompt>", encoding="utf-8")
+    templates = ConsoleClient.build_templates({
+        "tags": [{"tag": "summary", "format": "sum {prompt}"}],
+        "history": {"file": None},
+        "config": {"batch_process": True, "history_warning": False}})
+    manager = TextManager(str(target), templates, {"previous_prompt": "", "previous_response": ""})
+    results = manager.extract_prompt_tags_batch()
+    assert sorted(prompt for prompt, _ in results) == ["one", "sum three", "two"]
+    assert target.read_text(encoding="utf-8") == "A [one] B [two] C [sum three] D  "
+
+class FakeStreamResponse:
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(line.encode("utf-8") for line in self.lines)
+
+    def close(self):
+        pass
+
+def test_read_stream():
+    deltas = []
+    completion = FakeStreamResponse([
+        'data: {"choices": [{"delta": {"role": "assistant"}}]}',
+        '',
+        'data: {"choices": [{"delta": {"content": "Hel"}}]}',
+        'data: {"choices": [{"delta": {"content": "lo"}}], "citations": ["https://example.com"]}',
+        'data: [DONE]',
+    ])
+    content, citations = LLMSimpleClient.read_stream(completion, deltas.append)
+    assert content == "Hello"
+    assert citations == ["https://example.com"]
+    assert deltas == ["Hel", "Hello"]
+
+def test_read_stream_utf8_without_charset():
+    import io
+    deltas = []
+    body = "".join(
+        "data: " + json.dumps({"choices": [{"delta": {"content": text}}]}, ensure_ascii=False) + "\n\n"
+        for text in ("こんにちは", "世界")) + "data: [DONE]\n\n"
+    completion = requests.models.Response()
+    completion.status_code = 200
+    # charsetなし -> requestsはISO-8859-1として扱う
+    completion.headers["Content-Type"] = "text/event-stream"
+    completion.raw = io.BytesIO(body.encode("utf-8"))
+    content, _ = LLMSimpleClient.read_stream(completion, deltas.append)
+    assert content == "こんにちは世界"
+    assert deltas == ["こんにちは", "こんにちは世界"]
+
+def test_stream_writer(tmp_path, monkeypatch):
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: FakeLLMClient(llm_name)))
+    target = tmp_path / "stream.md"
+    target.write_text("A <chat>two</chat> B", encoding="utf-8")
+    templates = ConsoleClient.build_templates({
+        "history": {"file": None},
+        "config": {"stream": True, "stream_interval": 0, "history_warning": False}})
+    manager = TextManager(str(target), templates, {"previous_prompt": "", "previous_response": ""})
+    on_delta, state = manager._stream_writer("@@processing@@")
+    target.write_text("A @@processing@@ B", encoding="utf-8")
+    on_delta("Hel<prompt>")
+    assert target.read_text(encoding="utf-8") == "A Hel@@processing@@ B"
+    assert state["written"] == "Hel"
+    manager._splice_response("@@processing@@", "Hello", state)
+    assert manager.text == "A Hello B"
+
+    target.write_text("A <chat>two</chat> B", encoding="utf-8")
+    assert manager.extract_prompt_tag() == ("two", "[two]")
+    assert target.read_text(encoding="utf-8") == "A [two] B"
+
+def test_llm_client_registry_reload(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("TAGWRITING_MODEL", raising=False)
+    env_file = tmp_path / ".env.test"
+    env_file.write_text("TAGWRITING_API_KEY=key\nTAGWRITING_BASE_URL=http://localhost:1/v1\nTAGWRITING_MODEL=a\n")
+    LLMClientRegistry.clear()
+    client = LLMClientRegistry.get("test")
+    assert client.model == "a"
+    assert LLMClientRegistry.get("test") is client
+    # 同じbase_urlならSessionを共有する
+    assert client.session is LLMClientRegistry.session("http://localhost:1/v1")
+    # os.environは書き換えない
+    assert "TAGWRITING_MODEL" not in os.environ
+    env_file.write_text("TAGWRITING_API_KEY=key\nTAGWRITING_BASE_URL=http://localhost:1/v1\nTAGWRITING_MODEL=b\n")
+    os.utime(env_file, (0, 0))
+    assert LLMClientRegistry.get("test").model == "b"
+    LLMClientRegistry.clear()
+
+def test_work_queue_serializes_and_coalesces():
+    import threading
+    import time
+    from tagwriting.work_queue import WorkQueue
+    calls = []
+    active = set()
+    overlap = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler(path):
+        if path in active:
+            overlap.append(path)
+        active.add(path)
+        calls.append(path)
+        if path == "a.md" and calls.count("a.md") == 1:
+            started.set()
+            release.wait(5)
+        active.discard(path)
+
+    work_queue = WorkQueue(handler, workers=2, maxsize=8)
+    work_queue.start()
+    assert work_queue.submit("a.md")
+    started.wait(5)
+    # a.mdは処理中 -> 終わった後にもう一度だけ処理する
+    assert not work_queue.submit("a.md")
+    assert not work_queue.submit("a.md")
+    assert work_queue.submit("b.md")
+    time.sleep(0.1)
+    release.set()
+    work_queue.join()
+    work_queue.stop()
+    assert calls.count("a.md") == 2
+    assert calls.count("b.md") == 1
+    assert overlap == []
+
+class FakeEvent:
+    def __init__(self, src_path):
+        self.src_path = src_path
+
+def test_file_change_handler_debounce_per_file_and_hash(tmp_path):
+    a = tmp_path / "a.md"
+    b = tmp_path / "b.md"
+    a.write_text("a")
+    b.write_text("b")
+    changed = []
+    templates = {"ignore": [], "target": ["*.md"], "selfpath": None}
+    hashes = ContentHashes()
+    handler = FileChangeHandler(str(tmp_path), changed.append, templates, debounce_interval=0, content_hashes=hashes)
+    handler.on_modified(FakeEvent(str(a)))
+    # 別のファイルはdebounceされない
+    handler.on_modified(FakeEvent(str(b)))
+    assert changed == [str(a), str(b)]
+    # 内容が変わっていなければ処理しない
+    handler.on_modified(FakeEvent(str(a)))
+    assert changed == [str(a), str(b)]
+    # 自分で書き込んだ内容も処理しない
+    a.write_text("written by tagwriting")
+    hashes.record(str(a), b"written by tagwriting")
+    handler.on_modified(FakeEvent(str(a)))
+    assert changed == [str(a), str(b)]
+    a.write_text("edited by user")
+    handler.on_modified(FakeEvent(str(a)))
+    assert changed == [str(a), str(b), str(a)]
+
+def test_watch_processes_all_tags_in_one_save(tmp_path, monkeypatch):
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: FakeLLMClient(llm_name)))
+    target = tmp_path / "note.md"
+    client = ConsoleClient()
+    client.templates = ConsoleClient.build_templates({
+        "history": {"file": None}, "target": [str(tmp_path / "*.md")], "config": {"history_warning": False}})
+    handler = FileChangeHandler(str(tmp_path), client.on_change, client.templates,
+                                debounce_interval=0, content_hashes=client.content_hashes)
+    target.write_text("<chat>one</chat>\n<chat>two</chat>", encoding="utf-8")
+    handler.on_modified(FakeEvent(str(target)))
+    # tagwritingの書き込みによるイベントは無視される
+    handler.on_modified(FakeEvent(str(target)))
+    assert target.read_text(encoding="utf-8") == "[one]\n[two]"
+    assert handler.stats["dispatched"] == 1
+    assert client.history["previous_prompt"] == "two"
+
+def test_file_change_handler_debounce_same_file(tmp_path):
+    a = tmp_path / "a.md"
+    a.write_text("a")
+    changed = []
+    templates = {"ignore": [], "target": ["*.md"], "selfpath": None}
+    handler = FileChangeHandler(str(tmp_path), changed.append, templates, debounce_interval=60)
+    handler.on_modified(FakeEvent(str(a)))
+    a.write_text("b")
+    handler.on_modified(FakeEvent(str(a)))
+    assert changed == [str(a)]
+
+def test_atomic_write(tmp_path):
+    target = tmp_path / "atomic.md"
+    target.write_bytes(b"old")
+    os.chmod(target, 0o640)
+    atomic_write(str(target), b"new")
+    assert target.read_bytes() == b"new"
+    assert os.stat(target).st_mode & 0o777 == 0o640
+    # temp fileは残らない
+    assert os.listdir(tmp_path) == ["atomic.md"]
+
+def test_splice_write(tmp_path):
+    target = tmp_path / "splice.md"
+    old = b"0123456789" * 10
+    for new in [old.replace(b"345", b"abc", 1), old[:50] + b"inserted" + old[50:], old[:20]]:
+        target.write_bytes(old)
+        splice_write(str(target), old, new)
+        assert target.read_bytes() == new
+
+def test_save_text_splice(tmp_path):
+    target = tmp_path / "large.md"
+    target.write_text("x" * 100 + "<chat>a</chat>" + "y" * 100, encoding="utf-8")
+    templates = ConsoleClient.build_templates({"config": {"splice_write_threshold": 10}})
+    manager = TextManager(str(target), templates, {"previous_prompt": "", "previous_response": ""})
+    manager._load_text()
+    manager.text = manager.text.replace("<chat>a</chat>", "@@processing@@")
+    manager._save_text()
+    assert target.read_text(encoding="utf-8") == "x" * 100 + "@@processing@@" + "y" * 100
+
+def test_extract_prompt_tag_large(tmp_path, monkeypatch):
+    prompts = []
+    class CapturingClient(FakeLLMClient):
+        def ask_ai(self, system_prompt, user_prompt, stream=False, on_delta=None):
+            prompts.append(user_prompt)
+            return super().ask_ai(system_prompt, user_prompt, stream, on_delta)
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: CapturingClient(llm_name)))
+    target = tmp_path / "journal.md"
+    head = "日記の行です\r\n" * 200
+    target.write_bytes((head + "last line\r\n<summary>abc</summary>\r\ntail\r\n").encode("utf-8"))
+    templates = ConsoleClient.build_templates({
+        "tags": [{"tag": "summary", "format": "sum {prompt}"}],
+        "history": {"file": None},
+        "config": {"large_file_threshold": 1024, "large_file_context_bytes": 64, "history_warning": False}})
+    hashes = ContentHashes()
+    manager = TextManager(str(target), templates, {"previous_prompt": "", "previous_response": ""},
+                          content_hashes=hashes)
+    assert manager.is_large_file()
+    assert manager.extract_prompt_tag() == ("sum abc", "[sum abc]")
+    data = target.read_bytes()
+    # 改行コードはファイルに合わせ、タグの前後は変えない
+    assert data == (head + "last line\r\n[sum abc]\r\ntail\r\n").encode("utf-8")
+    assert hashes.get(str(target)) == ContentHashes.digest(data)
+    # contextはタグの周辺だけ
+    assert "last line\n@@processing@@\ntail" in prompts[0]
+    assert prompts[0].count("日記の行です") < 10
+
+def test_response_cache_replay(tmp_path, monkeypatch):
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: FakeLLMClient(llm_name)))
+    monkeypatch.setattr(FakeLLMClient, "calls", 0)
+    target = tmp_path / "cache.md"
+    templates = ConsoleClient.build_templates({
+        "history": {"file": None},
+        "config": {"duplicate_prompt": True, "history_warning": False}})
+    history = {"previous_prompt": "", "previous_response": ""}
+    response_cache = DiskCache(str(tmp_path / "response.sqlite3"), table="response")
+    for _ in range(2):
+        target.write_text("A <chat>two</chat> B", encoding="utf-8")
+        manager = TextManager(str(target), templates, history, response_cache=response_cache)
+        assert manager.extract_prompt_tag() == ("two", "[two]")
+        history["previous_prompt"] = "two"
+        assert target.read_text(encoding="utf-8") == "A [two] B"
+    # 2回目はキャッシュから書き戻す
+    assert FakeLLMClient.calls == 1
+
+class FakeCompletionSession:
+    def __init__(self):
+        self.urls = []
+
+    def post(self, url, **kwargs):
+        self.urls.append(url)
+        prompt = kwargs["json"]["messages"][-1]["content"].strip().splitlines()[-1]
+        response = requests.models.Response()
+        response.status_code = 200
+        response._content = json.dumps(
+            {"choices": [{"message": {"content": f"[{prompt}]"}}]}).encode("utf-8")
+        return response
+
+def test_response_cache_replay_after_build_url(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("TAGWRITING_API_KEY", "key")
+    monkeypatch.setenv("TAGWRITING_BASE_URL", "http://localhost/v1")
+    session = FakeCompletionSession()
+    client = LLMSimpleClient(session=session)
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: client))
+    target = tmp_path / "cache.md"
+    templates = ConsoleClient.build_templates({"history": {"file": None}, "config": {"history_warning": False}})
+    history = {"previous_prompt": "", "previous_response": ""}
+    response_cache = DiskCache(str(tmp_path / "response.sqlite3"), table="response")
+    for _ in range(2):
+        for prompt in ("A", "B"):
+            target.write_text(f"<chat>{prompt}</chat>", encoding="utf-8")
+            manager = TextManager(str(target), templates, history, response_cache=response_cache)
+            assert manager.extract_prompt_tag() == (prompt, f"[{prompt}]")
+    # build_urlの後もkeyは変わらない -> 2回目は両方ともキャッシュから
+    assert session.urls == ["http://localhost/v1/chat/completions"] * 2
+    assert client.base_url == "http://localhost/v1"
+
+def test_batch_client_find_files(tmp_path, monkeypatch):
+    from tagwriting.main import BatchClient
+    # target/ignoreはcurrent directoryからの相対パス
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "ignored").mkdir()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.md").write_text("x <chat>hi</chat>", encoding="utf-8")
+    (tmp_path / "b.md").write_text("no tags", encoding="utf-8")
+    (tmp_path / "c.txt").write_text("<summary>custom</summary>", encoding="utf-8")
+    (tmp_path / "ignored" / "d.md").write_text("<prompt>x</prompt>", encoding="utf-8")
+    (tmp_path / "sub" / "e.py").write_text("<prompt>x</prompt>", encoding="utf-8")
+    yaml_path = tmp_path / "templates.yaml"
+    yaml_path.write_text(
+        "ignore:\n  - 'ignored'\ntags:\n  - tag: summary\n    format: '{prompt}'\n",
+        encoding="utf-8")
+    client = BatchClient(str(tmp_path), str(yaml_path))
+    assert client.find_files() == [str(tmp_path / "a.md"), str(tmp_path / "c.txt")]
+
+def test_metrics_spans_and_counters(tmp_path):
+    metrics = Metrics()
+    jsonl = tmp_path / "metrics.jsonl"
+    metrics.configure(str(jsonl))
+    with metrics.span("llm"):
+        pass
+    metrics.incr("cache", cache="url", result="hit")
+    metrics.incr("cache", cache="url", result="hit")
+    metrics.incr("llm_bytes_sent", 128)
+    assert metrics.counter("cache", cache="url", result="hit") == 2
+    text = metrics.prometheus_text()
+    assert 'tagwriting_cache_total{cache="url",result="hit"} 2' in text
+    assert "tagwriting_llm_bytes_sent_total 128" in text
+    assert 'tagwriting_stage_seconds_count{stage="llm"} 1' in text
+    metrics.configure(None)
+    records = [json.loads(line) for line in jsonl.read_text(encoding="utf-8").splitlines()]
+    assert [r["type"] for r in records] == ["span", "counter", "counter", "counter"]
+
+def test_section_index_window():
+    text = ("# Top\n\nintro\n\n## A\n\na1\n\na2\n\na3 @@processing@@\n\na4\n\na5\n\n"
+            "```\n# not heading\n```\n\n## B\n\nb1\n")
+    index = SectionIndex(text)
+    assert [h.title for h in index.headings] == ["Top", "A", "B"]
+    offset = text.find("@@processing@@")
+    window = index.window(offset, neighbors=1)
+    assert window == "# Top\n## A\n\n...\n\na2\n\na3 @@processing@@\n\na4\n\n..."
+    # neighbors=None -> section全体 (コードブロックの#は見出しではない)
+    assert "# not heading" in index.window(offset, neighbors=None)
+    assert "b1" not in index.window(offset, neighbors=None)
+    # budgetを超える段落は入れない
+    assert "a2" not in index.window(offset, neighbors=1, max_tokens=8)
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("日本語") == 3
+
+def test_extract_prompt_tag_section_context(tmp_path, monkeypatch):
+    FakeLLMClient.calls = 0
+    captured = {}
+    def fake_ask_ai(self, system, user, stream=False, on_delta=None):
+        FakeLLMClient.calls += 1
+        captured["user"] = user
+        return "done"
+    monkeypatch.setattr(FakeLLMClient, "ask_ai", fake_ask_ai)
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, name=None: FakeLLMClient()))
+    target = tmp_path / "notes.md"
+    target.write_text("# One\n\nfar away\n\n# Two\n\nnear <prompt:section>q</prompt>\n", encoding="utf-8")
+    templates = ConsoleClient.build_templates({
+        "history": {"file": None},
+        "config": {"history_warning": False}})
+    history = {"previous_prompt": "", "previous_response": ""}
+    manager = TextManager(str(target), templates, history)
+    assert manager.extract_prompt_tag() == ("q", "done")
+    assert "near @@processing@@" in captured["user"]
+    assert "far away" not in captured["user"]
+
+def test_include_resolver_nested_cycle_and_cache(tmp_path):
+    resolver = IncludeResolver()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.md").write_text("A[<include>sub/b.md</include>]", encoding="utf-8")
+    (tmp_path / "sub" / "b.md").write_text("B<include>../a.md</include>", encoding="utf-8")
+    (tmp_path / "glossary.md").write_text("G", encoding="utf-8")
+    main = str(tmp_path / "main.md")
+    # 入れ子の展開 / 循環したタグは残す
+    assert resolver.resolve(main, "<include>a.md</include>") == "A[B<include>../a.md</include>]"
+    # 同じrequestの2回目以降は展開しない
+    seen = set()
+    assert resolver.resolve(main, "<include>glossary.md</include>", seen) == "G"
+    assert resolver.resolve(main, "x<include>glossary.md</include>", seen) == "x"
+    # 見つからないファイルはタグを残す
+    assert resolver.resolve(main, "<include>none.md</include>") == "<include>none.md</include>"
+    # (mtime, size)が変わったら読み直す
+    glossary = tmp_path / "glossary.md"
+    glossary.write_text("G2", encoding="utf-8")
+    assert resolver.resolve(main, "<include>glossary.md</include>") == "G2"
+
+class FakeWikipediaResponse:
+    status_code = 200
+
+    def __init__(self, params):
+        self.params = params
+
+    def json(self):
+        titles = self.params["titles"].split("|")
+        return {"query": {
+            "normalized": [{"from": t, "to": t.capitalize()} for t in titles if t != t.capitalize()],
+            "pages": {str(i): {"title": t.capitalize(), "extract": f" {t.capitalize()} text "}
+                      for i, t in enumerate(titles)},
+        }}
+
+def test_build_wikipedia_resources_batched(tmp_path, monkeypatch):
+    calls = []
+    def fake_get(url, params=None, timeout=None):
+        calls.append((url, dict(params)))
+        return FakeWikipediaResponse(params)
+    monkeypatch.setattr(requests, "get", fake_get)
+    templates = ConsoleClient.build_templates({
+        "history": {"file": None},
+        "config": {"history_warning": False, "wikipedia_extract": "intro"}})
+    manager = TextManager(str(tmp_path / "a.md"), templates, {})
+    context = "<wikipedia>python</wikipedia> <wikipedia>Ruby</wikipedia> <wikipedia(en):full>Go</wikipedia>"
+    prompt = "<wikipedia>python</wikipedia>"
+    resources = manager._build_wikipedia_resources(context, prompt)
+    assert "## python\n\nPython text" in resources
+    assert "## Ruby\n\nRuby text" in resources
+    assert "## Go\n\nGo text" in resources
+    # introはまとめて一回、fullは一件ずつ
+    assert sorted((url, params["titles"]) for url, params in calls) == [
+        ("https://en.wikipedia.org/w/api.php", "Go"),
+        ("https://ja.wikipedia.org/w/api.php", "Ruby|python"),
+    ]
+    # 2回目はキャッシュから
+    manager._build_wikipedia_resources(context, prompt)
+    assert len(calls) == 2
+
+def test_replace_url_tags_many_concurrent(tmp_path, monkeypatch):
+    import time
+    import threading
+    active = {}
+    peak = {}
+    lock = threading.Lock()
+    calls = []
+    class Response:
+        headers = {}
+        def __init__(self, status_code):
+            self.status_code = status_code
+    def fake_fetch(cls, url, headers=None, max_bytes=None):
+        host = url.split("/")[2]
+        with lock:
+            calls.append(url)
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+        time.sleep(0.05)
+        with lock:
+            active[host] -= 1
+        if url.endswith("error"):
+            raise Exception("timeout")
+        return Response(404 if url.endswith("404") else 200), url
+    def fake_html_to_text_async(cls, body, url_strip, simple_text, parser="auto", workers=2):
+        # 変換中はslotを返している -> 同じホストの次のリクエストが使える
+        with TextManager.host_slot(body, 1):
+            pass
+        return f"text:{body}", None
+    monkeypatch.setattr(HTMLClient, "fetch", classmethod(fake_fetch))
+    monkeypatch.setattr(HTMLClient, "html_to_text_async", classmethod(fake_html_to_text_async))
+    templates = ConsoleClient.build_templates({
+        "history": {"file": None},
+        "config": {"history_warning": False, "url_per_host": 1, "url_source": False}})
+    manager = TextManager(str(tmp_path / "a.md"), templates, {})
+    urls = [f"https://a.example/{i}" for i in range(4)] + ["https://b.example/404", "https://b.example/error"]
+    context = " ".join(f"<url>{url}</url>" for url in urls)
+    prompt = f"<url>{urls[0]}</url>"
+    prompt, context = manager.replace_url_tags_many([prompt, context])
+    assert prompt == "text:https://a.example/0"
+    assert context.startswith("text:https://a.example/0 text:https://a.example/1")
+    # 404 -> "", 例外 -> タグを残す
+    assert context.endswith("text:https://a.example/3  <url>https://b.example/error</url>")
+    assert sorted(calls) == sorted(urls)
+    assert peak["a.example"] == 1
+    # 使い終わったホストのslotは残らない
+    assert TextManager._host_slots == {}
+
+def test_get_titles_deadline_and_cache(monkeypatch):
+    import time
+    calls = []
+    def fake_read_head(cls, url, max_bytes=32 * 1024, timeout=10):
+        calls.append(url)
+        if "slow" in url:
+            time.sleep(0.5)
+        return "<html><head><title> Hello &amp;\n 世界 </title>".encode("shift_jis"), "shift_jis"
+    monkeypatch.setattr(HTMLClient, "read_head", classmethod(fake_read_head))
+    monkeypatch.setattr(HTMLClient, "_titles", OrderedDict())
+    titles = HTMLClient.get_titles(["https://fast.example", "https://slow.example"], deadline=0.1)
+    assert titles == {"https://fast.example": "Hello & 世界", "https://slow.example": "https://slow.example"}
+    HTMLClient.get_titles(["https://fast.example"], deadline=0.1)
+    assert calls.count("https://fast.example") == 1
+    # <meta charset>からcharsetを判定する
+    data = '<head><meta charset="euc-jp"><title>日本</title>'.encode("euc-jp")
+    assert HTMLClient.parse_title(data) == "日本"
+
+class FakeStreamingResponse:
+    def __init__(self, body, content_type="text/html", status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.headers = {"Content-Type": content_type}
+        self.encoding = content_type.split("charset=")[-1] if "charset=" in content_type else "ISO-8859-1"
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+def test_html_client_fetch_charset_and_size(monkeypatch):
+    body = "<html><head><title>表題</title></head><body>本文</body></html>".encode("shift_jis")
+    monkeypatch.setattr(requests, "get",
+                        lambda url, **kwargs: FakeStreamingResponse(body, "text/html; charset=shift_jis"))
+    _, text = HTMLClient.fetch("https://example.com")
+    assert "本文" in text
+    # headerにcharsetがなければutf-8 (apparent_encodingは使わない)
+    body = "<p>日本語</p>".encode("utf-8") * 100
+    monkeypatch.setattr(requests, "get",
+                        lambda url, **kwargs: FakeStreamingResponse(body))
+    _, text = HTMLClient.fetch("https://example.com", max_bytes=len(body) // 2)
+    assert len(text.encode("utf-8")) <= len(body) // 2
+
+def test_extract_prompt_tags_batch_large_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: FakeLLMClient(llm_name)))
+    target = tmp_path / "journal.md"
+    head = "日記の行です\n" * 200
+    target.write_text(head + "<chat>one</chat>\n<chat> </chat>\n<chat>two</chat>\n", encoding="utf-8")
+    templates = ConsoleClient.build_templates({
+        "history": {"file": None},
+        "config": {"batch_process": True, "large_file_threshold": 1024, "history_warning": False}})
+    # defaultではlarge fileとして扱わない
+    assert ConsoleClient.build_templates(None)["config"]["large_file_threshold"] == 0
+    manager = TextManager(str(target), templates, {"previous_prompt": "", "previous_response": ""})
+    assert manager.extract_prompt_tags_batch() == [("one", "[one]"), ("two", "[two]")]
+    assert target.read_text(encoding="utf-8") == head + "[one]\n \n[two]\n"
+
+def test_html_to_text_async_process_pool_large_page(monkeypatch):
+    import tagwriting.html_client
+    messages = []
+    monkeypatch.setattr(tagwriting.html_client, "verbose_print", messages.append)
+    rows = "".join(f"<div><p>段落{i}</p></div>" for i in range(20000))
+    html = f"<html><head><title>T</title></head><body><main>{rows}</main></body></html>"
+    assert len(html) >= HTMLClient.PROCESS_POOL_THRESHOLD
+    text, title = HTMLClient.html_to_text_async(html, False, True, workers=1)
+    # process poolの結果がそのまま返る (その場で変換し直さない)
+    assert not any("process pool failed" in message for message in messages)
+    assert type(title) is str and title == "T"
+    assert "段落19999" in text
+    # forkではなくspawnのpoolを使い、shutdown_poolで止める
+    assert HTMLClient._pool._mp_context.get_start_method() == "spawn"
+    HTMLClient.shutdown_pool()
+    assert HTMLClient._pool is None
+
+def test_html_to_text_async_process_pool(monkeypatch):
+    monkeypatch.setattr(HTMLClient, "PROCESS_POOL_THRESHOLD", 0)
+    html = "<html><head><title>T</title></head><body><main>メイン</main></body></html>"
+    assert HTMLClient.html_to_text_async(html, False, True, workers=1) == ("メイン", "T")
+    text, title = HTMLClient.html_to_text_async(html, False, False, parser="html.parser", workers=0)
+    assert "メイン" in text and title == "T"
+
+def test_path_matcher_directory_prefix_and_glob(tmp_path):
+    from tagwriting.path_matcher import PathMatcher
+    matcher = PathMatcher([str(tmp_path / ".git"), str(tmp_path / "*.md")])
+    assert matcher.match(str(tmp_path / ".git" / "objects" / "ab"))
+    assert matcher.match(str(tmp_path / ".git"))
+    assert not matcher.match(str(tmp_path / ".github" / "x.txt"))
+    assert matcher.match(str(tmp_path / "sub" / "a.md"))
+    assert not matcher.match(str(tmp_path / "a.txt"))
+
+def test_text_file_cache(tmp_path, monkeypatch):
+    from tagwriting.path_matcher import TextFileCache
+    cache = TextFileCache()
+    path = tmp_path / "a.bin"
+    path.write_bytes(b"\0\1\2")
+    assert not cache.is_text_file(str(path))
+    calls = []
+    original = TextFileCache.detect
+    monkeypatch.setattr(TextFileCache, "detect", classmethod(
+        lambda cls, p, blocksize=512: calls.append(p) or original(p, blocksize)))
+    assert not cache.is_text_file(str(path))
+    assert calls == []
+    path.write_bytes(b"text file")
+    assert cache.is_text_file(str(path))
+    assert calls == [str(path)]
+
+def test_gitignore_rules(tmp_path):
+    from tagwriting.path_matcher import GitIgnore
+    (tmp_path / ".gitignore").write_text("*.log\n!keep.log\n/build/\nnode_modules/\n", encoding="utf-8")
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / ".gitignore").write_text("secret.md\n", encoding="utf-8")
+    gitignore = GitIgnore(str(tmp_path))
+    gitignore.load(str(tmp_path))
+    gitignore.load(str(tmp_path / "pkg"))
+    assert gitignore.ignored(str(tmp_path / "a.log"))
+    assert not gitignore.ignored(str(tmp_path / "keep.log"))
+    assert gitignore.ignored(str(tmp_path / "build"), is_dir=True)
+    assert gitignore.ignored(str(tmp_path / "build" / "out.md"))
+    assert not gitignore.ignored(str(tmp_path / "pkg" / "build"), is_dir=True)
+    assert gitignore.ignored(str(tmp_path / "pkg" / "node_modules" / "x.md"))
+    assert gitignore.ignored(str(tmp_path / "pkg" / "secret.md"))
+    assert not gitignore.ignored(str(tmp_path / "secret.md"))
+    assert gitignore.ignored(str(tmp_path / ".git"), is_dir=True)
+
+def test_pruned_watcher_plan(tmp_path):
+    from tagwriting.watcher import PrunedWatcher
+    for d in ["docs/a", "src/.git/objects", "src/lib", "node_modules/x"]:
+        (tmp_path / d).mkdir(parents=True)
+    pruned = {str(tmp_path / "node_modules"), str(tmp_path / "src" / ".git")}
+    watcher = PrunedWatcher(None, lambda path, is_dir: path in pruned)
+    recursive_dirs, flat_dirs = [], []
+    assert not watcher.plan(str(tmp_path), recursive_dirs, flat_dirs)
+    assert sorted(flat_dirs) == [str(tmp_path), str(tmp_path / "src")]
+    assert sorted(recursive_dirs) == [str(tmp_path / "docs"), str(tmp_path / "src" / "lib")]
+
+def test_pruned_watcher_gitignore_dir_only_rule(tmp_path):
+    from tagwriting.path_matcher import GitIgnore
+    from tagwriting.watcher import PrunedWatcher
+    for d in ["docs", "node_modules/pkg"]:
+        (tmp_path / d).mkdir(parents=True)
+    (tmp_path / ".gitignore").write_text("node_modules/\n", encoding="utf-8")
+    gitignore = GitIgnore(str(tmp_path))
+    templates = {"ignore": [], "target": [], "selfpath": None}
+    handler = FileChangeHandler(str(tmp_path), None, templates, gitignore=gitignore)
+    watcher = PrunedWatcher(None, lambda path, is_dir: handler.is_ignored(path, is_dir), gitignore=gitignore)
+    recursive_dirs, flat_dirs = [], []
+    assert not watcher.plan(str(tmp_path), recursive_dirs, flat_dirs)
+    # "node_modules/"のようなディレクトリだけのruleで、ディレクトリ自体をwatchしない
+    assert flat_dirs == [str(tmp_path)]
+    assert recursive_dirs == [str(tmp_path / "docs")]
+
+def test_file_change_handler_batch_window(tmp_path):
+    import time
+    changed = []
+    target = tmp_path / "a.md"
+    target.write_text("hello", encoding="utf-8")
+    templates = {"ignore": [], "target": [], "selfpath": None}
+    handler = FileChangeHandler(str(tmp_path), changed.append, templates, debounce_interval=0, batch_window=0.05)
+    for _ in range(5):
+        handler.on_modified(FakeEvent(str(target)))
+    assert changed == []
+    time.sleep(0.2)
+    assert changed == [str(target)]
+    assert handler.stats["batched"] == 4
+
+def test_history_store_sqlite(tmp_path, monkeypatch):
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: FakeLLMClient(llm_name)))
+    target = tmp_path / "note.md"
+    target.write_text("A <prompt(gpt)>one</prompt> B", encoding="utf-8")
+    templates = ConsoleClient.build_templates({
+        "history": {"backend": "sqlite", "path": str(tmp_path / "history.sqlite3"), "flush_interval": 0.01}})
+    manager = TextManager(str(target), templates, {"previous_prompt": "", "previous_response": ""})
+    assert manager.extract_prompt_tag() == ("one", "[one]")
+    store = HistoryStore.from_templates(templates)
+    store.flush()
+    # markdownのhistoryファイルは作らない
+    assert not (tmp_path / "note.history.md").exists()
+    rows = store.query(file=str(target), prompt="one", model="fake")
+    assert [(r["prompt"], r["response"], r["llm"]) for r in rows] == [("one", "[one]", "gpt")]
+    assert store.query(search="nothing") == []
+    HistoryStore.close_all()
+
+def test_history_store_rotate_and_command(tmp_path):
+    from click.testing import CliRunner
+    from tagwriting.main import main
+    path = tmp_path / "history.sqlite3"
+    store = HistoryStore(str(path), max_bytes=16 * 1024, keep=2, batch_size=10, flush_interval=0.01)
+    for i in range(60):
+        store.append(str(tmp_path / "a.md"), f"prompt {i}", "x" * 1000, model="m", timestamp=i)
+    store.close()
+    assert os.path.exists(f"{path}.2") and not os.path.exists(f"{path}.3")
+    # rotateしたファイルもまとめて新しい順に引ける
+    rows = store.query(limit=None)
+    assert [r["prompt"] for r in rows] == [f"prompt {i}" for i in range(59, 59 - len(rows), -1)]
+    assert len(rows) > 10
+    yaml_path = tmp_path / "templates.yaml"
+    yaml_path.write_text(f"history:\n  backend: sqlite\n  path: {path}\n  keep: 2\n", encoding="utf-8")
+    result = CliRunner().invoke(main, ["history", "--templates", str(yaml_path), "--prompt", "prompt 59",
+                                       "--format", "jsonl"])
+    assert result.exit_code == 0, result.output
+    assert [json.loads(line)["prompt"] for line in result.output.splitlines()] == ["prompt 59"]
+
+class SlowLLMClient:
+    def __init__(self, name, delay, response):
+        self.base_url = f"http://{name}/v1"
+        self.model = name
+        self.delay = delay
+        self.response = response
+        self.calls = 0
+        self.cancelled = False
+
+    def ask_ai(self, system_prompt, user_prompt, stream=False, on_delta=None, cancel=None):
+        import time
+        self.calls += 1
+        time.sleep(self.delay)
+        self.cancelled = cancel.is_set()
+        return None if self.cancelled else self.response
+
+def test_hedged_client(tmp_path, monkeypatch):
+    import time
+    # primaryが速ければ、secondaryには投げない
+    primary, secondary = SlowLLMClient("a", 0, "A"), SlowLLMClient("b", 0, "B")
+    assert HedgedClient([primary, secondary], hedge_delay=1.0).ask_ai("s", "u") == "A"
+    assert secondary.calls == 0
+    # primaryが遅いと、hedge_delayの後にsecondaryにも投げて、先に返った方を使う
+    primary, secondary = SlowLLMClient("a", 0.5, "A"), SlowLLMClient("b", 0, "B")
+    assert HedgedClient([primary, secondary], hedge_delay=0.05).ask_ai("s", "u") == "B"
+    time.sleep(0.6)
+    assert primary.cancelled
+    # primaryが失敗したら、待たずにsecondaryに投げる
+    primary, secondary = SlowLLMClient("a", 0, None), SlowLLMClient("b", 0, "B")
+    started = time.time()
+    assert HedgedClient([primary, secondary], hedge_delay=5).ask_ai("s", "u") == "B"
+    assert time.time() - started < 1
+    # (group)の指定 / config.llm_groupでHedgedClientを使う
+    clients = {None: SlowLLMClient("default", 0, "D"), "gpt": SlowLLMClient("gpt", 0, "G")}
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: clients[llm_name]))
+    templates = ConsoleClient.build_templates({"config": {"llm_groups": {"fast": ["gpt", None]}}})
+    manager = TextManager(str(tmp_path / "a.md"), templates, {"previous_prompt": "", "previous_response": ""})
+    assert isinstance(manager.llm_client("fast"), HedgedClient)
+    assert manager.llm_client("fast").model == "gpt|default"
+    assert manager.llm_client(None) is clients[None]
+    templates["config"]["llm_group"] = "fast"
+    assert manager.llm_client(None).ask_ai("s", "u") == "G"
+    # 回答したbackendのmodelを見る
+    hedged = HedgedClient([SlowLLMClient("a", 0, None), SlowLLMClient("b", 0, "B")], hedge_delay=5)
+    assert hedged.winner_model is None
+    assert hedged.ask_ai("s", "u") == "B"
+    assert hedged.winner_model == "b"
+
+def test_history_records_hedge_winner_model(tmp_path, monkeypatch):
+    clients = {"a": SlowLLMClient("a", 0, None), "b": SlowLLMClient("b", 0, "B")}
+    monkeypatch.setattr(LLMClientRegistry, "get", classmethod(lambda cls, llm_name=None: clients[llm_name]))
+    target = tmp_path / "note.md"
+    target.write_text("<prompt(fast)>one</prompt>", encoding="utf-8")
+    templates = ConsoleClient.build_templates({
+        "history": {"backend": "sqlite", "path": str(tmp_path / "history.sqlite3"), "flush_interval": 0.01},
+        "config": {"llm_groups": {"fast": ["a", "b"]}, "llm_hedge_delay": 5}})
+    manager = TextManager(str(target), templates, {"previous_prompt": "", "previous_response": ""})
+    assert manager.extract_prompt_tag() == ("one", "B")
+    store = HistoryStore.from_templates(templates)
+    store.flush()
+    # group全体の"a|b"ではなく、回答したbackendのmodel
+    assert [r["model"] for r in store.query(file=str(target))] == ["b"]
+    HistoryStore.close_all()
+